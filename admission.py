@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""Admission control: whether the server can take one more connection.
+
+Instead of a fixed client count alone, new connections are refused when
+any resource the server actually runs out of is close to its limit:
+
+- clients: logged-in clients in the cluster plus connections of this
+  process still logging in, against --max-clients
+- descriptors: open file descriptors against the process limit, keeping
+  FD_RESERVE free for history segments, the metrics server and accept()
+- memory: resident memory against --max-memory
+- backlog: bytes queued for all local clients against --max-backlog, so
+  a server that is already behind on writing does not take on more
+- loop lag: how late the asyncio event loop runs its callbacks, against
+  --max-loop-lag
+
+The expensive signals are sampled at most every SAMPLE_INTERVAL, so a
+burst of connections is judged against the same sample; descriptors are
+counted up for every connection admitted since.
+"""
+import os
+import threading
+import time
+
+import chat_core
+import metrics
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SAMPLE_INTERVAL = 0.25  # seconds
+FD_RESERVE = 32
+
+CLIENTS = 'clients'
+DESCRIPTORS = 'descriptors'
+MEMORY = 'memory'
+BACKLOG = 'backlog'
+LOOP_LAG = 'loop lag'
+REASONS = (CLIENTS, DESCRIPTORS, MEMORY, BACKLOG, LOOP_LAG)
+
+
+def open_descriptors():
+    """Number of open file descriptors, or None where it can't be counted cheaply."""
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+def descriptor_limit():
+    if resource is None:
+        return None
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    return None if soft == resource.RLIM_INFINITY else soft
+
+
+def resident_memory():
+    """Resident set size in bytes, or None where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class AdmissionControl:
+    def __init__(self, max_clients, max_memory=None, max_backlog=None, max_loop_lag=None):
+        self.max_clients = max_clients
+        self.max_memory = max_memory  # bytes
+        self.max_backlog = max_backlog  # bytes
+        self.max_loop_lag = max_loop_lag  # seconds
+        self.lock = threading.Lock()
+        self.handshakes = 0  # admitted connections that have not logged in yet
+        self.loop_lag = 0.0  # kept up to date by the asyncio engine
+        self.sampled_at = None
+        self.descriptors = None
+        self.descriptor_limit = None
+        self.memory = None
+        self.backlog = 0
+        self.admitted_since_sample = 0
+        self.rejected = {reason: 0 for reason in REASONS}
+
+    def _sample(self, now):
+        self.sampled_at = now
+        self.admitted_since_sample = 0
+        self.descriptors = open_descriptors()
+        self.descriptor_limit = descriptor_limit()
+        if self.max_memory:
+            self.memory = resident_memory()
+        if self.max_backlog:
+            self.backlog = chat_core.outbound_backlog_bytes()
+
+    def _refusal(self):
+        if chat_core.cluster_client_count() + self.handshakes >= self.max_clients:
+            return CLIENTS
+        if (self.descriptors is not None and self.descriptor_limit
+                and self.descriptors + self.admitted_since_sample >= self.descriptor_limit - FD_RESERVE):
+            return DESCRIPTORS
+        if self.max_memory and self.memory is not None and self.memory >= self.max_memory:
+            return MEMORY
+        if self.max_backlog and self.backlog >= self.max_backlog:
+            return BACKLOG
+        if self.max_loop_lag and self.loop_lag >= self.max_loop_lag:
+            return LOOP_LAG
+        return None
+
+    def check(self):
+        """Admit a new connection; returns None, or the reason it is refused.
+
+        An admitted connection counts against the limits until
+        handshake_done() is called, whether it logs in or not.
+        """
+        now = time.monotonic()
+        with self.lock:
+            if self.sampled_at is None or now - self.sampled_at >= SAMPLE_INTERVAL:
+                self._sample(now)
+            reason = self._refusal()
+            if reason is None:
+                self.handshakes += 1
+                self.admitted_since_sample += 1
+            else:
+                self.rejected[reason] += 1
+            return reason
+
+    def handshake_done(self):
+        """An admitted connection logged in (and now counts as a client) or went away."""
+        with self.lock:
+            self.handshakes -= 1
+
+    def stats(self):
+        """Return a copy of the refused connection counters."""
+        with self.lock:
+            return dict(self.rejected)
+
+
+def _control():
+    return chat_core.admission_control
+
+
+metrics.Gauge("chat_connections_refused", "Connections refused by each admission limit",
+              lambda: {f'reason="{reason}"': count
+                       for reason, count in (_control().stats() if _control() else {}).items()})
+metrics.Gauge("chat_handshakes_pending", "Accepted connections that have not logged in yet",
+              lambda: _control().handshakes if _control() else 0)
+metrics.Gauge("chat_event_loop_lag_seconds", "How late the asyncio event loop last ran a timer",
+              lambda: _control().loop_lag if _control() else 0)
@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+"""Single-threaded asyncio engine for the chat server.
+
+Every connection is a pair of asyncio streams driven by one event loop
+(epoll on Linux, kqueue on macOS), so an idle client costs a few KB of
+buffers instead of a whole OS thread and its stack.
+"""
+import asyncio
+import signal
+import socket
+import sys
+import threading
+
+import admission
+import chat_core
+import console
+import handoff
+import heartbeat
+import metrics
+import protocol
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BUFFER_SIZE = 2048
+FRAMED_RECV_SIZE = 64 * 1024
+LISTEN_BACKLOG = 1024  # also how many connections are accepted per wakeup
+LAG_INTERVAL = 0.1  # seconds between event loop lag measurements
+WRITER_CLOSE_TIMEOUT = 1.0  # seconds a closing client gets to flush its queue
+GOODBYE = "SERVER: Server is shutting down. Goodbye!\n"
+RESTART_GOODBYE = "SERVER: Server is restarting. Please reconnect.\n"
+SERVER_FULL = "Server is full. Try again later."
+
+client_tasks = {}  # task serving a connection -> its writer, waited for on shutdown
+
+
+def raise_fd_limit():
+    """Raise the open file limit to the hard limit so we can hold 10k+ sockets."""
+    if resource is None:
+        return None
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    except (ValueError, OSError):
+        return None
+
+
+def track(task, writer):
+    """Remember a task serving a connection until it finishes."""
+    client_tasks[task] = writer
+    task.add_done_callback(lambda task: client_tasks.pop(task, None))
+
+
+async def close_writer(writer, timeout=WRITER_CLOSE_TIMEOUT):
+    """Close a stream, ignoring errors from an already dead peer.
+
+    A TLS peer that never answers our close_notify is cut off after timeout.
+    """
+    try:
+        writer.close()
+    except Exception:
+        return
+    closed = asyncio.ensure_future(writer.wait_closed())
+    closed.add_done_callback(lambda task: task.cancelled() or task.exception())
+    # Unlike wait_for(), wait() leaves the stream's close waiter alone on timeout
+    done, _ = await asyncio.wait([closed], timeout=timeout)
+    if not done:
+        writer.transport.abort()
+
+
+class AsyncClient(chat_core.Client):
+    """A connected client whose outbound queue is drained by a writer task."""
+    __slots__ = ('ready', 'loop', 'loop_thread', 'reader', 'writer', 'task', 'reading',
+                 'handed_off', 'write_task')
+
+    def __init__(self, reader, writer):
+        # A future only while the writer waits: an asyncio.Event per client costs more
+        self.ready = None
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        super().__init__(writer.get_extra_info('peername'), wakeup=self.wakeup)
+        self.reader = reader
+        self.writer = writer
+        self.task = None  # keeps the read loop of a handed over client alive
+        self.reading = False  # waiting in read() with everything received so far handled
+        self.handed_off = False  # now served by the process that replaced us
+        self.write_task = asyncio.ensure_future(self.write_loop())
+
+    def wakeup(self):
+        """Wake the writer task; safe to call from other threads (history, cluster bus)."""
+        if threading.get_ident() == self.loop_thread:
+            self._wake()
+        else:
+            self.loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        if self.ready is not None and not self.ready.done():
+            self.ready.set_result(None)
+
+    async def read_messages(self):
+        """Yield incoming messages until the client disconnects."""
+        while True:
+            # Framed clients can pipeline, so read as much as is available
+            self.reading = True
+            try:
+                data = await self.reader.read(FRAMED_RECV_SIZE if self.framed else BUFFER_SIZE)
+            finally:
+                self.reading = False
+            if not data:  # Client disconnected
+                return
+            for message in self.parse(data):
+                yield message
+
+    async def write_loop(self):
+        """Drain the outbound queue; drain() only ever suspends this task."""
+        try:
+            while True:
+                batch = self.outbound.take()
+                if batch:
+                    buffers = self.outgoing(batch)
+                    self.writer.writelines(buffers)
+                    metrics.write_calls.inc()
+                    metrics.bytes_out.inc(sum(map(len, buffers)))
+                    await self.writer.drain()
+                elif self.outbound.closed:
+                    break
+                else:
+                    # Everything runs on the loop thread, so nothing can be
+                    # queued between take() and creating the future
+                    self.ready = self.loop.create_future()
+                    try:
+                        await self.ready
+                    finally:
+                        self.ready = None
+        except ConnectionError:
+            self.kick()
+
+    def kick(self):
+        """Disconnect the client; its reader then runs the normal cleanup."""
+        self.outbound.close()
+        self.writer.transport.abort()
+
+    def idle(self):
+        """Whether the client can be handed over: waiting for input with nothing left to write."""
+        return (self.reading and not self.outbound and self.compressor is None
+                and self.compress_after is None
+                and self.writer.transport.get_write_buffer_size() == 0)
+
+    async def close(self, timeout=WRITER_CLOSE_TIMEOUT):
+        """Flush what is still queued, then close the stream, all within timeout."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        self.outbound.close()
+        try:
+            await asyncio.wait_for(self.write_task, timeout)
+        except asyncio.TimeoutError:
+            pass
+        await close_writer(self.writer, max(0, deadline - loop.time()))
+
+
+async def handle_client(reader, writer):
+    """Handle a client connection."""
+    track(asyncio.current_task(), writer)
+    addr = writer.get_extra_info('peername')
+
+    reason = chat_core.admission_control.check()
+    if reason:
+        console.log(f"Refused connection from {addr}: {reason}")
+        writer.write(SERVER_FULL.encode('utf-8'))
+        await close_writer(writer)
+        return
+
+    console.log(f"New connection from {addr}")
+    if chat_core.keepalive_idle:
+        heartbeat.set_keepalive(writer.get_extra_info('socket'), chat_core.keepalive_idle)
+    client = AsyncClient(reader, writer)
+    await run_client(client)
+
+
+async def run_client(client, logged_in=False):
+    """Log a client in, unless it was handed over, and handle its messages until it leaves."""
+    try:
+        if not logged_in:
+            # Ask for username
+            chat_core.send(client, protocol.PROMPT)
+            try:
+                # A connection that never logs in must not hold its slot forever
+                username_bytes = await asyncio.wait_for(client.reader.read(BUFFER_SIZE),
+                                                        chat_core.login_timeout)
+            except asyncio.TimeoutError:
+                console.log(f"{client.addr} did not log in within {chat_core.login_timeout} seconds")
+                return
+            finally:
+                chat_core.admission_control.handshake_done()
+            if not username_bytes:
+                return
+
+            chat_core.login(client, username_bytes)
+
+        # Main loop
+        async for message in client.read_messages():
+            wait = chat_core.admit(client, message)
+            if wait is None:
+                continue
+            if wait:
+                # Not reading meanwhile pushes back on the sender
+                await asyncio.sleep(wait)
+            if not chat_core.handle_message(client, message):
+                break
+
+    except (OSError, UnicodeDecodeError, protocol.ProtocolError) as e:
+        console.log(f"Error handling client {client.username or client.addr}: {e}")
+    finally:
+        # Client is disconnecting, unless another process serves it now
+        if not client.handed_off:
+            chat_core.logout(client)
+            await client.close()
+
+
+async def drain(clients, goodbye):
+    """Say goodbye and give every client's writer until the drain deadline to flush."""
+    if chat_core.bus:
+        # Its threads outlive the loop, and peers leaving now are no news
+        chat_core.bus.stop()
+    chat_core.flush_broadcasts()
+    for client in clients:
+        client.writer.transport.pause_reading()
+        chat_core.send(client, goodbye)
+        client.outbound.close()
+    await asyncio.gather(*(client.close(chat_core.drain_timeout) for client in clients))
+
+    # Connections that never logged in are still waiting for a name, and the
+    # tasks of the others are logging them out; asyncio.run() would cancel them
+    for writer in client_tasks.values():
+        writer.close()
+    if client_tasks:
+        await asyncio.wait(list(client_tasks), timeout=WRITER_CLOSE_TIMEOUT)
+
+
+async def adopt_clients(channel):
+    """Take over the clients of the process we replace."""
+    adopted = []
+    left = []
+    while True:
+        record, sock = handoff.receive_record(channel)
+        if record is None:
+            break
+        if record["type"] == "end":
+            left = record["left"]
+            break
+        if record["type"] == "header":
+            chat_core.names.restore(record["names"])
+            continue
+        reader, writer = await asyncio.open_connection(sock=sock)
+        client = AsyncClient(reader, writer)
+        chat_core.adopt(client, record)
+        adopted.append(client)
+
+    # Only read from them once the old process has let go
+    channel.sendall(handoff.ACK)
+    channel.close()
+    for client in adopted:
+        client.task = asyncio.ensure_future(run_client(client, logged_in=True))
+        track(client.task, client.writer)
+    print(f"Took over {len(adopted)} clients")
+
+    # The clients that were not handed over are being disconnected
+    for username in left:
+        chat_core.presence_changed(username, True)
+        chat_core.announce_left(username)
+
+
+async def hot_restart(servers):
+    """Hand the listening sockets and idle clients to a new process.
+
+    Returns None once the new process has taken over. If it did not, the
+    clients are resumed and copies of the listening sockets are returned
+    so we can carry on serving.
+    """
+    loop = asyncio.get_running_loop()
+    # Copies of the listening sockets keep the accept queue alive while nobody accepts
+    listeners = [socket.fromfd(sock.fileno(), sock.family, sock.type)
+                 for server in servers for sock in server.sockets]
+    for server in servers:
+        server.close()
+
+    # Held batches must be queued before we wait for the queues to empty
+    chat_core.flush_broadcasts()
+    # Stop reading and wait until every client that can be moved has
+    # everything it sent handled and everything queued for it written
+    connected = chat_core.recipients()
+    for client in connected:
+        client.writer.transport.pause_reading()
+    # A TLS connection's state lives in our OpenSSL, so only plaintext sockets can be passed on
+    movable = [client for client in connected if client.compressor is None and client.compress_after is None
+               and client.writer.get_extra_info('ssl_object') is None]
+    deadline = loop.time() + chat_core.drain_timeout
+    while loop.time() < deadline and not all(client.idle() for client in movable):
+        await asyncio.sleep(0.01)
+    movable = [client for client in movable if client.idle()]
+
+    chat_core.history_store.flush(max(0, deadline - loop.time()))
+    metrics.stop_http_server()
+    channel = None
+    try:
+        process, channel = handoff.spawn_successor(listeners, with_clients=True)
+        handoff.send_record(channel, {"type": "header", "names": chat_core.names.export()})
+        for client in movable:
+            record = dict(chat_core.client_state(client), type="client")
+            handoff.send_record(channel, record, client.writer.get_extra_info('socket').fileno())
+        left = [client.username for client in connected if client not in movable]
+        handoff.send_record(channel, {"type": "end", "left": left})
+        await loop.run_in_executor(None, handoff.wait_for_ack, channel, process)
+    except (handoff.HandoffError, OSError) as e:
+        print(f"Hot restart failed: {e}")
+        for client in connected:
+            client.writer.transport.resume_reading()
+        return listeners
+    finally:
+        if channel:
+            channel.close()
+
+    for sock in listeners:
+        sock.close()
+    print(f"Handed {len(movable)} of {len(connected)} clients to process {process.pid}")
+    for client in movable:
+        # Forget it without a word; closing our copy of its socket does not disconnect it
+        client.handed_off = True
+        chat_core.unregister(client)
+        client.outbound.close()
+        client.reader.feed_eof()
+    return None
+
+
+async def monitor_loop_lag(control):
+    """Measure how late the loop wakes a sleeping task; a busy loop is slow for every client."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        control.loop_lag = max(0.0, loop.time() - start - LAG_INTERVAL)
+
+
+async def run_heartbeat(monitor):
+    """Check on silent clients every heartbeat tick."""
+    while True:
+        await asyncio.sleep(heartbeat.TICK)
+        monitor.tick()
+
+
+def listen_options(backlog, tls_context):
+    """Arguments for asyncio.start_server(); the loop runs TLS handshakes without blocking."""
+    options = {"backlog": backlog}
+    if tls_context is not None:
+        options.update(ssl=tls_context, ssl_handshake_timeout=chat_core.login_timeout)
+        if sys.version_info >= (3, 11):
+            # The default waits 30 seconds for the peer's close_notify
+            options.update(ssl_shutdown_timeout=chat_core.drain_timeout)
+    return options
+
+
+async def serve(host, port, reuse_port, backlog, tls_context):
+    """Accept connections until told to shut down or restart."""
+    loop = asyncio.get_running_loop()
+    if chat_core.batcher:
+        # Batches are started by bus threads too, so always go through the loop
+        chat_core.batcher.schedule = lambda delay, callback: loop.call_soon_threadsafe(
+            loop.call_later, delay, callback)
+    lag_monitor = asyncio.ensure_future(monitor_loop_lag(chat_core.admission_control))
+    ticker = None
+    if chat_core.heartbeat_monitor:
+        ticker = asyncio.ensure_future(run_heartbeat(chat_core.heartbeat_monitor))
+
+    options = listen_options(backlog, tls_context)
+    listeners = handoff.inherited_listeners()
+    if listeners:
+        servers = [await asyncio.start_server(handle_client, sock=sock, **options)
+                   for sock in listeners]
+    else:
+        servers = [await asyncio.start_server(
+            handle_client, host, port, reuse_address=True, reuse_port=reuse_port, **options)]
+    print(f"Server started on {host}:{port} (asyncio engine{', TLS' if tls_context else ''})")
+    channel = handoff.inherited_channel()
+    if channel:
+        await adopt_clients(channel)
+    print("Waiting for connections...")
+
+    if chat_core.bus:
+        # Bus events arrive on its reader threads; run them on the loop
+        chat_core.bus.start(loop.call_soon_threadsafe)
+
+    requests = asyncio.Queue()
+    actions = [(signal.SIGINT, "shutdown"), (getattr(signal, 'SIGTERM', None), "shutdown")]
+    if not chat_core.bus:
+        # Pre-fork workers share the port with their siblings; restart the whole cluster instead
+        actions.append((getattr(signal, 'SIGUSR2', None), "restart"))
+    for signum, action in actions:
+        try:
+            loop.add_signal_handler(signum, requests.put_nowait, action)
+        except (TypeError, NotImplementedError, RuntimeError):
+            pass  # Windows, or no such signal
+
+    goodbye = GOODBYE
+    try:
+        while True:
+            action = await requests.get()
+            if action == "shutdown":
+                print("\nShutting down server...")
+                break
+            print("Restarting server...")
+            listeners = await hot_restart(servers)
+            if listeners is None:
+                # Clients that could not be moved (compressed or TLS streams, busy) have to reconnect
+                goodbye = RESTART_GOODBYE
+                break
+            servers = [await asyncio.start_server(handle_client, sock=sock, **options)
+                       for sock in listeners]
+    finally:
+        lag_monitor.cancel()
+        if ticker:
+            ticker.cancel()
+        for server in servers:
+            server.close()
+        # Close all connections, giving writers until the drain deadline to flush the goodbye
+        await drain(chat_core.recipients(), goodbye)
+
+
+def start_async_server(host, port, max_clients, reuse_port=False, backlog=LISTEN_BACKLOG,
+                       tls_context=None):
+    """Start the chat server on a single-threaded event loop."""
+    if chat_core.admission_control is None:
+        chat_core.admission_control = admission.AdmissionControl(max_clients)
+    fd_limit = raise_fd_limit()
+    if fd_limit is not None and fd_limit < max_clients + 16:
+        print(f"Warning: open file limit {fd_limit} is below --max-clients {max_clients}")
+
+    try:
+        asyncio.run(serve(host, port, reuse_port, backlog, tls_context))
+    except KeyboardInterrupt:
+        # Only reaches us where the loop cannot handle signals (Windows)
+        print("\nShutting down server...")
+    except Exception as e:
+        print(f"Server error: {e}")
+    finally:
+        console.flush()
+        chat_core.print_policy_stats()
+        print("Server closed")
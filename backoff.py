@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""Reconnect delays for the clients.
+
+When a server restarts, every client loses its connection at the same
+moment. Retrying after a fixed delay brings them all back at the same
+moment too, so the delay doubles with every failed attempt and each
+client waits a random time of up to that delay ("full jitter"), which
+spreads the reconnects evenly over the window.
+"""
+import random
+
+INITIAL_DELAY = 0.5  # seconds
+MAX_DELAY = 30.0
+
+
+class Backoff:
+    def __init__(self, initial=INITIAL_DELAY, maximum=MAX_DELAY):
+        self.initial = initial
+        self.maximum = maximum
+        self.attempts = 0
+
+    def next_delay(self):
+        """Seconds to wait before the next attempt."""
+        ceiling = min(self.maximum, self.initial * 2 ** min(self.attempts, 32))
+        self.attempts += 1
+        return random.uniform(0, ceiling)
+
+    def reset(self):
+        """Call once a connection has worked, so the next outage starts over."""
+        self.attempts = 0
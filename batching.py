@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Optional batching of room broadcasts.
+
+Normally every chat line is queued for every member of its room as soon
+as it arrives: a room of N members sending M messages a second costs
+N * M queue puts and up to as many writer wakeups. With a batching
+window the server holds a room's messages for a few milliseconds and then
+queues the whole batch for each member as one buffer, so a busy room
+costs N puts per window however many messages it had, and each member's
+writer sends the batch with one write.
+
+The price is latency: a message waits up to the window before it is
+queued at all. A batch is also flushed as soon as it reaches its size
+cap, so a burst never waits for the timer and one batch never grows past
+what a client's queue accepts.
+
+Batches are per room and flushed in the order they were started;
+messages to everyone (room None) flush every pending batch first, so
+nobody sees a server notice overtake the chat lines before it.
+"""
+import heapq
+import itertools
+import threading
+import time
+
+DEFAULT_MAX_BYTES = 64 * 1024  # a batch is flushed early once it holds this much
+
+
+class RoomBatcher:
+    """Holds each room's broadcasts until its window ends or its batch is full.
+
+    flush(room, entries) is called with the batch in arrival order, from
+    whichever thread adds the entry that fills it or runs the timer.
+    schedule(delay, callback) must be set by the engine before use.
+    """
+
+    def __init__(self, window, max_bytes=DEFAULT_MAX_BYTES, flush=None):
+        self.window = window
+        self.max_bytes = max_bytes
+        self.flush = flush
+        self.schedule = None
+        self.lock = threading.Lock()
+        # Taken around taking a batch and flushing it, so batches of a room go out in order
+        self.flush_lock = threading.Lock()
+        self.pending = {}  # room -> [entries, bytes]
+
+    def add(self, room, entry, size):
+        """Queue entry for room; flushes right away if the batch is full."""
+        with self.lock:
+            batch = self.pending.get(room)
+            if batch is None:
+                batch = self.pending[room] = [[], 0]
+                self.schedule(self.window, lambda: self._flush(room, batch))
+            batch[0].append(entry)
+            batch[1] += size
+            full = batch[1] >= self.max_bytes
+        if full:
+            self._flush(room, batch)
+
+    def _flush(self, room, batch):
+        """Flush batch if it is still the room's pending one."""
+        with self.flush_lock:
+            with self.lock:
+                if self.pending.get(room) is not batch:
+                    return
+                del self.pending[room]
+            self.flush(room, batch[0])
+
+    def flush_now(self, room):
+        """Flush room's pending batch, if it has one, without waiting for the window."""
+        with self.lock:
+            batch = self.pending.get(room)
+        if batch is not None:
+            self._flush(room, batch)
+
+    def flush_all(self):
+        """Flush every pending batch now, oldest first."""
+        with self.flush_lock:
+            with self.lock:
+                batches = list(self.pending.items())
+                self.pending.clear()
+            for room, (entries, _) in batches:
+                self.flush(room, entries)
+
+
+class TimerThread:
+    """Runs callbacks after a delay on one daemon thread, for the thread engine."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.timers = []  # heap of (due, sequence, callback)
+        self.sequence = itertools.count()
+        self.thread = None
+
+    def call_later(self, delay, callback):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+            heapq.heappush(self.timers, (time.monotonic() + delay, next(self.sequence), callback))
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.monotonic()
+                    if self.timers and self.timers[0][0] <= now:
+                        _, _, callback = heapq.heappop(self.timers)
+                        break
+                    self.condition.wait(self.timers[0][0] - now if self.timers else None)
+            try:
+                callback()
+            except Exception as e:
+                print(f"Timer callback failed: {e}")
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""Benchmark registry lock contention under many concurrent senders.
+
+Runs the chat core in-process with hundreds of sender threads
+broadcasting into rooms while another thread keeps logging clients in and
+out. Compares the old broadcast, which held clients_lock for the whole
+fan-out, with the snapshot broadcast that reads the recipients without
+the lock. Reports broadcast throughput and how long logins and logouts
+had to wait.
+
+    python bench_contention.py --senders 500 --clients 2000 --room-size 200
+"""
+import argparse
+import threading
+import time
+
+import chat_core
+
+
+class BenchClient(chat_core.Client):
+    """A client whose queue is emptied by the benchmark instead of a socket."""
+    __slots__ = ()
+
+    def kick(self):
+        pass
+
+
+def locked_broadcast(message, sender=None, room=None):
+    """The old broadcast: fan out with clients_lock held."""
+    data = message.encode('utf-8')
+    with chat_core.clients_lock:
+        recipients = chat_core.clients if room is None else chat_core.room_index.members_of(room)
+        chat_core._queue_for(recipients, data, sender)
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def setup(args):
+    clients = [BenchClient(("127.0.0.1", i)) for i in range(args.clients)]
+    rooms = max(1, args.clients // args.room_size)
+    for i, client in enumerate(clients):
+        chat_core.register(client, f"bench{i}")
+        chat_core.cmd_join(client, f"bench-{i % rooms}")
+    for client in clients:
+        client.outbound.take()
+    return clients, rooms
+
+
+def run(name, broadcast, args):
+    clients, rooms = setup(args)
+    stop = threading.Event()
+    start_line = threading.Barrier(args.senders + 1)
+    sent = [0] * args.senders
+    waits = []
+
+    def sender(index):
+        client = clients[index % len(clients)]
+        room = f"bench-{index % rooms}"
+        start_line.wait()
+        while not stop.is_set():
+            broadcast("[12:00] bench: hello\n", client, room)
+            sent[index] += 1
+
+    def churn():
+        # Log a client in and out over and over, timing each registry change
+        client = BenchClient(("127.0.0.1", -1))
+        while not stop.is_set():
+            start = time.perf_counter()
+            chat_core.register(client, "churn")
+            waits.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            chat_core.unregister(client)
+            waits.append(time.perf_counter() - start)
+            time.sleep(0.001)
+
+    def drain():
+        while not stop.is_set():
+            for client in clients:
+                client.outbound.take()
+            time.sleep(0.01)
+
+    threads = [threading.Thread(target=sender, args=(i,)) for i in range(args.senders)]
+    threads += [threading.Thread(target=churn), threading.Thread(target=drain)]
+    for thread in threads:
+        thread.start()
+    start_line.wait()
+    start = time.perf_counter()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    for client in clients:
+        chat_core.unregister(client)
+    ordered = sorted(waits)
+    print(f"{name:<10} {sum(sent) / elapsed:>14,.0f} {len(waits) / elapsed:>12,.0f} "
+          f"{percentile(ordered, 0.5) * 1e6:>10.0f} {percentile(ordered, 0.99) * 1e6:>10.0f} "
+          f"{(ordered[-1] if ordered else 0) * 1e6:>10.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Registry lock contention benchmark')
+    parser.add_argument('--senders', type=int, default=500, help='Concurrent sender threads')
+    parser.add_argument('--clients', type=int, default=2000, help='Registered clients')
+    parser.add_argument('--room-size', type=int, default=200, help='Clients per room')
+    parser.add_argument('--duration', type=float, default=3, help='Seconds per run')
+    args = parser.parse_args()
+
+    print(f"{args.senders} senders, {args.clients} clients in rooms of {args.room_size}, "
+          f"{args.duration:g}s per run")
+    print(f"{'broadcast':<10} {'broadcasts/s':>14} {'changes/s':>12} {'p50 us':>10} "
+          f"{'p99 us':>10} {'max us':>10}")
+    run("locked", locked_broadcast, args)
+    run("snapshot", chat_core.broadcast, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""Benchmark the broadcast fan-out path.
+
+Compares the original broadcast (encode the message and send() it once per
+recipient) with the queued path (encode once, share the bytes between
+every recipient's OutboundQueue, flush each queue with one sendmsg()).
+Recipients are local socket pairs drained by a background thread, so the
+numbers measure the server's own cost rather than the network.
+
+    python bench_fanout.py --clients 200 --messages 2000 --burst 8
+"""
+import argparse
+import selectors
+import socket
+import threading
+import time
+
+import outbound
+import protocol
+
+
+def start_drain(sockets):
+    """Read and discard everything arriving on the receiving ends."""
+    selector = selectors.DefaultSelector()
+    for sock in sockets:
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ)
+    stop = threading.Event()
+
+    def drain():
+        while not stop.is_set():
+            for key, _ in selector.select(timeout=0.1):
+                try:
+                    while key.fileobj.recv(1 << 16):
+                        pass
+                except BlockingIOError:
+                    pass
+
+    thread = threading.Thread(target=drain)
+    thread.daemon = True
+    thread.start()
+    return stop, thread
+
+
+def run_legacy(pairs, messages, text):
+    """The original broadcast: encode and send per recipient."""
+    calls = 0
+    for _ in range(messages):
+        for sender, _ in pairs:
+            sender.send(text.encode('utf-8'))
+            calls += 1
+    return calls
+
+
+def run_queued(pairs, messages, text, burst, framed):
+    """Encode once, queue the shared bytes, flush each queue with sendmsg()."""
+    queues = [outbound.OutboundQueue(max_messages=burst + 1) for _ in pairs]
+    calls = 0
+    for i in range(messages):
+        data = text.encode('utf-8')
+        if framed:
+            data = protocol.encode_frame(data)
+        for queue in queues:
+            queue.put(data)
+        # Writers usually find several messages waiting when they wake up
+        if (i + 1) % burst == 0 or i == messages - 1:
+            for (sender, _), queue in zip(pairs, queues):
+                calls += outbound.send_vectored(sender, queue.take())
+    return calls
+
+
+def measure(name, func, pairs, messages, *args):
+    start_cpu = time.thread_time()
+    start = time.perf_counter()
+    calls = func(pairs, messages, *args)
+    elapsed = time.perf_counter() - start
+    cpu = time.thread_time() - start_cpu
+    fanned_out = messages * len(pairs)
+    print(f"{name:<22} {calls / fanned_out:>10.3f} {cpu / fanned_out * 1e6:>12.2f} "
+          f"{fanned_out / elapsed:>14,.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Broadcast fan-out benchmark')
+    parser.add_argument('--clients', type=int, default=200, help='Number of recipients')
+    parser.add_argument('--messages', type=int, default=2000, help='Messages to broadcast')
+    parser.add_argument('--size', type=int, default=80, help='Message size in characters')
+    parser.add_argument('--burst', type=int, default=8,
+                        help='Messages pending per recipient when its writer wakes up')
+    args = parser.parse_args()
+
+    text = f"[12:00] bench: {'x' * args.size}\n"
+    pairs = [socket.socketpair() for _ in range(args.clients)]
+    for sender, _ in pairs:
+        sender.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+    stop, thread = start_drain([receiver for _, receiver in pairs])
+
+    print(f"{args.clients} recipients, {args.messages} messages of {len(text)} bytes, "
+          f"burst {args.burst}")
+    print(f"{'path':<22} {'syscalls/msg':>10} {'cpu us/msg':>12} {'fanned-out/s':>14}")
+    try:
+        measure("legacy send()", run_legacy, pairs, args.messages, text)
+        measure("queued raw", run_queued, pairs, args.messages, text, args.burst, False)
+        measure("queued framed", run_queued, pairs, args.messages, text, args.burst, True)
+    finally:
+        stop.set()
+        thread.join()
+        for sender, receiver in pairs:
+            sender.close()
+            receiver.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""Load generator and latency benchmark for the chat server.
+
+Opens many simulated clients from one asyncio process, puts them into
+rooms, drives a steady message rate through them and reports connection
+setup rate, throughput and end-to-end fan-out latency percentiles. Every
+benchmark message carries its send time, and because senders and
+receivers live in this one process the latency is measured on a single
+clock.
+
+    python bench_load.py --spawn thread --clients 500 --room-size 50 --rate 200
+    python bench_load.py --spawn asyncio --clients 500 --room-size 50 --rate 200
+    python bench_load.py --port 8888 --clients 2000   # against a running server
+    python bench_load.py --spawn asyncio --protocol compact --compress
+    python bench_load.py --spawn thread --tls --server-args "--tls-cert cert.pem --tls-key key.pem"
+    python bench_load.py --spawn asyncio --room-size 200 --rate 2000 --sweep-batch 0,1,2,5,10
+
+--sweep-batch runs the benchmark once per batching window (--batch-ms of
+the server, 0 for none) and prints the tradeoff: throughput, latency and
+how many reads each client needed per message delivered.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import protocol
+import tls
+
+BENCH_TAG = "bench@"
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "python_server.py")
+
+
+class LoadClient:
+    """One simulated connection speaking the framed (or compact) protocol."""
+
+    def __init__(self, index, room, compact=False, compress=False):
+        self.index = index
+        self.username = f"load{index}"
+        self.room = room
+        self.compact = compact
+        self.compress = compress
+        self.reader = None
+        self.writer = None
+        self.messages = protocol.MessageReader()
+        self.messages.prompt_seen = True
+        self.received = 0
+        self.bytes_received = 0
+        self.reads = 0
+
+    async def connect(self, host, port, tls_context=None, local_addr=None):
+        self.reader, self.writer = await asyncio.open_connection(host, port, ssl=tls_context,
+                                                                 local_addr=local_addr)
+        prompt = protocol.PROMPT.encode('utf-8')
+        data = b""
+        while len(data) < len(prompt):
+            chunk = await self.reader.read(len(prompt) - len(data))
+            if not chunk:
+                raise ConnectionError("Server closed the connection during login")
+            data += chunk
+        if data != prompt:
+            raise ConnectionError(f"Unexpected greeting: {data!r}")
+        self.messages.expect_ack()
+        self.writer.write(protocol.offer_framing(self.username, self.compact, self.compress))
+        while self.messages.negotiating:
+            chunk = await self.reader.read(64 * 1024)
+            if not chunk:
+                raise ConnectionError("Server closed the connection during login")
+            # Welcome and scrollback that arrive with the acknowledgement are not measured
+            self.messages.feed(chunk)
+        if not self.messages.framed:
+            raise ConnectionError("Server does not support the framed protocol")
+        if self.room:
+            self.send(f"/join {self.room}")
+
+    def send(self, message):
+        self.writer.write(protocol.encode_frame(message.encode('utf-8')))
+
+    async def receive(self, latencies):
+        """Count benchmark messages and record their latency until cancelled."""
+        while True:
+            data = await self.reader.read(64 * 1024)
+            if not data:
+                return
+            now = time.perf_counter_ns()
+            self.reads += 1
+            self.bytes_received += len(data)
+            for text in self.messages.feed(data):
+                start = text.find(BENCH_TAG)
+                while start >= 0:
+                    end = start + len(BENCH_TAG)
+                    stop = end
+                    while stop < len(text) and text[stop].isdigit():
+                        stop += 1
+                    latencies.append(now - int(text[end:stop]))
+                    self.received += 1
+                    start = text.find(BENCH_TAG, stop)
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def room_name(index, room_size, clients):
+    """Rooms of room_size clients; one room for everybody stays in #general."""
+    if room_size >= clients:
+        return None
+    return f"bench-{index // room_size}"
+
+
+async def connect_all(args):
+    clients = [LoadClient(i, room_name(i, args.room_size, args.clients),
+                          args.protocol == 'compact', args.compress)
+               for i in range(args.clients)]
+    limit = asyncio.Semaphore(args.connect_concurrency)
+    # Benchmark servers use throwaway certificates
+    tls_context = tls.client_context(verify=False) if args.tls else None
+
+    async def connect(client):
+        async with limit:
+            await asyncio.wait_for(client.connect(args.host, args.port, tls_context), args.login_timeout)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(connect(c) for c in clients), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    connected = [c for c, result in zip(clients, results) if result is None]
+    failures = [result for result in results if result is not None]
+    print(f"Connected {len(connected)}/{len(clients)} clients in {elapsed:.2f}s "
+          f"({len(connected) / elapsed:,.0f} connections/s)")
+    if failures:
+        print(f"  {len(failures)} failed, e.g. {failures[0]!r}")
+    return connected
+
+
+async def drive(args, clients):
+    """Send args.rate messages/s spread over the senders for args.duration seconds."""
+    senders = clients[:args.senders] if args.senders else clients
+    total = int(args.rate * args.duration)
+    interval = 1.0 / args.rate
+    start = time.perf_counter()
+    for i in range(total):
+        delay = start + i * interval - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        sender = senders[i % len(senders)]
+        sender.send(f"{'x' * args.size} {BENCH_TAG}{time.perf_counter_ns()}")
+    return total, time.perf_counter() - start, senders
+
+
+def expected_deliveries(clients, senders, total):
+    """Messages each sender's room should have fanned out."""
+    room_sizes = {}
+    for client in clients:
+        room_sizes[client.room] = room_sizes.get(client.room, 0) + 1
+    per_sender = total / len(senders)
+    return sum(per_sender * (room_sizes[s.room] - 1) for s in senders)
+
+
+async def run(args):
+    """Run the benchmark and print its results; returns them for a sweep, or None."""
+    clients = await connect_all(args)
+    if not clients:
+        return None
+
+    latencies = []
+    receivers = [asyncio.ensure_future(c.receive(latencies)) for c in clients]
+    # Let joins and scrollback settle before measuring
+    await asyncio.sleep(args.settle)
+    latencies.clear()
+    for client in clients:
+        client.received = 0
+        client.bytes_received = 0
+        client.reads = 0
+
+    total, elapsed, senders = await drive(args, clients)
+    await asyncio.sleep(args.settle)
+
+    received = sum(c.received for c in clients)
+    bytes_received = sum(c.bytes_received for c in clients)
+    reads = sum(c.reads for c in clients)
+    expected = expected_deliveries(clients, senders, total)
+    ordered = sorted(latencies)
+    print(f"Sent {total} messages in {elapsed:.2f}s ({total / elapsed:,.0f} msgs/s) "
+          f"from {len(senders)} senders")
+    print(f"Delivered {received:,} of {expected:,.0f} expected "
+          f"({received / (elapsed + args.settle):,.0f} deliveries/s)")
+    if received:
+        print(f"Received {bytes_received:,} bytes ({bytes_received / received:.1f} per delivery) "
+              f"in {reads:,} reads ({reads / received:.2f} per delivery)")
+    print("Fan-out latency: " + "  ".join(
+        f"{name} {percentile(ordered, q) / 1e6:.2f}ms"
+        for name, q in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999))))
+
+    for task in receivers:
+        task.cancel()
+    for client in clients:
+        client.close()
+    return {"deliveries": received / (elapsed + args.settle),
+            "delivered": received / expected if expected else 0,
+            "reads": reads / received if received else 0,
+            "p50": percentile(ordered, 0.5) / 1e6, "p99": percentile(ordered, 0.99) / 1e6}
+
+
+def wait_for_port(host, port, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def benchmark(args, server_args):
+    """One run, against a server spawned with server_args added or the one at --port."""
+    server = None
+    if args.spawn:
+        # The server only needs to fit the benchmark clients
+        command = [sys.executable, SERVER_SCRIPT, '--host', args.host, '--port', str(args.port),
+                   '--engine', args.spawn, '--max-clients', str(args.clients + 10)]
+        command += args.server_args.split() + server_args
+        server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+        if not wait_for_port(args.host, args.port):
+            print("Server did not start")
+            server.kill()
+            return None
+        print(f"Spawned {args.spawn} engine (pid {server.pid})")
+
+    try:
+        return asyncio.run(run(args))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Chat server load benchmark')
+    parser.add_argument('--host', default='127.0.0.1', help='Server address')
+    parser.add_argument('--port', type=int, default=8888, help='Server port')
+    parser.add_argument('--spawn', choices=['thread', 'asyncio'],
+                        help='Start python_server.py with this engine for the run')
+    parser.add_argument('--server-args', default='',
+                        help='Extra arguments for the spawned server')
+    parser.add_argument('--clients', type=int, default=200, help='Simulated connections')
+    parser.add_argument('--room-size', type=int, default=50,
+                        help='Clients per room (>= --clients puts everyone in #general)')
+    parser.add_argument('--senders', type=int, default=0,
+                        help='Clients that send messages (default: all)')
+    parser.add_argument('--rate', type=float, default=100, help='Total messages per second')
+    parser.add_argument('--duration', type=float, default=5, help='Seconds of sending')
+    parser.add_argument('--size', type=int, default=40, help='Message body size in characters')
+    parser.add_argument('--protocol', choices=['framed', 'compact'], default='framed',
+                        help='Encoding the simulated clients offer')
+    parser.add_argument('--compress', action='store_true',
+                        help='Have the simulated clients offer zlib compression')
+    parser.add_argument('--tls', action='store_true',
+                        help='Connect with TLS (give the server a certificate with --server-args)')
+    parser.add_argument('--connect-concurrency', type=int, default=100,
+                        help='Connections being set up at the same time')
+    parser.add_argument('--login-timeout', type=float, default=10.0,
+                        help='Seconds a client may take to connect and log in')
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help='Seconds to wait after connecting and after sending')
+    parser.add_argument('--sweep-batch', default=None, metavar='MS,MS,...',
+                        help='Repeat the run with each of these server --batch-ms windows (needs --spawn)')
+    args = parser.parse_args()
+    if args.sweep_batch and not args.spawn:
+        parser.error("--sweep-batch starts its own servers; give --spawn")
+
+    if not args.sweep_batch:
+        benchmark(args, [])
+        return
+    results = []
+    for window in args.sweep_batch.split(","):
+        print(f"--- batch window {window}ms ---")
+        results.append((window, benchmark(args, ['--batch-ms', window])))
+    print(f"{'window':>8} {'deliveries/s':>13} {'delivered':>10} {'p50':>9} {'p99':>9} {'reads/delivery':>15}")
+    for window, result in results:
+        if result is None:
+            print(f"{window + 'ms':>8}  no clients connected")
+            continue
+        print(f"{window + 'ms':>8} {result['deliveries']:>13,.0f} {result['delivered']:>10.1%} "
+              f"{result['p50']:>7.2f}ms {result['p99']:>7.2f}ms {result['reads']:>15.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""Server memory per idle connection, for sizing hosts.
+
+Starts a server with the chosen engine, then logs in idle clients in
+steps (1k, 10k and 50k connections by default) and after each step
+reports the server's resident memory and how much it grew per
+connection since the server had none. The clients use the framed
+protocol and stay silent once logged in, the way most connections of a
+large chat server spend their time. They still read what they are sent,
+so nothing piles up in the server's outbound queues, and each step is
+measured only once the server has gone quiet. The server runs with
+--no-announce: announcing every login to everyone would make reaching n
+connections cost n²/2 deliveries, hours of work at 50k.
+
+    python bench_memory.py --spawn asyncio
+    python bench_memory.py --spawn thread --counts 1000,5000,10000
+
+Every connection needs a file descriptor at both ends, and the thread
+engine also needs two threads per client. Connections are spread over
+127.0.0.x source addresses so the ephemeral ports of one address don't
+run out, and the run stops at the first step the limits of this host
+don't allow.
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+from async_server import raise_fd_limit
+from bench_load import SERVER_SCRIPT, LoadClient, wait_for_port
+
+PORTS_PER_ADDRESS = 20000  # connections from each 127.0.0.x source address
+
+
+def server_memory(pid):
+    """(resident bytes, threads) of a process, from /proc."""
+    with open(f'/proc/{pid}/statm') as f:
+        resident = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    threads = 0
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('Threads:'):
+                threads = int(line.split()[1])
+    return resident, threads
+
+
+class IdleClient(LoadClient):
+    """A logged-in client that only reads, throwing away what it gets."""
+
+    async def discard(self, activity):
+        while True:
+            data = await self.reader.read(64 * 1024)
+            if not data:
+                return
+            activity[0] = time.monotonic()
+
+
+async def connect_up_to(clients, target, args, activity, readers):
+    """Log in clients until there are target of them; returns the failures."""
+    limit = asyncio.Semaphore(args.connect_concurrency)
+
+    async def connect(client):
+        async with limit:
+            source = None
+            if args.host == '127.0.0.1':
+                source = (f"127.0.0.{1 + client.index // PORTS_PER_ADDRESS}", 0)
+            await asyncio.wait_for(client.connect(args.host, args.port, local_addr=source),
+                                   args.login_timeout)
+
+    new = [IdleClient(i, None) for i in range(len(clients), target)]
+    results = await asyncio.gather(*(connect(c) for c in new), return_exceptions=True)
+    for client, result in zip(new, results):
+        if result is None:
+            clients.append(client)
+            readers.append(asyncio.ensure_future(client.discard(activity)))
+        else:
+            client.close()
+    return [result for result in results if result is not None]
+
+
+async def wait_until_quiet(activity, quiet):
+    """Wait until no client has received anything for quiet seconds."""
+    while time.monotonic() - activity[0] < quiet:
+        await asyncio.sleep(quiet / 4)
+
+
+async def run(args, pid):
+    baseline, threads = server_memory(pid)
+    print(f"Server with no clients: {baseline / 2**20:.1f} MB resident, {threads} threads")
+    print(f"{'connections':>12} {'resident':>10} {'threads':>8} {'per connection':>15}")
+    clients = []
+    readers = []
+    activity = [time.monotonic()]
+    for count in args.counts:
+        start = time.perf_counter()
+        failures = await connect_up_to(clients, count, args, activity, readers)
+        await wait_until_quiet(activity, args.quiet)
+        if failures:
+            print(f"{count:>12,}  only {len(clients):,} connected in {time.perf_counter() - start:.0f}s, "
+                  f"e.g. {failures[0]!r}")
+            break
+        resident, threads = server_memory(pid)
+        print(f"{count:>12,} {resident / 2**20:>8.1f}MB {threads:>8} "
+              f"{(resident - baseline) / count:>11,.0f} bytes")
+
+    for task in readers:
+        task.cancel()
+    for client in clients:
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Server memory per idle connection')
+    parser.add_argument('--spawn', choices=['thread', 'asyncio'], default='asyncio',
+                        help='Engine of the server to start')
+    parser.add_argument('--server-args', default='', help='Extra arguments for the server')
+    parser.add_argument('--host', default='127.0.0.1', help='Address the server listens on')
+    parser.add_argument('--port', type=int, default=8889, help='Port the server listens on')
+    parser.add_argument('--counts', default='1000,10000,50000',
+                        help='Comma-separated connection counts to measure at')
+    parser.add_argument('--connect-concurrency', type=int, default=200,
+                        help='Connections being set up at the same time')
+    parser.add_argument('--login-timeout', type=float, default=60.0,
+                        help='Seconds a client may take to connect and log in')
+    parser.add_argument('--quiet', type=float, default=1.0,
+                        help='Seconds without traffic before a step is measured')
+    args = parser.parse_args()
+    args.counts = sorted(int(count) for count in args.counts.split(','))
+
+    fd_limit = raise_fd_limit()
+    if fd_limit is not None and fd_limit < args.counts[-1] + 100:
+        print(f"Warning: open file limit {fd_limit} is below {args.counts[-1]:,} connections")
+
+    command = [sys.executable, SERVER_SCRIPT, '--host', args.host, '--port', str(args.port),
+               '--engine', args.spawn, '--max-clients', str(args.counts[-1] + 10), '--quiet',
+               '--no-announce']
+    command += args.server_args.split()
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    try:
+        if not wait_for_port(args.host, args.port):
+            print("Server did not start")
+            return
+        print(f"Spawned {args.spawn} engine (pid {server.pid})")
+        asyncio.run(run(args, server.pid))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
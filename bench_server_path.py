@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""Microbenchmarks of the per-message server path.
+
+Runs each stage a chat message goes through on the server in-process,
+on one thread, and reports messages per second per core: parsing the
+received bytes, formatting the chat line, the whole of handle_message()
+fanning out to a room, and the writer turning queued messages into
+buffers. Save a run as a baseline and compare later runs against it to
+catch regressions:
+
+    python bench_server_path.py --save baseline.json
+    python bench_server_path.py --compare baseline.json
+
+With --compare the exit status is 1 if any stage got slower than the
+tolerance allows.
+"""
+import argparse
+import json
+import sys
+import time
+import zlib
+
+import chat_core
+import console
+import protocol
+
+
+class BenchClient(chat_core.Client):
+    """A client whose queue is emptied by the benchmark instead of a socket."""
+    __slots__ = ()
+
+    def kick(self):
+        pass
+
+
+def make_client(index, framed=True, compact=False, compress=False):
+    """A registered client in the given mode, as if it had negotiated it at login."""
+    client = BenchClient(("127.0.0.1", index))
+    client.framed = framed
+    client.compact = compact
+    if compress:
+        client.compressor = zlib.compressobj()
+    client.username = f"bench{index}"
+    chat_core.register(client, client.username)
+    return client
+
+
+def setup(args):
+    """A room of room_size clients, a third each raw, framed and compact."""
+    clients = []
+    for i in range(args.room_size):
+        mode = i % 3
+        clients.append(make_client(i, framed=mode > 0, compact=mode == 2,
+                                   compress=mode == 2 and args.compress))
+    for client in clients:
+        chat_core.cmd_join(client, "bench")
+    drain(clients)
+    return clients
+
+
+def drain(clients):
+    for client in clients:
+        client.outgoing(client.outbound.take())
+
+
+def measure(func, iterations, repeat):
+    """Best messages/s over repeat runs of func(iterations)."""
+    best = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(iterations)
+        best = max(best, iterations / (time.perf_counter() - start))
+    return best
+
+
+def stage_parse(args, clients):
+    client = clients[1]  # framed
+    data = protocol.encode_frame(("x" * args.size).encode('utf-8'))
+
+    def run(iterations):
+        for _ in range(iterations):
+            client.parse(data)
+    return run
+
+
+def stage_format_strftime(args, clients):
+    body = "x" * args.size
+
+    def run(iterations):
+        # What every message cost before the minute was cached
+        for _ in range(iterations):
+            timestamp = time.strftime("%H:%M", time.localtime())
+            f"[{timestamp}] #bench bench0: {body}\n"
+    return run
+
+
+def stage_format(args, clients):
+    body = "x" * args.size
+
+    def run(iterations):
+        for _ in range(iterations):
+            chat_core.format_message("bench0", body, "bench")
+    return run
+
+
+def stage_handle(args, clients):
+    sender = clients[0]
+    body = "x" * args.size
+
+    def run(iterations):
+        for i in range(iterations):
+            chat_core.handle_message(sender, body)
+            if i % 64 == 63:
+                # Keep the queues from filling up, without timing the writers
+                for client in clients:
+                    client.outbound.take()
+        for client in clients:
+            client.outbound.take()
+    return run
+
+
+def stage_write(args, clients):
+    writers = [client for client in clients if client.framed]
+    sender = clients[0]
+    body = "x" * args.size
+
+    def run(iterations):
+        # handle_message() is timed too; subtract the handle stage to isolate the writers
+        for i in range(iterations):
+            chat_core.handle_message(sender, body)
+            if i % 64 == 63:
+                drain(writers)
+        drain(clients)
+    return run
+
+
+STAGES = [
+    ("parse", stage_parse),
+    ("format (strftime)", stage_format_strftime),
+    ("format", stage_format),
+    ("handle_message", stage_handle),
+    ("handle + write", stage_write),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-message server path microbenchmarks')
+    parser.add_argument('--room-size', type=int, default=50, help='Clients the message fans out to')
+    parser.add_argument('--size', type=int, default=40, help='Message body size in characters')
+    parser.add_argument('--iterations', type=int, default=20000, help='Messages per run')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per stage; the best one counts')
+    parser.add_argument('--compress', action='store_true',
+                        help='Compact clients in the room also use zlib')
+    parser.add_argument('--save', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Compare against results saved with --save')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='Slowdown from the baseline that counts as a regression')
+    args = parser.parse_args()
+
+    console.log_messages = False
+    clients = setup(args)
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print(f"Room of {args.room_size}, {args.size} character messages, "
+          f"best of {args.repeat} x {args.iterations}")
+    print(f"{'stage':<20} {'msgs/s':>12} {'baseline':>12} {'change':>8}")
+    results = {}
+    regressions = []
+    for name, stage in STAGES:
+        rate = results[name] = measure(stage(args, clients), args.iterations, args.repeat)
+        line = f"{name:<20} {rate:>12,.0f}"
+        if name in baseline:
+            change = rate / baseline[name] - 1
+            line += f" {baseline[name]:>12,.0f} {change:>+8.1%}"
+            if change < -args.tolerance:
+                regressions.append(name)
+        print(line)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        print(f"Regressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
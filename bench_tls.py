@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""What TLS costs: handshakes per second and per-message overhead.
+
+The in-process part runs both ends of a TLS connection over memory
+buffers on one core, so it measures only the cryptography: full
+handshakes, resumed handshakes (session tickets) and encrypting plus
+decrypting one chat message, with the bytes each record adds on the
+wire. With --spawn it also starts a plaintext and a TLS server and
+counts how many connections per second get from connect() to the
+username prompt with each, from --concurrency threads.
+
+    python bench_tls.py
+    python bench_tls.py --spawn thread --concurrency 8
+    python bench_tls.py --cert cert.pem --key key.pem --size 200
+
+Without --cert a throwaway self-signed certificate is generated with
+the openssl command. For end-to-end fan-out latency over TLS, run
+bench_load.py --tls against a server started with --tls-cert.
+"""
+import argparse
+import os
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import protocol
+import tls
+from bench_load import SERVER_SCRIPT, wait_for_port
+
+
+def make_certificate(directory):
+    """Write a self-signed certificate for 127.0.0.1; returns (certfile, keyfile)."""
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=localhost", "-addext", "subjectAltName=IP:127.0.0.1,DNS:localhost",
+                    "-keyout", keyfile, "-out", certfile],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+class MemoryPair:
+    """Both ends of a TLS connection, exchanging records through memory."""
+
+    def __init__(self, server_context, client_context, session=None):
+        self.to_server = ssl.MemoryBIO()
+        self.to_client = ssl.MemoryBIO()
+        self.server = server_context.wrap_bio(self.to_server, self.to_client, server_side=True)
+        self.client = client_context.wrap_bio(self.to_client, self.to_server,
+                                              server_hostname="127.0.0.1", session=session)
+
+    def handshake(self):
+        done = {self.server: False, self.client: False}
+        while not all(done.values()):
+            for end in done:
+                if not done[end]:
+                    try:
+                        end.do_handshake()
+                        done[end] = True
+                    except ssl.SSLWantReadError:
+                        pass
+        # TLS 1.3 tickets follow the handshake; reading delivers them
+        self.server.write(b"x")
+        self.client.read()
+
+    def transfer(self, data):
+        """Send data from server to client; returns the bytes it took on the wire."""
+        self.server.write(data)
+        wire = self.to_client.pending
+        self.client.read(len(data))
+        return wire
+
+
+def bench_handshakes(server_context, client_context, duration):
+    pair = MemoryPair(server_context, client_context)
+    pair.handshake()
+    session = pair.client.session
+
+    results = {}
+    for name, resume in (("full", None), ("resumed", session)):
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < duration:
+            pair = MemoryPair(server_context, client_context, resume)
+            pair.handshake()
+            if resume is not None and not pair.client.session_reused:
+                raise RuntimeError("Session was not resumed")
+            count += 1
+        results[name] = count / (time.perf_counter() - start)
+    return results
+
+
+def bench_messages(server_context, client_context, size, count):
+    """Microseconds and extra wire bytes per framed message of size characters."""
+    message = protocol.encode_frame(f"[12:00] someone: {'x' * size}\n".encode('utf-8'))
+    pair = MemoryPair(server_context, client_context)
+    pair.handshake()
+    wire = 0
+    start = time.perf_counter()
+    for _ in range(count):
+        wire += pair.transfer(message)
+    elapsed = time.perf_counter() - start
+    return elapsed / count * 1e6, wire / count - len(message), len(message)
+
+
+def connect_rate(port, context, resume, concurrency, duration):
+    """Connections per second that reach the username prompt."""
+    prompt = protocol.PROMPT.encode('utf-8')
+    counts = [0] * concurrency
+    failures = []
+    deadline = time.perf_counter() + duration
+
+    def worker(index):
+        session = None
+        while time.perf_counter() < deadline:
+            try:
+                sock = socket.create_connection(("127.0.0.1", port))
+                if context is not None:
+                    sock = context.wrap_socket(sock, server_hostname="127.0.0.1", session=session)
+                data = b""
+                while len(data) < len(prompt):
+                    chunk = sock.recv(len(prompt) - len(data))
+                    if not chunk:
+                        break
+                    data += chunk
+                if resume:
+                    # Tickets arrive after the handshake, so take them after reading
+                    session = tls.client_session(sock) or session
+                sock.close()
+                if data == prompt:
+                    counts[index] += 1
+            except OSError as e:
+                failures.append(e)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if failures:
+        print(f"  {len(failures)} connections failed, e.g. {failures[0]!r}")
+    return sum(counts) / elapsed
+
+
+def spawn(engine, port, extra):
+    command = [sys.executable, SERVER_SCRIPT, '--engine', engine, '--port', str(port),
+               '--quiet', '--max-clients', '10000', '--heartbeat', '0'] + extra
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    if not wait_for_port('127.0.0.1', port):
+        server.kill()
+        raise RuntimeError("Server did not start")
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='TLS cost benchmark')
+    parser.add_argument('--cert', default=None, help='PEM certificate (default: generate one)')
+    parser.add_argument('--key', default=None, help='PEM private key, if not in --cert')
+    parser.add_argument('--duration', type=float, default=2, help='Seconds per measurement')
+    parser.add_argument('--size', type=int, default=40, help='Message body size in characters')
+    parser.add_argument('--messages', type=int, default=100000, help='Messages for the per-message cost')
+    parser.add_argument('--spawn', choices=['thread', 'asyncio'],
+                        help='Also measure connections/s against servers with this engine')
+    parser.add_argument('--port', type=int, default=9888,
+                        help='Port of the spawned plaintext server; the TLS one gets the next')
+    parser.add_argument('--concurrency', type=int, default=4, help='Connecting threads')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        certfile, keyfile = (args.cert, args.key) if args.cert else make_certificate(directory)
+        server_context = tls.server_context(certfile, keyfile)
+        client_context = tls.client_context(certfile)
+
+        print(f"{ssl.OPENSSL_VERSION}, both ends in one process:")
+        rates = bench_handshakes(server_context, client_context, args.duration)
+        print(f"  full handshakes:    {rates['full']:,.0f}/s")
+        print(f"  resumed handshakes: {rates['resumed']:,.0f}/s")
+        micros, overhead, length = bench_messages(server_context, client_context, args.size, args.messages)
+        print(f"  {length}-byte message: {micros:.2f}us to encrypt and decrypt, "
+              f"+{overhead:.0f} bytes on the wire")
+
+        if args.spawn:
+            plain = spawn(args.spawn, args.port, [])
+            secure = spawn(args.spawn, args.port + 1, ['--tls-cert', certfile] +
+                           (['--tls-key', keyfile] if keyfile else []))
+            try:
+                print(f"Connections to the prompt per second ({args.spawn} engine, "
+                      f"{args.concurrency} connecting threads):")
+                for name, port, context, resume in (
+                        ("plaintext", args.port, None, False),
+                        ("TLS", args.port + 1, client_context, False),
+                        ("TLS resumed", args.port + 1, client_context, True)):
+                    rate = connect_rate(port, context, resume, args.concurrency, args.duration)
+                    print(f"  {name + ':':13} {rate:,.0f}/s")
+            finally:
+                for server in (plain, secure):
+                    server.terminate()
+                    server.wait()
+
+
+if __name__ == "__main__":
+    main()
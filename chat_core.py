@@ -0,0 +1,974 @@
+#!/usr/bin/env python3
+"""Chat state shared by the thread and asyncio server engines.
+
+Engines subclass Client and only deal with moving bytes between sockets
+and the client's outbound queue; login, commands, rooms and broadcasts
+live here so both engines behave identically.
+"""
+import contextlib
+import threading
+import time
+import zlib
+
+import console
+import history
+import metrics
+import outbound
+import protocol
+import ratelimit
+import rooms
+from rooms import DEFAULT_ROOM
+
+SCROLLBACK_LINES = 20  # messages replayed to someone entering a room
+HISTORY_PAGE_LINES = 50
+RESUME_LINES = 200  # missed messages replayed per room to a resumed session
+
+# Outbound queue settings, overridden from the command line
+queue_max_messages = outbound.DEFAULT_MAX_MESSAGES
+queue_max_bytes = outbound.DEFAULT_MAX_BYTES
+slow_consumer_policy = outbound.DROP_OLDEST
+allow_compression = True  # accept zlib when a client offers it
+drain_timeout = 5.0  # seconds clients get to receive what is queued when the server stops
+login_timeout = 10.0  # seconds a new connection gets to send its username; None waits forever
+keepalive_idle = 60  # seconds of silence before TCP keepalive probes start; None disables them
+announce_presence = True  # tell everyone when someone joins or leaves the chat
+
+# Connected clients and their usernames, plus the indexes used to route
+# messages without scanning every client. Changes are made under
+# clients_lock; message delivery reads immutable snapshots without it, so
+# joins and leaves never wait behind a broadcast in progress.
+clients_lock = threading.Lock()
+clients = {}  # client -> username
+users = {}    # username -> tuple of clients, for direct messages; replaced, never modified
+room_index = rooms.RoomIndex()
+everyone = None  # tuple of all clients, rebuilt on first use after a change
+watchers = set()  # clients that asked for presence events with /roster
+watcher_snapshot = None
+
+# Link to the other workers in pre-fork mode (a cluster.ClusterBus)
+bus = None
+
+# Room history; memory only unless the server is started with --history-dir
+history_store = history.HistoryStore()
+
+# Ids of usernames and rooms for compact-mode clients
+names = protocol.NameTable()
+
+# Limits on how fast clients may send (a ratelimit.RateLimiter), if any
+rate_limiter = None
+
+# Decides whether new connections are accepted (an admission.AdmissionControl)
+admission_control = None
+
+# Pings silent clients and evicts dead ones (a heartbeat.Heartbeat), if enabled
+heartbeat_monitor = None
+
+# Issues and checks session-resume tokens (a sessions.SessionTokens), if sessions are enabled
+session_tokens = None
+
+# Holds room broadcasts for a short window (a batching.RoomBatcher), if enabled
+batcher = None
+
+# (minute since the epoch, its "HH:MM"), replaced as one tuple so readers
+# on other threads never see a minute paired with another minute's text
+_clock = (None, "")
+
+
+def configure(max_messages=None, max_bytes=None, policy=None, compression=None, drain=None,
+              login=None, keepalive=None, announce=None):
+    """Change the outbound queue settings used for new clients."""
+    global queue_max_messages, queue_max_bytes, slow_consumer_policy, allow_compression, drain_timeout
+    global login_timeout, keepalive_idle, announce_presence
+    if max_messages is not None:
+        queue_max_messages = max_messages
+    if max_bytes is not None:
+        queue_max_bytes = max_bytes
+    if policy is not None:
+        slow_consumer_policy = policy
+    if compression is not None:
+        allow_compression = compression
+    if drain is not None:
+        drain_timeout = drain
+    if login is not None:
+        login_timeout = login or None
+    if keepalive is not None:
+        keepalive_idle = int(keepalive) or None
+    if announce is not None:
+        announce_presence = announce
+
+
+class Client:
+    """Engine-independent state of one connection.
+
+    Subclasses provide kick(), which must make the engine's reader see
+    end-of-stream so the normal logout path runs.
+
+    A server holds one of these for every connection, so they are slotted
+    (no per-instance __dict__) and subclasses must declare their own
+    attributes in __slots__ too. The rooms a client is in are kept in
+    room_index, which needs both directions anyway.
+    """
+    __slots__ = ('addr', 'username', 'room', 'framed', 'compact', 'known_names', 'compress_after',
+                 'compressor', 'session', 'heartbeat', 'last_seen', 'pinged_at', 'timed_out',
+                 'decoder', 'bucket', 'throttled', 'outbound')
+
+    def __init__(self, addr, wakeup=None):
+        self.addr = addr
+        self.username = None
+        self.room = DEFAULT_ROOM  # where plain messages go
+        self.framed = False
+        self.compact = False
+        self.known_names = None  # name ids already sent to this client in compact mode, once there are any
+        self.compress_after = None  # the acknowledgement; what is written after it is compressed
+        self.compressor = None
+        self.session = False  # gets SESSION lines and SEEN marks
+        self.heartbeat = False  # answers pings
+        self.last_seen = time.monotonic()  # when it last sent anything
+        self.pinged_at = None
+        self.timed_out = False
+        self.decoder = protocol.FrameDecoder()
+        self.bucket = rate_limiter.bucket() if rate_limiter else None
+        self.throttled = False  # the last message was dropped by a rate limit
+        self.outbound = outbound.OutboundQueue(queue_max_messages, queue_max_bytes,
+                                               slow_consumer_policy, wakeup, self.notice)
+
+    def wire(self, data):
+        """Encode a payload for this client's negotiated mode."""
+        if self.compact:
+            return protocol.encode_text(data)
+        return protocol.encode_frame(data) if self.framed else data
+
+    def outgoing(self, batch):
+        """Turn messages taken from the outbound queue into the buffers to write.
+
+        Only the client's writer calls this, so the interning and
+        compression state need no lock.
+        """
+        if self.compact:
+            batch = self._with_names(batch)
+        if self.session:
+            batch = self._with_seen(batch)
+        if self.compress_after is not None:
+            for i, data in enumerate(batch):
+                if data is self.compress_after:
+                    # The acknowledgement itself goes out uncompressed
+                    self.compress_after = None
+                    self.compressor = zlib.compressobj()
+                    return batch[:i + 1] + self._deflate(batch[i + 1:])
+            return batch
+        if self.compressor is not None:
+            return self._deflate(batch)
+        return batch
+
+    def _with_names(self, batch):
+        """Put NAME frames this client has not seen in front of the messages using them."""
+        known = self.known_names
+        if known is None:
+            known = self.known_names = set()
+        buffers = []
+        for data in batch:
+            for name_id, frame in getattr(data, 'names', ()):
+                if name_id not in known:
+                    known.add(name_id)
+                    buffers.append(frame)
+            buffers.append(data)
+        return buffers
+
+    def _with_seen(self, batch):
+        """Follow the batch with the id of the last chat line in it, if any."""
+        for data in reversed(batch):
+            message_id = getattr(data, 'message_id', None)
+            if message_id is not None:
+                return batch + [protocol.seen_frame(message_id, self.compact)]
+        return batch
+
+    def _deflate(self, batch):
+        if not batch:
+            return []
+        data = self.compressor.compress(b"".join(batch))
+        return [data + self.compressor.flush(zlib.Z_SYNC_FLUSH)]
+
+    def notice(self, skipped):
+        """Notice that replaces a coalesced backlog."""
+        return self.wire(outbound.coalesce_notice(skipped))
+
+    def parse(self, data):
+        """Split received bytes into messages."""
+        self.last_seen = time.monotonic()
+        metrics.bytes_in.inc(len(data))
+        if self.framed:
+            messages = [frame.decode('utf-8') for frame in self.decoder.feed(data)]
+        else:
+            # Raw mode: each chunk is one message
+            messages = [data.decode('utf-8')]
+        metrics.messages_in.inc(len(messages))
+        return messages
+
+    def kick(self):
+        raise NotImplementedError
+
+
+@contextlib.contextmanager
+def registry_lock():
+    """Hold clients_lock, recording how long it was held."""
+    with clients_lock:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            metrics.lock_hold_seconds.observe(time.perf_counter() - start)
+
+
+def register(client, username, rooms_in=(DEFAULT_ROOM,)):
+    """Add a client to the registry and its rooms, the default room unless told otherwise."""
+    global everyone
+    if batcher is not None:
+        # What the rooms hold is already in the scrollback a newcomer gets
+        for room in rooms_in:
+            batcher.flush_now(room)
+    with registry_lock():
+        clients[client] = username
+        users[username] = users.get(username, ()) + (client,)
+        for room in rooms_in:
+            room_index.join(client, room)
+        everyone = None
+
+
+def unregister(client):
+    """Remove a client from the registry and all its rooms.
+
+    Returns the rooms it was in, or None if it was not registered.
+    """
+    global everyone, watcher_snapshot
+    with registry_lock():
+        username = clients.pop(client, None)
+        if username is None:
+            return None
+        everyone = None
+        if client in watchers:
+            watchers.discard(client)
+            watcher_snapshot = None
+        sessions = tuple(c for c in users.get(username, ()) if c is not client)
+        if sessions:
+            users[username] = sessions
+        else:
+            users.pop(username, None)
+        return room_index.leave_all(client)
+
+
+def recipients(room=None):
+    """Immutable snapshot of a room's members, or of everyone if room is None.
+
+    Lock-free while the snapshot is current; only the first caller after
+    a join or leave takes clients_lock to rebuild it.
+    """
+    global everyone
+    snapshot = everyone if room is None else room_index.snapshot(room)
+    if snapshot is None:
+        with registry_lock():
+            if room is not None:
+                snapshot = room_index.rebuild_snapshot(room)
+            elif everyone is None:
+                snapshot = everyone = tuple(clients)
+            else:
+                snapshot = everyone
+    return snapshot
+
+
+def roster_watchers():
+    """Immutable snapshot of the clients that get presence events."""
+    global watcher_snapshot
+    snapshot = watcher_snapshot
+    if snapshot is None:
+        with registry_lock():
+            if watcher_snapshot is None:
+                watcher_snapshot = tuple(watchers)
+            snapshot = watcher_snapshot
+    return snapshot
+
+
+def client_count():
+    return len(clients)
+
+
+def cluster_client_count():
+    """Clients connected to this process plus those on other workers."""
+    count = client_count()
+    if bus:
+        count += bus.remote_count()
+    return count
+
+
+def send(client, message):
+    """Queue a message for a single client."""
+    if not client.outbound.put(client.wire(message.encode('utf-8'))):
+        client.kick()
+
+
+def fits_frame(text):
+    """Whether text can go out as one frame in every mode; compact TEXT frames add a type byte."""
+    # UTF-8 takes at most 4 bytes a character, so short text needs no encoding to tell
+    return len(text) * 4 < protocol.MAX_FRAME_SIZE or len(text.encode('utf-8')) < protocol.MAX_FRAME_SIZE
+
+
+def _queue_for(recipients, data, sender, compact=None, message_id=None):
+    """Queue data for each recipient; returns the ones that must be kicked.
+
+    compact is the message pre-encoded for compact-mode clients; without
+    it they get data as a TEXT frame. message_id is the history id of a
+    chat line; the framed encodings carry it for session clients.
+    """
+    framed = None
+    if message_id is not None:
+        framed = protocol.ChatFrame(protocol.encode_frame(data))
+        framed.message_id = message_id
+        if compact is None:
+            compact = protocol.ChatFrame(protocol.encode_text(data))
+        compact.message_id = message_id
+    slow = []
+    queued_count = 0
+    for client in recipients:
+        # Don't send the message back to the sender
+        if client is sender:
+            continue
+        if client.compact:
+            if compact is None:
+                compact = protocol.encode_text(data)
+            queued = client.outbound.put(compact)
+        elif client.framed:
+            if framed is None:
+                framed = protocol.encode_frame(data)
+            queued = client.outbound.put(framed)
+        else:
+            queued = client.outbound.put(data)
+        queued_count += 1
+        if not queued:
+            slow.append(client)
+    metrics.messages_out.inc(queued_count)
+    return slow
+
+
+def broadcast(message, sender=None, room=None, chat=None, message_id=None):
+    """Queue a message for everyone in a room (or everyone, if room is None) except the sender.
+
+    chat is (username, timestamp, body) when the message is a chat line,
+    so compact-mode clients can be sent a CHAT frame instead of the text,
+    and message_id is its id in this process's history.
+    """
+    data = message.encode('utf-8')
+    start = time.perf_counter()
+    compact = None
+    if chat is not None:
+        username, timestamp, body = chat
+        compact = names.encode_chat(username, None if room in (None, DEFAULT_ROOM) else room,
+                                    timestamp, body)
+    if batcher is not None:
+        if room is not None:
+            batcher.add(room, (data, sender, compact, message_id), len(data))
+            return
+        # Don't let a message to everyone overtake what rooms are holding
+        batcher.flush_all()
+    slow = _queue_for(recipients(room), data, sender, compact, message_id)
+    metrics.broadcast_seconds.observe(time.perf_counter() - start)
+
+    # Kick clients whose queue overflowed under the disconnect policy
+    for client in slow:
+        client.kick()
+
+
+def _encode_entry(mode, entry):
+    data, _, compact, _ = entry
+    if mode == "compact":
+        return compact if compact is not None else protocol.encode_text(data)
+    return protocol.encode_frame(data) if mode == "framed" else data
+
+
+def _join_entries(mode, parts, message_ids):
+    """One buffer holding a batch's encoded messages, with their NAME frames and last id."""
+    data = b"".join(parts)
+    if mode == "compact":
+        data = protocol.CompactFrame(data)
+        data.names = tuple(name for part in parts for name in getattr(part, 'names', ()))
+    elif message_ids:
+        data = protocol.ChatFrame(data)
+    if message_ids:
+        data.message_id = message_ids[-1]
+    return data
+
+
+def flush_room(room, entries):
+    """Queue a batch of a room's broadcasts for its members as one buffer each.
+
+    entries are (data, sender, compact, message_id) in the order they
+    were broadcast. Members who sent some of them get the batch without
+    those, so each distinct sender costs one more join, not one per message.
+    """
+    start = time.perf_counter()
+    senders = {entry[1] for entry in entries if entry[1] is not None}
+    encoded = {}  # mode -> every entry encoded for it
+    batches = {}  # (mode, sender left out) -> (buffer or None, messages in it)
+    slow = []
+    queued_count = 0
+    for client in recipients(room):
+        mode = "compact" if client.compact else "framed" if client.framed else "raw"
+        excluded = client if client in senders else None
+        batch = batches.get((mode, excluded))
+        if batch is None:
+            parts = encoded.get(mode)
+            if parts is None:
+                parts = encoded[mode] = [_encode_entry(mode, entry) for entry in entries]
+            kept = [i for i, entry in enumerate(entries) if excluded is None or entry[1] is not excluded]
+            data = None
+            if kept:
+                data = _join_entries(mode, [parts[i] for i in kept],
+                                     [entries[i][3] for i in kept if entries[i][3] is not None])
+            batch = batches[(mode, excluded)] = (data, len(kept))
+        data, count = batch
+        if data is None:
+            continue
+        if not client.outbound.put(data):
+            slow.append(client)
+        queued_count += count
+    metrics.messages_out.inc(queued_count)
+    metrics.batch_messages.observe(len(entries))
+    metrics.broadcast_seconds.observe(time.perf_counter() - start)
+
+    for client in slow:
+        client.kick()
+
+
+def flush_broadcasts():
+    """Queue whatever the batching window is holding, before the server stops or hands over."""
+    if batcher is not None:
+        batcher.flush_all()
+
+
+def send_to_user(username, message):
+    """Queue a message for every session of a user; returns how many got it."""
+    data = message.encode('utf-8')
+    sessions = users.get(username, ())
+    slow = _queue_for(sessions, data, None)
+    for client in slow:
+        client.kick()
+    return len(sessions)
+
+
+def announce_left(username):
+    """Tell this process's clients that a user elsewhere has left, unless announcements are off."""
+    if announce_presence:
+        broadcast(f"SERVER: {username} has left the chat.\n")
+
+
+def is_online(username):
+    """Whether a user has a session on this worker or any other."""
+    return username in users or bool(bus and bus.has_user(username))
+
+
+def presence_changed(username, was_online):
+    """Tell roster watchers if a user just came online or went offline."""
+    online = is_online(username)
+    if online == was_online:
+        return
+    data = protocol.presence_message(username, online).encode('utf-8')
+    for client in _queue_for(roster_watchers(), data, None):
+        client.kick()
+
+
+def publish(message, sender=None, room=None, chat=None, message_id=None):
+    """Broadcast a message originating here to the whole cluster.
+
+    Other workers give chat lines ids in their own history.
+    """
+    broadcast(message, sender, room, chat, message_id)
+    if bus:
+        bus.publish_message(message, room, chat)
+
+
+def send_lines(client, entries):
+    """Send history entries (id, text) in as few messages as fit a frame each."""
+    chunk = []
+    size = 0
+    for _, text in entries:
+        if not fits_frame(text):
+            # Kept from before lines were checked; it could never be delivered
+            continue
+        length = len(text.encode('utf-8'))
+        if size + length >= protocol.MAX_FRAME_SIZE:
+            send(client, "".join(chunk))
+            chunk = []
+            size = 0
+        chunk.append(text)
+        size += length
+    if chunk:
+        send(client, "".join(chunk))
+
+
+def send_history(client, room, entries, footer=True):
+    """Replay history entries (id, text) to a client."""
+    if not entries:
+        send(client, f"SERVER: No earlier messages in #{room}.\n")
+        return
+    send_lines(client, entries)
+    if footer:
+        send(client, f"SERVER: Type /history {entries[0][0]} for messages before these.\n")
+
+
+def send_scrollback(client, room):
+    """Show someone entering a room what was said recently, from memory."""
+    entries = history_store.recent(room, SCROLLBACK_LINES)
+    if entries:
+        send(client, f"SERVER: Recent messages in #{room}:\n")
+        send_history(client, room, entries)
+
+
+def clock_text(timestamp):
+    """The "HH:MM" of a Unix time; strftime only runs when the minute changes."""
+    global _clock
+    minute = int(timestamp // 60)
+    cached_minute, text = _clock
+    if minute != cached_minute:
+        # Time zone offsets are whole minutes, so local minutes start with UTC ones
+        text = time.strftime("%H:%M", time.localtime(timestamp))
+        _clock = (minute, text)
+    return text
+
+
+def format_message(username, message, room, timestamp=None):
+    """Format a chat line; the default room keeps the original format."""
+    if timestamp is None:
+        timestamp = time.time()
+    return protocol.format_chat(clock_text(timestamp), username, message,
+                                None if room == DEFAULT_ROOM else room)
+
+
+def session_token(client):
+    """A token that resumes a client's session in its current rooms."""
+    with registry_lock():
+        rooms_in = room_index.rooms_of(client)
+    return session_tokens.issue(client.username, client.room, rooms_in, history_store.origin)
+
+
+def refresh_session(client):
+    """Send a session client a new token after its rooms changed."""
+    if client.session:
+        send(client, protocol.session_token(session_token(client)))
+
+
+def start_session(client, resumed, last_seen):
+    """Send a session client its token and, if it is resuming, what it missed."""
+    # Chat lines from here on reach it live; a line racing with register()
+    # may arrive both ways, but none is lost
+    last_id = history_store.next_id - 1
+    send(client, protocol.session_start(session_token(client), last_id))
+    if resumed is None:
+        return
+    if resumed["origin"] != history_store.origin:
+        send(client, "SERVER: The server was restarted; messages sent while you were away are lost.\n")
+        return
+    for room in resumed["rooms"]:
+        entries, complete = history_store.since(room, last_seen, RESUME_LINES)
+        entries = [entry for entry in entries if entry[0] <= last_id]
+        if entries:
+            send(client, f"SERVER: Missed messages in #{room}:\n")
+            send_history(client, room, entries, footer=not complete)
+
+
+def login(client, data):
+    """Complete the handshake from the client's first message.
+
+    Negotiates framing, registers the client and announces it. A client
+    resuming a session goes back to its rooms and is sent the messages
+    it missed instead of the welcome and scrollback.
+    """
+    username, wants_framing, extras = protocol.parse_login(data)
+    username, token, last_seen = protocol.split_resume(username)
+    if not username:
+        username = f"User-{client.addr[0]}"
+    client.username = username
+
+    if wants_framing:
+        if not allow_compression:
+            extras.discard("zlib")
+        if session_tokens is None:
+            extras.discard("session")
+        if heartbeat_monitor is None:
+            extras.discard("heartbeat")
+        # The acknowledgement itself is still raw
+        ack = protocol.framing_ack(extras)
+        client.compact = "compact" in extras
+        client.session = "session" in extras
+        client.heartbeat = "heartbeat" in extras
+        if "zlib" in extras:
+            client.compress_after = ack
+        client.outbound.put(ack)
+        client.framed = True
+
+    resumed = None
+    rooms_in = [DEFAULT_ROOM]
+    if token and client.session:
+        resumed = session_tokens.verify(token, username)
+    if resumed is not None:
+        rooms_in = [room for room in resumed["rooms"] if rooms.valid_room_name(room)] or rooms_in
+        resumed["rooms"] = rooms_in
+        client.room = resumed["room"] if resumed["room"] in rooms_in else rooms_in[0]
+
+    # Register the client
+    was_online = is_online(username)
+    register(client, username, rooms_in)
+    if bus:
+        # Peers count a new user in the default room
+        bus.publish_join(username)
+        for room in rooms_in:
+            if room != DEFAULT_ROOM:
+                bus.publish_room_join(room)
+        if DEFAULT_ROOM not in rooms_in:
+            bus.publish_room_leave(DEFAULT_ROOM)
+    presence_changed(username, was_online)
+    if client.heartbeat:
+        heartbeat_monitor.watch(client)
+
+    # Welcome message
+    if resumed is None:
+        send(client, f"Welcome {username}! You are now connected to the chat server.\n")
+        if token and client.session:
+            send(client, "SERVER: Your session could not be resumed; messages sent while you were away are not shown.\n")
+        send_scrollback(client, DEFAULT_ROOM)
+    else:
+        send(client, f"Welcome back {username}! You are now connected to the chat server again.\n")
+    if client.session:
+        start_session(client, resumed, last_seen)
+
+    # Notify others
+    if announce_presence:
+        publish(f"SERVER: {username} has joined the chat.\n", client)
+    console.log(f"{username} has joined the chat")
+
+
+def cmd_help(client, args):
+    send(client, "SERVER: Commands: /join <room>, /leave [room], /rooms, "
+                 "/msg <user> <message>, /history [before id], /search <words>, /roster, /exit\n")
+
+
+def cmd_join(client, args):
+    """/join <room>: join a room and make it the current one."""
+    room = args.lstrip('#')
+    if not rooms.valid_room_name(room):
+        send(client, "SERVER: Usage: /join <room> (letters, digits, - and _)\n")
+        return
+
+    if batcher is not None:
+        # What the room holds is already in the scrollback we send
+        batcher.flush_now(room)
+    with registry_lock():
+        joined = room_index.join(client, room)
+    client.room = room
+    if joined:
+        if bus:
+            bus.publish_room_join(room)
+        publish(f"SERVER: {client.username} joined #{room}.\n", client, room)
+    send(client, f"SERVER: You are now talking in #{room}.\n")
+    if joined:
+        send_scrollback(client, room)
+    refresh_session(client)
+
+
+def cmd_leave(client, args):
+    """/leave [room]: leave a room, the current one by default."""
+    room = args.lstrip('#') or client.room
+    with registry_lock():
+        left = room_index.leave(client, room)
+        remaining = sorted(room_index.rooms_of(client))
+        if left and not remaining:
+            # Everyone is always in at least one room
+            room_index.join(client, DEFAULT_ROOM)
+            remaining = [DEFAULT_ROOM]
+            rejoined = True
+        else:
+            rejoined = False
+    if not left:
+        send(client, f"SERVER: You are not in #{room}.\n")
+        return
+
+    if bus:
+        bus.publish_room_leave(room)
+        if rejoined:
+            bus.publish_room_join(DEFAULT_ROOM)
+    publish(f"SERVER: {client.username} left #{room}.\n", client, room)
+    if client.room == room:
+        client.room = DEFAULT_ROOM if DEFAULT_ROOM in remaining else remaining[0]
+    send(client, f"SERVER: You left #{room}. You are now talking in #{client.room}.\n")
+    refresh_session(client)
+
+
+def cmd_rooms(client, args):
+    """/rooms: list rooms and how many people are in each."""
+    with registry_lock():
+        counts = room_index.counts()
+        mine = set(room_index.rooms_of(client))
+    if bus:
+        for room, count in bus.remote_room_counts().items():
+            counts[room] = counts.get(room, 0) + count
+
+    listing = []
+    for room in sorted(counts):
+        marker = "*" if room == client.room else ("+" if room in mine else "")
+        listing.append(f"{marker}#{room} ({counts[room]})")
+    send(client, "SERVER: Rooms: " + ", ".join(listing) + "\n")
+
+
+def cmd_msg(client, args):
+    """/msg <user> <message>: send a private message."""
+    username, _, text = args.partition(" ")
+    text = text.strip()
+    if not username or not text:
+        send(client, "SERVER: Usage: /msg <user> <message>\n")
+        return
+
+    message = f"[{clock_text(time.time())}] {client.username} -> {username}: {text}\n"
+    if not fits_frame(message):
+        send(client, "SERVER: Message too long; it was not sent.\n")
+        return
+    delivered = send_to_user(username, message)
+    if bus and bus.has_user(username):
+        bus.publish_direct(username, message)
+        delivered += 1
+    if not delivered:
+        send(client, f"SERVER: No user named {username} is online.\n")
+
+
+def cmd_history(client, args):
+    """/history [before id]: page back through the current room."""
+    if args:
+        try:
+            before_id = int(args)
+        except ValueError:
+            send(client, "SERVER: Usage: /history [message id]\n")
+            return
+    else:
+        before_id = history_store.next_id
+
+    room = client.room
+    # May complete later on the history reader thread
+    history_store.page(room, before_id, HISTORY_PAGE_LINES,
+                       lambda entries: send_history(client, room, entries))
+
+
+def cmd_search(client, args):
+    """/search <words>: find the latest messages in the current room containing all the words."""
+    index = history_store.index
+    if index is None:
+        send(client, "SERVER: Search is not enabled on this server.\n")
+        return
+    if not args:
+        send(client, "SERVER: Usage: /search <words>\n")
+        return
+
+    room = client.room
+    ids = index.search(room, args)
+    if not ids:
+        send(client, f"SERVER: No messages in #{room} match \"{args}\".\n")
+        return
+
+    def found(entries):
+        send(client, f"SERVER: Messages in #{room} matching \"{args}\":\n")
+        send_lines(client, entries)
+        if not index.backfilled:
+            send(client, "SERVER: Older messages are still being indexed; try again later for more.\n")
+
+    # May complete later on the history reader thread
+    history_store.fetch(room, ids, found)
+
+
+def cmd_pong(client, args):
+    """/pong: answer to a heartbeat ping; receiving it was all that mattered."""
+
+
+def cmd_roster(client, args):
+    """/roster: send the online users now and presence changes from then on."""
+    global watcher_snapshot
+    with registry_lock():
+        if client not in clients:
+            return
+        watchers.add(client)
+        watcher_snapshot = None
+        online = set(users)
+    if bus:
+        online.update(bus.remote_usernames())
+    for message in protocol.roster_messages(online):
+        send(client, message)
+
+
+COMMANDS = {
+    "/help": cmd_help,
+    "/join": cmd_join,
+    "/leave": cmd_leave,
+    "/rooms": cmd_rooms,
+    "/msg": cmd_msg,
+    "/history": cmd_history,
+    "/search": cmd_search,
+    "/roster": cmd_roster,
+    protocol.PONG: cmd_pong,
+}
+
+
+def admit(client, message):
+    """Apply the rate limits to a received message before handle_message().
+
+    Returns the seconds the engine must wait, without reading from the
+    client, before handling it (0 to handle it now), or None if the
+    message must be discarded. Kicks the client under the disconnect
+    policy.
+    """
+    if rate_limiter is None:
+        return 0
+    if client.outbound.closed:
+        # Already kicked; the rest of what it sent is discarded
+        return None
+    # Commands only count against the connection; chat lines also against the room
+    room = None if message.lstrip().startswith("/") else client.room
+    limit, wait = rate_limiter.check(client.bucket, room)
+    if not wait:
+        client.throttled = False
+        return 0
+    if message.strip() == "/exit":
+        return 0
+
+    policy = rate_limiter.policy
+    ratelimit.count_throttled(limit, policy)
+    if policy == ratelimit.DELAY:
+        return wait
+    if policy == ratelimit.DISCONNECT:
+        console.log(f"Disconnecting {client.username} for exceeding the {limit} rate limit")
+        client.kick()
+    elif not client.throttled:
+        # One notice per burst of dropped messages, not one per message
+        client.throttled = True
+        send(client, "SERVER: You are sending too fast; messages are being dropped.\n")
+    return None
+
+
+def handle_message(client, message):
+    """Process one message from a logged-in client; returns False on /exit."""
+    message = message.strip()
+    if message == "/exit":
+        return False
+
+    if message.startswith("/"):
+        command, _, args = message.partition(" ")
+        handler = COMMANDS.get(command)
+        if handler:
+            handler(client, args.strip())
+            return True
+
+    # Send to everyone in the client's current room
+    timestamp = time.time()
+    formatted_message = format_message(client.username, message, client.room, timestamp)
+    if not fits_frame(formatted_message):
+        # A frame the client could send may not fit once the time and name are added
+        send(client, "SERVER: Message too long; it was not sent.\n")
+        return True
+    message_id = history_store.append(client.room, formatted_message)
+    publish(formatted_message, client, client.room, (client.username, timestamp, message), message_id)
+    console.log_message(formatted_message[:-1])
+    return True
+
+
+def logout(client):
+    """Remove a client and tell everyone it left."""
+    left_rooms = unregister(client)
+    if left_rooms is not None:
+        if bus:
+            bus.publish_leave(client.username, left_rooms)
+        presence_changed(client.username, True)
+        reason = " (connection timed out)" if client.timed_out else ""
+        if announce_presence:
+            publish(f"SERVER: {client.username} has left the chat{reason}.\n")
+        console.log(f"{client.username} has left the chat{reason}")
+
+
+def ping(client):
+    """Check on a client that has been silent for a while."""
+    send(client, protocol.HEARTBEAT_PING)
+
+
+def time_out(client):
+    """Disconnect a client that did not answer a ping; logout then announces it."""
+    metrics.heartbeat_timeouts.inc()
+    client.timed_out = True
+    client.kick()
+
+
+def client_state(client):
+    """A client's chat state as a JSON-able record, for a hot restart."""
+    with registry_lock():
+        rooms_in = sorted(room_index.rooms_of(client))
+        watching = client in watchers
+    return {
+        "addr": list(client.addr),
+        "username": client.username,
+        "room": client.room,
+        "rooms": rooms_in,
+        "framed": client.framed,
+        "compact": client.compact,
+        "session": client.session,
+        "heartbeat": client.heartbeat,
+        "known_names": sorted(client.known_names or ()),
+        "watcher": watching,
+        # Part of a frame that has been read but not handled yet
+        "pending": client.decoder.buffer.decode('latin-1'),
+    }
+
+
+def adopt(client, state):
+    """Register a client handed over by the previous process, without announcing it."""
+    global everyone, watcher_snapshot
+    client.username = state["username"]
+    client.room = state["room"]
+    client.framed = state["framed"]
+    client.compact = state["compact"]
+    client.session = state.get("session", False)
+    client.heartbeat = state.get("heartbeat", False) and heartbeat_monitor is not None
+    client.known_names = set(state["known_names"])
+    client.decoder.buffer += state["pending"].encode('latin-1')
+    with registry_lock():
+        clients[client] = client.username
+        users[client.username] = users.get(client.username, ()) + (client,)
+        for room in state["rooms"]:
+            room_index.join(client, room)
+        everyone = None
+        if state["watcher"]:
+            watchers.add(client)
+            watcher_snapshot = None
+    if client.heartbeat:
+        heartbeat_monitor.watch(client)
+
+
+def print_policy_stats():
+    """Print how often each slow-consumer policy fired."""
+    stats = outbound.policy_stats()
+    if any(stats.values()):
+        print("Slow consumers: " + ", ".join(f"{k}={v}" for k, v in stats.items()))
+
+
+def _backlogs():
+    return [client.outbound for client in recipients()]
+
+
+def outbound_backlog_bytes():
+    """Bytes queued for all local clients."""
+    return sum(queue.pending_bytes for queue in _backlogs())
+
+
+metrics.Gauge("chat_clients", "Clients logged in to this process", client_count)
+metrics.Gauge("chat_cluster_clients", "Clients logged in across all workers", cluster_client_count)
+metrics.Gauge("chat_rooms", "Rooms with at least one local member",
+              lambda: len(room_index.members))
+metrics.Gauge("chat_outbound_backlog_bytes", "Bytes queued for all local clients",
+              outbound_backlog_bytes)
+metrics.SnapshotHistogram("chat_client_backlog_messages", "Messages queued per client",
+                          metrics.BACKLOG_BUCKETS, lambda: [len(queue) for queue in _backlogs()])
+metrics.Gauge("chat_throttled_messages", "Received messages throttled by each rate limit and policy",
+              lambda: {f'limit="{limit}",action="{policy}"': count
+                       for (limit, policy), count in ratelimit.throttle_stats().items()})
+metrics.Gauge("chat_slow_consumer_events", "Times each slow-consumer policy fired",
+              lambda: {f'policy="{policy}"': count for policy, count in outbound.policy_stats().items()})
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""Pre-fork mode: several worker processes sharing one port.
+
+Every worker opens its own listening socket with SO_REUSEPORT, so the
+kernel spreads new connections across them. Workers are linked by a full
+mesh of Unix socket pairs (the cluster bus) created before forking. Each
+worker forwards the messages, joins and leaves of its own clients to its
+peers once, and peers fan them out to their local clients, so everyone
+sees the same chat no matter which worker they landed on.
+"""
+import collections
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+
+import chat_core
+import outbound
+import protocol
+
+# The bus must not lose joins or leaves, so its queues are only bounded
+# to protect against a wedged peer
+BUS_QUEUE_MESSAGES = 1 << 20
+BUS_QUEUE_BYTES = 256 * 1024 * 1024
+BUS_RECV_SIZE = 256 * 1024
+
+
+class ClusterBus:
+    """Links one worker to every other worker in the cluster."""
+
+    def __init__(self, worker_id, peers):
+        self.worker_id = worker_id
+        self.peers = peers  # worker id -> socket
+        self.queues = {peer: outbound.OutboundQueue(BUS_QUEUE_MESSAGES, BUS_QUEUE_BYTES)
+                       for peer in peers}
+        self.remote_lock = threading.Lock()
+        self.remote_users = {peer: collections.Counter() for peer in peers}
+        self.remote_rooms = {peer: collections.Counter() for peer in peers}
+        self.dispatch = None
+
+    def start(self, dispatch=None):
+        """Start reader and writer threads for every peer.
+
+        dispatch(func, *args) runs bus events in the engine's context; the
+        asyncio engine passes loop.call_soon_threadsafe, the thread engine
+        runs them directly on the reader thread.
+        """
+        self.dispatch = dispatch or (lambda func, *args: func(*args))
+        for peer, sock in self.peers.items():
+            for target in (self.read_loop, self.write_loop):
+                thread = threading.Thread(target=target, args=(peer, sock))
+                thread.daemon = True
+                thread.start()
+
+    def stop(self):
+        """Stop handing bus events to the engine, which is shutting down.
+
+        Its peers are usually stopping too, and their links closing is no
+        news for clients being said goodbye to.
+        """
+        self.dispatch = lambda func, *args: None
+
+    def publish(self, event):
+        """Send an event to every peer; it is encoded once for all of them."""
+        payload = json.dumps(event).encode('utf-8')
+        data = protocol.HEADER.pack(len(payload)) + payload
+        for queue in self.queues.values():
+            queue.put(data)
+
+    def publish_message(self, message, room=None, chat=None):
+        self.publish({"type": "message", "text": message, "room": room, "chat": chat})
+
+    def publish_direct(self, username, message):
+        self.publish({"type": "direct", "user": username, "text": message})
+
+    def publish_join(self, username):
+        """A client logged in here; it starts out in the default room."""
+        self.publish({"type": "join", "user": username})
+
+    def publish_leave(self, username, rooms):
+        self.publish({"type": "leave", "user": username, "rooms": sorted(rooms)})
+
+    def publish_room_join(self, room):
+        self.publish({"type": "room_join", "room": room})
+
+    def publish_room_leave(self, room):
+        self.publish({"type": "room_leave", "room": room})
+
+    def remote_count(self):
+        """Number of clients connected to other workers."""
+        with self.remote_lock:
+            return sum(sum(users.values()) for users in self.remote_users.values())
+
+    def remote_usernames(self):
+        with self.remote_lock:
+            return [user for users in self.remote_users.values() for user in users.elements()]
+
+    def has_user(self, username):
+        """Whether a user is connected to another worker."""
+        with self.remote_lock:
+            return any(users[username] > 0 for users in self.remote_users.values())
+
+    def remote_room_counts(self):
+        """Members of each room on other workers."""
+        total = collections.Counter()
+        with self.remote_lock:
+            for counts in self.remote_rooms.values():
+                total.update(counts)
+        return dict(total)
+
+    def write_loop(self, peer, sock):
+        queue = self.queues[peer]
+        while True:
+            batch = queue.wait()
+            if batch is None:
+                break
+            try:
+                outbound.send_vectored(sock, batch)
+            except OSError:
+                break
+
+    def read_loop(self, peer, sock):
+        decoder = protocol.FrameDecoder(max_frame_size=BUS_RECV_SIZE)
+        while True:
+            try:
+                data = sock.recv(BUS_RECV_SIZE)
+            except OSError:
+                data = b""
+            if not data:
+                break
+            events = [json.loads(frame) for frame in decoder.feed(data)]
+            self.dispatch(self.apply, peer, events)
+        self.queues[peer].close()
+        self.dispatch(self.peer_lost, peer)
+
+    def apply(self, peer, events):
+        """Apply events received from a peer to this worker."""
+        for event in events:
+            kind = event["type"]
+            if kind == "message":
+                message_id = None
+                # Only chat lines are history; join and leave notices are not
+                if event["room"] is not None and event.get("chat") is not None:
+                    message_id = chat_core.history_store.append(event["room"], event["text"])
+                chat_core.broadcast(event["text"], room=event["room"], chat=event.get("chat"),
+                                    message_id=message_id)
+            elif kind == "direct":
+                chat_core.send_to_user(event["user"], event["text"])
+            else:
+                username = event.get("user")
+                was_online = username is not None and chat_core.is_online(username)
+                with self.remote_lock:
+                    self.apply_presence(peer, kind, event)
+                if username is not None:
+                    chat_core.presence_changed(username, was_online)
+
+    def apply_presence(self, peer, kind, event):
+        """Track who is connected to a peer and which rooms they are in."""
+        users = self.remote_users[peer]
+        room_counts = self.remote_rooms[peer]
+        if kind == "join":
+            users[event["user"]] += 1
+            room_counts[chat_core.DEFAULT_ROOM] += 1
+        elif kind == "leave":
+            decrement(users, event["user"])
+            for room in event["rooms"]:
+                decrement(room_counts, room)
+        elif kind == "room_join":
+            room_counts[event["room"]] += 1
+        elif kind == "room_leave":
+            decrement(room_counts, event["room"])
+
+    def peer_lost(self, peer):
+        """A worker died: everyone connected to it has left the chat."""
+        with self.remote_lock:
+            users = list(self.remote_users.pop(peer, collections.Counter()).elements())
+            self.remote_rooms.pop(peer, None)
+        print(f"Worker {peer} is gone; dropping its {len(users)} users")
+        for username in users:
+            chat_core.announce_left(username)
+        for username in set(users):
+            chat_core.presence_changed(username, True)
+
+
+def decrement(counter, key):
+    """Decrement a Counter entry, dropping it when it reaches zero."""
+    counter[key] -= 1
+    if counter[key] <= 0:
+        del counter[key]
+
+
+def start_cluster(start_engine, workers):
+    """Fork workers that each run start_engine(worker_id, reuse_port=True)."""
+    if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(os, 'fork'):
+        print("Pre-fork mode needs fork() and SO_REUSEPORT, which this platform lacks")
+        return
+
+    # One socket pair for every pair of workers
+    links = {}
+    for i in range(workers):
+        for j in range(i + 1, workers):
+            links[(i, j)] = socket.socketpair()
+
+    pids = []
+    for worker_id in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            peers = {}
+            for (i, j), (a, b) in links.items():
+                if i == worker_id:
+                    peers[j] = a
+                    b.close()
+                elif j == worker_id:
+                    peers[i] = b
+                    a.close()
+                else:
+                    a.close()
+                    b.close()
+            chat_core.bus = ClusterBus(worker_id, peers)
+            try:
+                start_engine(worker_id, reuse_port=True)
+            finally:
+                sys.stdout.flush()
+                os._exit(0)
+        pids.append(pid)
+
+    for a, b in links.values():
+        a.close()
+        b.close()
+    print(f"Started {workers} workers: {', '.join(map(str, pids))}")
+
+    # Wait for the workers; Ctrl+C reaches them through the process group,
+    # but forward it in case only we were signalled
+    remaining = set(pids)
+    while remaining:
+        try:
+            pid, _ = os.wait()
+            remaining.discard(pid)
+        except KeyboardInterrupt:
+            for pid in remaining:
+                try:
+                    os.kill(pid, signal.SIGINT)
+                except OSError:
+                    pass
+        except ChildProcessError:
+            break
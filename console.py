@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""Console logging that stays off the hot path.
+
+log() only appends to a queue; a background thread prints whatever has
+piled up in one write. Per-message lines can be switched off entirely
+with log_messages = False.
+"""
+import queue
+import sys
+import threading
+
+log_messages = True  # print every chat message, not just connections and errors
+
+_queue = queue.Queue()
+_thread = None
+_lock = threading.Lock()
+
+
+def _printer():
+    while True:
+        lines = [_queue.get()]
+        while True:
+            try:
+                lines.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        sys.stdout.write("".join(line + "\n" for line in lines))
+        sys.stdout.flush()
+        for _ in lines:
+            _queue.task_done()
+
+
+def log(line):
+    """Print a line from a background thread."""
+    global _thread
+    if _thread is None:
+        with _lock:
+            if _thread is None:
+                _thread = threading.Thread(target=_printer)
+                _thread.daemon = True
+                _thread.start()
+    _queue.put(line)
+
+
+def log_message(line):
+    """Log a chat message, if per-message logging is on."""
+    if log_messages:
+        log(line)
+
+
+def flush():
+    """Wait until everything logged so far has been printed."""
+    if _thread is not None:
+        _queue.join()
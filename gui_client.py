@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 import socket
 import threading
+import bisect
+import collections
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox, simpledialog
 import argparse
@@ -12,10 +14,24 @@ import re
 import json
 import random
 
+import backoff
+import heartbeat
+import protocol
+import tls
+
 # Client configuration
 DEFAULT_HOST = '127.0.0.1'
 DEFAULT_PORT = 8888
 BUFFER_SIZE = 2048
+FRAME_MS = 16             # how often queued messages are rendered (~60 fps)
+MAX_BATCHES_PER_FRAME = 500  # received chunks rendered per frame, so a flood can't freeze the UI
+SCROLLBACK_LINES = 2000   # lines kept in the chat widget; older ones move to the archive
+TRIM_LINES = 200          # trim in chunks of this many lines rather than one at a time
+ARCHIVE_LINES = 100000    # trimmed lines kept in memory for scrolling back
+ARCHIVE_PAGE = 200        # lines brought back into the widget when scrolling past the top
+
+# "[12:00] alice:", "[12:00] #room alice:" or "[12:00] alice -> bob:"
+CHAT_LINE = re.compile(r"^(\[\d+:\d+\] (?:#[\w-]+ )?(\w+)(?: -> \w+)?:)(.*)$", re.DOTALL)
 
 # Color constants
 DARK_BG = "#1e1e2e"          # Main background
@@ -43,17 +59,39 @@ USERNAME_COLORS = [
 ]
 
 class ImprovedChatClient:
-    def __init__(self, root, server_ip="127.0.0.1", server_port=8888):
+    def __init__(self, root, server_ip="127.0.0.1", server_port=8888, use_framing=True,
+                 scrollback=SCROLLBACK_LINES, compact=True, compress=False, tls_context=None):
         self.root = root
         self.server_ip = server_ip
         self.server_port = server_port
+        self.use_framing = use_framing
+        self.compact = compact
+        self.compress = compress
+        self.scrollback = scrollback
+        self.tls_context = tls_context
+        self.tls_session = None  # resumed on reconnect, skipping most of the handshake
+        # Each line is a flat tuple (text, tag, text, tag, ...) ready for Text.insert()
+        self.shown = collections.deque()  # lines in the chat widget, oldest first
+        self.archive = collections.deque(maxlen=ARCHIVE_LINES)  # lines trimmed from the widget
+        self.partial_line = []
+        self.loading_older = False
         self.socket = None
+        # Survives reconnects, so a new connection can resume where the old one stopped
+        self.session = protocol.Session() if use_framing else None
+        self.reader = protocol.MessageReader(self.session)
+        self.backoff = backoff.Backoff()
         self.running = False
         self.username = None
+        self.logged_in = False  # sent our username on the current connection
         self.is_windows = platform.system() == "Windows"
-        self.message_queue = queue.Queue()
+        self.message_queue = queue.Queue()  # lists of (text, tag) spans, ready to insert
         self.username_colors = {}
-        self.last_seen_usernames = set()
+        self.roster = {}  # online usernames, updated from presence events on the UI thread
+        self.listed = []  # the usernames in the listbox, sorted like it
+        self.roster_changes = {}  # username -> online, not yet applied to the listbox
+        self.roster_reset = False  # a full roster arrived; rebuild the listbox
+        self.presence_queue = queue.Queue()  # (kind, usernames) from the receive thread
+        self.roster_requested = False
         
         # Setup UI
         self.setup_gui()
@@ -161,7 +199,7 @@ class ImprovedChatClient:
                                                     font=("Consolas", 11),
                                                     padx=10, pady=10)
         self.chat_display.grid(row=0, column=0, sticky="nsew", pady=(0, 10))
-        self.chat_display.config(state=tk.DISABLED)
+        self.chat_display.config(state=tk.DISABLED, yscrollcommand=self.on_chat_scroll)
         
         # Configure tags for different message types
         self.chat_display.tag_configure("server", foreground=SERVER_MSG_COLOR)
@@ -201,16 +239,24 @@ class ImprovedChatClient:
         self.status_bar.grid(row=1, column=0, sticky="ew")
         
         # Welcome message
-        self.chat_display.config(state=tk.NORMAL)
-        self.chat_display.insert(tk.END, "Welcome to the Chat Application!\n", "server")
-        self.chat_display.insert(tk.END, "Connecting to server...\n", "server")
-        self.chat_display.config(state=tk.DISABLED)
+        self.render([("Welcome to the Chat Application!\n", "server"),
+                     ("Connecting to server...\n", "server")])
     
     def connect_to_server(self):
         """Connect to the chat server."""
+        if self.socket is not None:
+            self.tls_session = tls.client_session(self.socket) or self.tls_session
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.connect((self.server_ip, self.server_port))
+            heartbeat.set_keepalive(self.socket)
+            if self.tls_context is not None:
+                self.socket = self.tls_context.wrap_socket(self.socket, server_hostname=self.server_ip,
+                                                           session=self.tls_session)
+                # The receiving thread and the UI thread share it
+                self.socket = tls.SerializedSocket(self.socket)
+            self.reader = protocol.MessageReader(self.session)
+            self.logged_in = False
             
             # Update status
             self.running = True
@@ -224,8 +270,13 @@ class ImprovedChatClient:
             self.display_system_message(f"Connected to server at {self.server_ip}:{self.server_port}")
         except Exception as e:
             self.display_error(f"Could not connect to the server: {str(e)}")
-            # Schedule reconnect after 5 seconds
-            self.root.after(5000, self.reconnect)
+            self.schedule_reconnect()
+    
+    def schedule_reconnect(self):
+        """Reconnect after a growing, randomized delay, so a restarted server isn't mobbed."""
+        delay = self.backoff.next_delay()
+        self.display_system_message(f"Reconnecting in {delay:.1f} seconds...")
+        self.root.after(int(delay * 1000), self.reconnect)
     
     def reconnect(self):
         """Attempt to reconnect to the server."""
@@ -239,102 +290,223 @@ class ImprovedChatClient:
             try:
                 data = self.socket.recv(BUFFER_SIZE)
                 if not data:
-                    self.message_queue.put(("system", "Disconnected from server"))
+                    self.display_system_message("Disconnected from server")
                     self.running = False
-                    # Schedule reconnect after 5 seconds
-                    self.root.after(5000, self.reconnect)
+                    self.root.after(0, self.schedule_reconnect)
                     break
                 
-                message = data.decode('utf-8')
+                spans = []
+                for message in self.reader.feed(data):
+                    # Handle username prompt
+                    if message.startswith(protocol.PROMPT.strip()):
+                        if not self.username:
+                            self.root.after(0, self.prompt_username)
+                        else:
+                            # Reconnected: log back in without asking, resuming the session if we have one
+                            self.root.after(0, self.login)
+                    else:
+                        # Parse here so the main thread only has to insert
+                        spans.extend(self.parse_message(message))
+                if spans:
+                    self.message_queue.put(spans)
                 
-                # Handle username prompt
-                if message.startswith("Please enter your username:"):
-                    if not self.username:
-                        self.root.after(0, self.prompt_username)
-                else:
-                    # Queue the message for processing in the main thread
-                    self.message_queue.put(("message", message))
-                    
-                    # Extract and update user list
-                    self.extract_users(message)
+                if self.reader.ping_due:
+                    self.reader.ping_due = False
+                    self.root.after(0, self.send_pong)
+                
+                # Subscribe to the user list once the login is answered
+                if self.logged_in and not self.roster_requested and not self.reader.negotiating:
+                    self.roster_requested = True
+                    self.backoff.reset()
+                    self.root.after(0, self.request_roster)
             except Exception as e:
                 if self.running:
-                    self.message_queue.put(("error", f"Error receiving message: {str(e)}"))
+                    self.display_error(f"Error receiving message: {str(e)}")
                     self.running = False
-                    # Schedule reconnect after 5 seconds
-                    self.root.after(5000, self.reconnect)
+                    self.root.after(0, self.schedule_reconnect)
                 break
     
     def process_message_queue(self):
-        """Process messages from the queue in the main thread."""
+        """Render everything queued since the last frame in one widget update."""
+        spans = []
+        events = []
         try:
-            messages_processed = 0
-            while not self.message_queue.empty() and messages_processed < 10:  # Process max 10 at once to keep UI responsive
-                msg_type, message = self.message_queue.get_nowait()
-                
-                if msg_type == "system":
-                    self.display_system_message(message)
-                elif msg_type == "error":
-                    self.display_error(message)
-                else:
-                    self.display_message(message)
-                
-                self.message_queue.task_done()
-                messages_processed += 1
-                
-            # Force update the display
-            self.root.update_idletasks()
+            for _ in range(MAX_BATCHES_PER_FRAME):
+                spans.extend(self.message_queue.get_nowait())
+        except queue.Empty:
+            pass
+        try:
+            while True:
+                events.append(self.presence_queue.get_nowait())
         except queue.Empty:
             pass
+        
+        try:
+            if spans:
+                self.render(spans)
+            # Update the user list at most once per frame
+            if self.apply_presence(events):
+                self.refresh_user_list()
         finally:
-            # Schedule to check again
-            self.root.after(50, self.process_message_queue)  # Check more frequently (50ms)
+            self.root.after(FRAME_MS, self.process_message_queue)
     
-    def extract_users(self, message):
-        """Extract usernames from server messages and update the user list."""
-        # Handle different message formats
-        if "has joined the chat" in message:
-            match = re.search(r"SERVER: (\w+) has joined the chat", message)
-            if match:
-                username = match.group(1)
-                self.add_user(username)
-        elif "has left the chat" in message:
-            match = re.search(r"SERVER: (\w+) has left the chat", message)
-            if match:
-                username = match.group(1)
-                self.remove_user(username)
-        elif "]" in message and ":" in message:
-            # Regular chat message
-            match = re.search(r"\[\d+:\d+\] (\w+):", message)
-            if match:
-                username = match.group(1)
-                self.add_user(username)
+    def render(self, spans):
+        """Append (text, tag) spans with a single insert and scroll."""
+        args = []
+        line = self.partial_line
+        for text, tag in spans:
+            args.append(text)
+            args.append(tag)
+            line.append(text)
+            line.append(tag)
+            if text.endswith('\n'):
+                self.shown.append(tuple(line))
+                line.clear()
+        
+        # Only follow new messages if the user hasn't scrolled up to read
+        following = self.chat_display.yview()[1] >= 1.0
+        self.chat_display.config(state=tk.NORMAL)
+        self.chat_display.insert(tk.END, *args)
+        if len(self.shown) > self.scrollback + TRIM_LINES:
+            excess = len(self.shown) - self.scrollback
+            if not following:
+                # Spare the lines in view and a page above them until the widget holds
+                # twice the limit, and keep the first line in view where it was
+                top = int(self.chat_display.index("@0,0").split(".")[0])
+                if len(self.shown) < 2 * self.scrollback:
+                    excess = min(excess, top - 1 - ARCHIVE_PAGE)
+                if excess > 0:
+                    self.trim(excess)
+                    self.chat_display.yview(f"{max(1, top - excess)}.0")
+            else:
+                self.trim(excess)
+        self.chat_display.config(state=tk.DISABLED)
+        if following:
+            self.chat_display.see(tk.END)
     
-    def add_user(self, username):
-        """Add a user to the user list if not already there."""
-        if username and username != "SERVER" and username not in self.last_seen_usernames:
-            self.last_seen_usernames.add(username)
-            
-            # Add color for this username if not exists
-            if username not in self.username_colors:
-                color_index = len(self.username_colors) % len(USERNAME_COLORS)
-                self.username_colors[username] = color_index
-                
-            # Check if already in list
-            users = list(self.users_list.get(0, tk.END))
-            if username not in users:
-                self.users_list.insert(tk.END, username)
+    def trim(self, excess):
+        """Move the oldest excess lines to the archive in one delete."""
+        for _ in range(excess):
+            self.archive.append(self.shown.popleft())
+        self.chat_display.delete("1.0", f"{excess + 1}.0")
+    
+    def on_chat_scroll(self, first, last):
+        """Scrollbar callback; brings archived lines back when the top is reached."""
+        self.chat_display.vbar.set(first, last)
+        if float(first) <= 0.0 and float(last) < 1.0 and self.archive and not self.loading_older:
+            self.loading_older = True
+            self.root.after_idle(self.load_older)
     
-    def remove_user(self, username):
-        """Remove a user from the user list."""
-        if username in self.last_seen_usernames:
-            self.last_seen_usernames.remove(username)
+    def load_older(self):
+        """Re-render a page of archived lines above what is shown, keeping the view in place."""
+        self.loading_older = False
+        page = []
+        while self.archive and len(page) < ARCHIVE_PAGE:
+            page.append(self.archive.pop())
+        if not page:
+            return
+        page.reverse()
+        self.shown.extendleft(reversed(page))
+        
+        args = [item for line in page for item in line]
+        self.chat_display.config(state=tk.NORMAL)
+        self.chat_display.insert("1.0", *args)
+        self.chat_display.config(state=tk.DISABLED)
+        self.chat_display.yview(f"{len(page) + 1}.0")
+    
+    def color_tag(self, username):
+        """Tag for a username's color, assigning the next color on first sight."""
+        color_index = self.username_colors.get(username)
+        if color_index is None:
+            color_index = self.username_colors.setdefault(
+                username, len(self.username_colors) % len(USERNAME_COLORS))
+        return f"user{color_index}"
+    
+    def parse_message(self, message):
+        """Split a received message into (text, tag) spans, one line at a time."""
+        spans = []
+        for line in message.splitlines(keepends=True):
+            # Ensure every line ends with a newline
+            if not line.endswith('\n'):
+                line += '\n'
             
-        # Find and remove from listbox
-        for i in range(self.users_list.size()):
-            if self.users_list.get(i) == username:
-                self.users_list.delete(i)
-                break
+            if line.startswith(protocol.PRESENCE_PREFIX):
+                # Roster updates are not shown in the chat
+                event = protocol.parse_presence(line)
+                if event:
+                    self.presence_queue.put(event)
+            elif line.startswith("SERVER:"):
+                spans.append((line, "server"))
+            elif "Welcome" in line and "connected to the chat server" in line:
+                spans.append((line, "server"))
+            else:
+                # Color the "[time] user:" prefix by username
+                match = CHAT_LINE.match(line)
+                if match:
+                    spans.append((match.group(1), self.color_tag(match.group(2))))
+                    spans.append((match.group(3), ""))
+                else:
+                    spans.append((line, ""))
+        return spans
+    
+    def request_roster(self):
+        """Ask the server for the user list and presence updates."""
+        if self.reader.negotiating:
+            # Try again once the server has answered the login
+            self.roster_requested = False
+            return
+        if not self.reader.framed:
+            # A server without framing has no presence events either
+            return
+        try:
+            self.socket.sendall(self.reader.encode("/roster"))
+        except Exception as e:
+            self.display_error(f"Error requesting user list: {str(e)}")
+    
+    def send_pong(self):
+        """Answer a heartbeat ping so the server knows we are still here."""
+        try:
+            self.socket.sendall(self.reader.encode(protocol.PONG))
+        except Exception:
+            pass  # the receiving thread notices the connection is gone
+    
+    def apply_presence(self, events):
+        """Update the roster from presence events; returns True if it changed."""
+        changed = False
+        for kind, names in events:
+            if kind == "roster":
+                self.roster = dict.fromkeys(names)
+                self.roster_reset = True
+            elif kind == "more" or kind == "join":
+                self.roster.update(dict.fromkeys(names))
+                self.roster_changes.update(dict.fromkeys(names, True))
+            elif kind == "leave":
+                for name in names:
+                    self.roster.pop(name, None)
+                    self.roster_changes[name] = False
+            changed = True
+        return changed
+    
+    def refresh_user_list(self):
+        """Bring the listbox up to date, only touching the rows that changed."""
+        if self.roster_reset:
+            self.roster_reset = False
+            self.roster_changes.clear()
+            self.listed = sorted(self.roster)
+            self.users_list.delete(0, tk.END)
+            if self.listed:
+                self.users_list.insert(tk.END, *self.listed)
+            return
+        for name, online in self.roster_changes.items():
+            index = bisect.bisect_left(self.listed, name)
+            shown = index < len(self.listed) and self.listed[index] == name
+            if online and not shown:
+                self.listed.insert(index, name)
+                self.users_list.insert(index, name)
+            elif not online and shown:
+                del self.listed[index]
+                self.users_list.delete(index)
+        self.roster_changes.clear()
     
     def prompt_username(self):
         """Prompt the user for a username."""
@@ -345,9 +517,7 @@ class ImprovedChatClient:
             username = f"User-{int(time.time()) % 10000}"
         
         self.username = username
-        self.add_user(username)  # Add ourselves to the user list
-        self.status_var.set(f"Connected as {username}")
-        self.socket.send(username.encode('utf-8'))
+        self.login()
         
         # Update window title
         self.root.title(f"Chat Client - {username}")
@@ -355,6 +525,22 @@ class ImprovedChatClient:
         # Ensure input gets focus after username dialog
         self.root.after(100, lambda: self.message_input.focus_set())
     
+    def login(self):
+        """Send our username, offering the framed protocol if enabled."""
+        self.roster_requested = False
+        self.status_var.set(f"Connected as {self.username}")
+        try:
+            if self.use_framing:
+                self.reader.expect_ack()
+                self.socket.sendall(protocol.offer_framing(self.username, self.compact, self.compress,
+                                                           self.session, heartbeat=True))
+            else:
+                self.socket.sendall(self.username.encode('utf-8'))
+        except Exception as e:
+            self.display_error(f"Error logging in: {str(e)}")
+            return
+        self.logged_in = True
+    
     def send_message(self, event=None):
         """Send a message to the server."""
         message = self.message_input.get().strip()
@@ -364,28 +550,21 @@ class ImprovedChatClient:
                 self.display_error("Cannot send message - not connected or username not set.")
                 return "break"
             
+            # Wait until the server has told us which protocol it speaks
+            if self.reader.negotiating:
+                self.display_error("Still connecting to the server, please try again.")
+                return "break"
+            
             try:
-                self.socket.send(message.encode('utf-8'))
+                self.socket.sendall(self.reader.encode(message))
                 self.message_input.delete(0, tk.END)
                 
                 # Display our own message in the chat
                 if message != "/exit":
                     timestamp = time.strftime("%H:%M", time.localtime())
-                    formatted_message = f"[{timestamp}] {self.username}: {message}\n"
-                    
-                    # Add message directly to chat display to ensure immediate feedback
-                    self.chat_display.config(state=tk.NORMAL)
-                    
-                    # Get color for our username
-                    color_index = self.username_colors.get(self.username, 0)
-                    tag = f"user{color_index}"
-                    
-                    # Insert with proper formatting
                     prefix = f"[{timestamp}] {self.username}:"
-                    self.chat_display.insert(tk.END, prefix, tag)
-                    self.chat_display.insert(tk.END, f" {message}\n")
-                    self.chat_display.see(tk.END)
-                    self.chat_display.config(state=tk.DISABLED)
+                    self.message_queue.put([(prefix, self.color_tag(self.username)),
+                                            (f" {message}\n", "")])
                 
                 # Exit check
                 if message == "/exit":
@@ -398,65 +577,19 @@ class ImprovedChatClient:
     
     def display_message(self, message):
         """Display a received message in the chat display."""
-        self.chat_display.config(state=tk.NORMAL)
-        
-        # Ensure message ends with newline
-        if not message.endswith('\n'):
-            message += '\n'
-        
-        # Handle server messages
-        if message.startswith("SERVER:"):
-            self.chat_display.insert(tk.END, message, "server")
-        elif "Welcome" in message and "connected to the chat server" in message:
-            self.chat_display.insert(tk.END, message, "server")
-        else:
-            # Try to extract username for coloring
-            match = re.search(r"\[\d+:\d+\] (\w+):", message)
-            if match:
-                username = match.group(1)
-                # Get color for this username
-                color_index = self.username_colors.get(username, 0)
-                tag = f"user{color_index}"
-                
-                # Split message into parts
-                parts = message.split(f"{username}:", 1)
-                if len(parts) == 2:
-                    prefix = parts[0] + f"{username}:"
-                    content = parts[1]
-                    
-                    # Insert with appropriate tags
-                    self.chat_display.insert(tk.END, prefix, tag)
-                    self.chat_display.insert(tk.END, content)
-                else:
-                    # Fallback for unexpected format
-                    self.chat_display.insert(tk.END, message)
-            else:
-                # Just insert the message as is
-                self.chat_display.insert(tk.END, message)
-        
-        self.chat_display.see(tk.END)
-        self.chat_display.config(state=tk.DISABLED)
-        
-        # Update the window title if we have a username
-        if self.username:
-            self.root.title(f"Chat Client - {self.username}")
+        self.message_queue.put(self.parse_message(message))
     
     def display_system_message(self, message):
         """Display a system message in the chat display."""
-        self.chat_display.config(state=tk.NORMAL)
-        self.chat_display.insert(tk.END, f"SYSTEM: {message}\n", "server")
-        self.chat_display.see(tk.END)
-        self.chat_display.config(state=tk.DISABLED)
+        self.message_queue.put([(f"SYSTEM: {message}\n", "server")])
     
     def display_error(self, message):
         """Display an error message in the chat display."""
-        self.chat_display.config(state=tk.NORMAL)
-        self.chat_display.insert(tk.END, f"ERROR: {message}\n", "error")
-        self.chat_display.see(tk.END)
-        self.chat_display.config(state=tk.DISABLED)
+        self.message_queue.put([(f"ERROR: {message}\n", "error")])
         
         # Also update status bar
-        self.status_var.set(f"Error: {message[:30]}..." if len(message) > 30 else f"Error: {message}")
+        status = f"Error: {message[:30]}..." if len(message) > 30 else f"Error: {message}"
+        self.root.after(0, self.status_var.set, status)
     
     def on_closing(self):
         """Handle window close event."""
@@ -464,7 +597,7 @@ class ImprovedChatClient:
             self.running = False
             if self.socket:
                 try:
-                    self.socket.send("/exit".encode('utf-8'))
+                    self.socket.sendall(self.reader.encode("/exit"))
                     self.socket.close()
                 except:
                     pass
@@ -475,8 +608,24 @@ def main():
     parser = argparse.ArgumentParser(description='Improved Chat Client')
     parser.add_argument('--host', default=DEFAULT_HOST, help='Server IP address')
     parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='Server port')
+    parser.add_argument('--protocol', choices=['compact', 'framed', 'raw'], default='compact',
+                        help='compact: offer binary chat frames (falls back to framed, then raw); '
+                             'framed: offer length-prefixed text; raw: never offer')
+    parser.add_argument('--compress', action='store_true',
+                        help='Offer zlib compression of everything the server sends')
+    parser.add_argument('--scrollback', type=int, default=SCROLLBACK_LINES,
+                        help='Lines kept in the chat window; older lines are re-rendered when you scroll up')
+    parser.add_argument('--tls', action='store_true', help='Connect with TLS')
+    parser.add_argument('--tls-ca', default=None,
+                        help="PEM file of the CA (or self-signed certificate) to trust for the server's certificate")
+    parser.add_argument('--tls-insecure', action='store_true',
+                        help="Don't verify the server's certificate (testing only)")
     args = parser.parse_args()
     
+    tls_context = None
+    if args.tls or args.tls_ca or args.tls_insecure:
+        tls_context = tls.client_context(args.tls_ca, verify=not args.tls_insecure)
+    
     # Create and run the GUI
     root = tk.Tk()
     root.title("Chat Client - Connecting...")
@@ -491,7 +640,9 @@ def main():
     except:
         pass  # Icon not found, use default
     
-    client = ImprovedChatClient(root, args.host, args.port)
+    client = ImprovedChatClient(root, args.host, args.port, use_framing=args.protocol != 'raw',
+                                scrollback=args.scrollback, compact=args.protocol == 'compact',
+                                compress=args.compress, tls_context=tls_context)
     root.mainloop()
 
 if __name__ == "__main__":
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""Hot restart: hand the listening socket and live clients to a new process.
+
+The running server starts a copy of itself with the same command line.
+The listening sockets are inherited by the new process, so connection
+attempts during the restart wait in the kernel's accept queue instead of
+being refused. The asyncio engine also hands over its connected clients:
+each client's socket travels over a Unix socket pair with SCM_RIGHTS,
+together with a JSON record of its chat state, and the new process
+carries on serving it without the client noticing.
+
+The handoff channel is a SOCK_SEQPACKET pair, so every record arrives as
+one packet with its file descriptor attached. The old process sends a
+header record, one record per client and an end record; the new process
+answers ACK once it has adopted everything, and only then does the old
+process let go of the clients.
+"""
+import array
+import json
+import os
+import socket
+import subprocess
+import sys
+
+LISTEN_FDS_ENV = "CHAT_LISTEN_FDS"
+HANDOFF_FD_ENV = "CHAT_HANDOFF_FD"
+MAX_RECORD_SIZE = 192 * 1024  # clients with more state than this are not handed over
+ACK = b"ACK"
+ACK_TIMEOUT = 30.0  # seconds the new process gets to start and adopt every client
+
+
+class HandoffError(Exception):
+    """The new process could not be started or did not take over."""
+
+
+def inherited_listeners():
+    """Listening sockets passed down by the process we replace, if any."""
+    fds = os.environ.pop(LISTEN_FDS_ENV, None)
+    if not fds:
+        return []
+    return [socket.socket(fileno=int(fd)) for fd in fds.split(",")]
+
+
+def inherited_channel():
+    """The handoff channel to the process we replace, if it is handing over clients."""
+    fd = os.environ.pop(HANDOFF_FD_ENV, None)
+    if fd is None:
+        return None
+    return socket.socket(fileno=int(fd))
+
+
+def spawn_successor(listeners, with_clients=False):
+    """Start a new server process with our command line and listening sockets.
+
+    Returns (process, channel); channel is the parent end of the handoff
+    channel when with_clients is set, otherwise None.
+    """
+    env = dict(os.environ)
+    fds = [sock.fileno() for sock in listeners]
+    env[LISTEN_FDS_ENV] = ",".join(map(str, fds))
+    channel = None
+    if with_clients:
+        channel, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        env[HANDOFF_FD_ENV] = str(child.fileno())
+        fds.append(child.fileno())
+    try:
+        process = subprocess.Popen([sys.executable] + sys.argv, env=env, pass_fds=fds)
+    except OSError as e:
+        if channel:
+            channel.close()
+        raise HandoffError(f"Could not start the new server: {e}")
+    finally:
+        if with_clients:
+            child.close()
+    return process, channel
+
+
+def encode_record(record):
+    data = json.dumps(record).encode('utf-8')
+    if len(data) > MAX_RECORD_SIZE:
+        raise HandoffError(f"Handoff record of {len(data)} bytes is too large")
+    return data
+
+
+def send_record(channel, record, fd=None):
+    """Send one JSON record, with a file descriptor attached if given."""
+    data = encode_record(record)
+    if fd is None:
+        channel.sendall(data)
+    else:
+        channel.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [fd]))])
+
+
+def receive_record(channel):
+    """Receive one record; returns (record, socket or None), or (None, None) at end of channel."""
+    fds = array.array("i")
+    data, ancdata, _, _ = channel.recvmsg(MAX_RECORD_SIZE, socket.CMSG_SPACE(fds.itemsize))
+    if not data:
+        return None, None
+    sock = None
+    for level, kind, payload in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(payload[:len(payload) - len(payload) % fds.itemsize])
+    if fds:
+        sock = socket.socket(fileno=fds[0])
+    return json.loads(data), sock
+
+
+def wait_for_ack(channel, process):
+    """Wait for the new process to take over; raises HandoffError if it does not."""
+    channel.settimeout(ACK_TIMEOUT)
+    try:
+        reply = channel.recv(len(ACK))
+    except OSError:
+        reply = b""
+    if reply != ACK:
+        if process.poll() is None:
+            process.kill()
+        raise HandoffError("The new server did not take over")
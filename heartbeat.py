@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""Heartbeats: finding connections whose peer is gone.
+
+A client that vanished without closing its connection (pulled cable,
+suspended laptop, crashed NAT) still looks connected: the server keeps
+paying for it in every broadcast until a write finally fails, which may
+take many minutes or, with nothing queued, never happen.
+
+Clients that offer heartbeats at login are pinged when they have been
+silent for `interval` seconds and must answer within `timeout`; those
+that don't are disconnected, which runs the normal logout and tells
+everyone they left. Anything a client sends counts as an answer, so busy
+clients are never pinged. For clients that can't answer pings, TCP
+keepalive (set_keepalive()) lets the kernel find dead peers instead.
+
+Connections are tracked on a timer wheel: every client sits in the slot
+of the tick at which it next needs attention, so a tick only touches the
+clients due then, and receiving a message costs one timestamp store
+rather than rescheduling a timer. A client that was heard from in the
+meantime is simply put back in a later slot when its slot comes up.
+"""
+import math
+import socket
+import threading
+import time
+
+TICK = 1.0  # seconds per timer wheel slot
+DEFAULT_INTERVAL = 30.0  # seconds of silence before a client is pinged
+DEFAULT_TIMEOUT = 10.0  # seconds it then has to answer
+
+
+def set_keepalive(sock, idle=60, interval=10, count=5):
+    """Have the kernel probe an idle connection and fail it after count unanswered probes."""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # Not every platform lets the timing be set per socket
+    for name, value in (("TCP_KEEPIDLE", idle), ("TCP_KEEPINTVL", interval), ("TCP_KEEPCNT", count)):
+        option = getattr(socket, name, None)
+        if option is not None:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, option, value)
+            except OSError:
+                pass
+
+
+class TimerWheel:
+    """Buckets of items by the tick they are due at; delays may not exceed the wheel's span."""
+
+    def __init__(self, span, tick=TICK):
+        self.tick = tick
+        self.slots = [[] for _ in range(int(math.ceil(span / tick)) + 2)]
+        self.current = int(time.monotonic() // tick)  # the next tick to expire
+
+    def schedule(self, item, when):
+        """Have advance() return item once the monotonic clock reaches when."""
+        due = max(int(when // self.tick), self.current)
+        self.slots[due % len(self.slots)].append(item)
+
+    def advance(self, now):
+        """Return every item due up to now."""
+        due = []
+        last = int(now // self.tick)
+        while self.current <= last:
+            slot = self.current % len(self.slots)
+            due.extend(self.slots[slot])
+            self.slots[slot] = []
+            self.current += 1
+        return due
+
+
+class Heartbeat:
+    """Pings silent clients and evicts the ones that don't answer.
+
+    ping(client) and evict(client) are called from tick(), which the
+    engine runs every TICK seconds.
+    """
+
+    def __init__(self, interval, timeout, ping, evict):
+        self.interval = interval
+        self.timeout = timeout
+        self.ping = ping
+        self.evict = evict
+        self.lock = threading.Lock()  # watch() runs on client threads in the thread engine
+        self.wheel = TimerWheel(max(interval, timeout))
+
+    def watch(self, client):
+        """Start checking on a logged-in client."""
+        with self.lock:
+            self.wheel.schedule(client, client.last_seen + self.interval)
+
+    def tick(self):
+        now = time.monotonic()
+        with self.lock:
+            due = self.wheel.advance(now)
+        later = []
+        for client in due:
+            if client.outbound.closed:
+                # Gone already; drop it from the wheel
+                continue
+            if now - client.last_seen < self.interval:
+                # Heard from since it was scheduled
+                client.pinged_at = None
+                later.append((client, client.last_seen + self.interval))
+            elif client.pinged_at is None or client.pinged_at < client.last_seen:
+                client.pinged_at = now
+                self.ping(client)
+                later.append((client, now + self.timeout))
+            else:
+                self.evict(client)
+        with self.lock:
+            for client, when in later:
+                self.wheel.schedule(client, when)
+        return len(due)
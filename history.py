@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""Message history: in-memory ring buffers backed by an append-only log.
+
+append() is on the broadcast path, so it only assigns an id, adds the
+message to its room's ring buffer and hands it to a writer thread; disk
+I/O never happens on the caller's thread. The most recent messages of
+every room are served straight from the ring buffers. Older pages are
+read from the on-disk log by a reader thread and delivered through a
+callback.
+
+The log is a directory of segment files named after the id of their
+first message, each holding one JSON record per line. A new segment is
+started every SEGMENT_MESSAGES messages, so a page lookup only reads the
+segments that can contain it.
+
+Message ids only mean something within one history, so every store has
+an origin: random for a memory-only store, kept in ORIGIN_FILE for a
+log that outlives the process.
+
+A store can feed a search index (search.SearchIndex): every appended
+message is passed on to it, and at startup it is given the log to index.
+"""
+import bisect
+import collections
+import functools
+import json
+import os
+import queue
+import threading
+
+RING_SIZE = 200
+SEGMENT_MESSAGES = 10000
+SEGMENT_SUFFIX = ".log"
+ORIGIN_FILE = "origin"
+
+
+def _record_id(line):
+    """The id of a log record, without decoding the rest of it."""
+    try:
+        return int(line[7:line.index(",", 7)])
+    except ValueError:
+        return None
+
+
+class HistoryStore:
+    def __init__(self, directory=None, ring_size=RING_SIZE, segment_messages=SEGMENT_MESSAGES,
+                 index=None):
+        self.directory = directory
+        self.ring_size = ring_size
+        self.segment_messages = segment_messages
+        self.lock = threading.Lock()
+        self.rings = {}  # room -> deque of (id, text)
+        self.next_id = 1
+        self.segments = []  # first ids of the segment files, ascending
+        self.segment_file = None
+        self.write_queue = queue.Queue()
+        self.read_queue = queue.Queue()
+        self.written = threading.Condition()
+        self.written_id = 0  # everything up to this id is on disk
+        self.origin = os.urandom(8).hex()
+        self.index = index
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.origin = self._load_origin()
+            self._recover()
+            for target in (self._write_loop, self._read_loop):
+                thread = threading.Thread(target=target)
+                thread.daemon = True
+                thread.start()
+        if index is not None:
+            index.start(self._records(self.next_id - 1) if directory else ())
+
+    def _segment_path(self, first_id):
+        return os.path.join(self.directory, f"{first_id:012d}{SEGMENT_SUFFIX}")
+
+    def _load_origin(self):
+        path = os.path.join(self.directory, ORIGIN_FILE)
+        try:
+            with open(path, encoding="utf-8") as f:
+                origin = f.read().strip()
+            if origin:
+                return origin
+        except OSError:
+            pass
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.origin + "\n")
+        return self.origin
+
+    def _recover(self):
+        """Find existing segments and warm the ring buffers from the newest ones."""
+        for name in os.listdir(self.directory):
+            if name.endswith(SEGMENT_SUFFIX):
+                try:
+                    self.segments.append(int(name[:-len(SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+        self.segments.sort()
+
+        for first_id in self.segments[-2:]:
+            for record in self._read_segment(first_id):
+                self._remember(record["room"], record["id"], record["text"])
+                self.next_id = max(self.next_id, record["id"] + 1)
+        self.written_id = self.next_id - 1
+
+    def _remember(self, room, message_id, text):
+        ring = self.rings.get(room)
+        if ring is None:
+            ring = self.rings[room] = collections.deque(maxlen=self.ring_size)
+        ring.append((message_id, text))
+
+    def append(self, room, text):
+        """Record a message and return its id."""
+        with self.lock:
+            message_id = self.next_id
+            self.next_id += 1
+            self._remember(room, message_id, text)
+        if self.directory:
+            self.write_queue.put((message_id, room, text))
+        if self.index is not None:
+            self.index.add(message_id, room, text)
+        return message_id
+
+    def recent(self, room, limit):
+        """The newest messages of a room, oldest first, from memory."""
+        with self.lock:
+            ring = self.rings.get(room)
+            if not ring:
+                return []
+            return list(ring)[-limit:]
+
+    def since(self, room, after_id, limit):
+        """The messages of a room newer than after_id, oldest first, from memory.
+
+        Returns (messages, complete): complete is False if some of them
+        have already left the ring buffer or there were more than limit.
+        """
+        with self.lock:
+            ring = self.rings.get(room)
+            if not ring:
+                return [], True
+            newer = [entry for entry in ring if entry[0] > after_id]
+            # Everything evicted is older than the oldest message still in the ring
+            complete = len(ring) < ring.maxlen or ring[0][0] <= after_id + 1
+        if len(newer) > limit:
+            return newer[-limit:], False
+        return newer, complete
+
+    def page(self, room, before_id, limit, callback):
+        """Look up up to `limit` messages older than before_id, oldest first.
+
+        Served from memory when the ring buffer reaches back far enough,
+        otherwise from disk on the reader thread. callback(messages) may
+        run on either thread.
+        """
+        with self.lock:
+            ring = self.rings.get(room, ())
+            older = [entry for entry in ring if entry[0] < before_id][-limit:]
+            upto = self.next_id - 1
+        if len(older) >= limit or not self.directory:
+            callback(older)
+            return
+        last_id = min(before_id - 1, upto)
+        self.read_queue.put((last_id, functools.partial(self._read_page, room, last_id, limit), callback))
+
+    def fetch(self, room, ids, callback):
+        """Look up the messages of a room with the given ids, oldest first.
+
+        Like page(), served from memory when the ring buffer has them all,
+        otherwise from disk on the reader thread.
+        """
+        wanted = set(ids)
+        with self.lock:
+            found = [entry for entry in self.rings.get(room, ()) if entry[0] in wanted]
+        if len(found) == len(wanted) or not self.directory:
+            callback(found)
+            return
+        self.read_queue.put((max(wanted), functools.partial(self._read_ids, room, wanted), callback))
+
+    def flush(self, timeout=None):
+        """Wait until everything appended so far is on disk; returns False on timeout."""
+        if not self.directory:
+            return True
+        with self.lock:
+            last_id = self.next_id - 1
+        with self.written:
+            return self.written.wait_for(lambda: self.written_id >= last_id, timeout)
+
+    def _write_loop(self):
+        while True:
+            batch = [self.write_queue.get()]
+            # Write everything that piled up in one go
+            while True:
+                try:
+                    batch.append(self.write_queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except OSError as e:
+                print(f"History write failed: {e}")
+            with self.written:
+                self.written_id = batch[-1][0]
+                self.written.notify_all()
+
+    def _write(self, batch):
+        lines = []
+        for message_id, room, text in batch:
+            if self.segment_file is None or message_id - self.segments[-1] >= self.segment_messages:
+                self._flush_lines(lines)
+                lines = []
+                self._roll(message_id)
+            lines.append(json.dumps({"id": message_id, "room": room, "text": text}) + "\n")
+        self._flush_lines(lines)
+
+    def _flush_lines(self, lines):
+        if lines:
+            self.segment_file.write("".join(lines))
+            self.segment_file.flush()
+
+    def _roll(self, first_id):
+        """Start a new segment, or reopen the newest one after a restart."""
+        if self.segment_file is not None:
+            self.segment_file.close()
+        elif self.segments and first_id - self.segments[-1] < self.segment_messages:
+            self.segment_file = open(self._segment_path(self.segments[-1]), "a+", encoding="utf-8")
+            # Don't glue new records onto a line torn by a crash
+            if self.segment_file.tell():
+                self.segment_file.seek(self.segment_file.tell() - 1)
+                if self.segment_file.read(1) != "\n":
+                    self.segment_file.write("\n")
+            return
+        with self.lock:
+            self.segments.append(first_id)
+        self.segment_file = open(self._segment_path(first_id), "a", encoding="utf-8")
+
+    def _read_segment(self, first_id, ids=None):
+        """The records of a segment; with ids, only those records, skipping the rest undecoded."""
+        try:
+            with open(self._segment_path(first_id), encoding="utf-8") as f:
+                for line in f:
+                    if ids is not None and _record_id(line) not in ids:
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        # Torn last line after a crash
+                        continue
+        except OSError:
+            return
+
+    def _records(self, last_id):
+        """Every (id, room, text) in the log up to last_id, oldest first."""
+        with self.lock:
+            segments = self.segments[:bisect.bisect_right(self.segments, last_id)]
+        for first_id in segments:
+            for record in self._read_segment(first_id):
+                if record["id"] <= last_id:
+                    yield record["id"], record["room"], record["text"]
+
+    def _read_page(self, room, last_id, limit):
+        with self.lock:
+            segments = self.segments[:bisect.bisect_right(self.segments, last_id)]
+        found = []
+        for first_id in reversed(segments):
+            page = [(record["id"], record["text"]) for record in self._read_segment(first_id)
+                    if record["room"] == room and record["id"] <= last_id]
+            found = page + found
+            if len(found) >= limit:
+                break
+        return found[-limit:]
+
+    def _read_ids(self, room, ids):
+        with self.lock:
+            if not self.segments:
+                return []
+            segments = sorted({self.segments[bisect.bisect_right(self.segments, message_id) - 1]
+                               for message_id in ids if message_id >= self.segments[0]})
+        return [(record["id"], record["text"]) for first_id in segments
+                for record in self._read_segment(first_id, ids) if record["room"] == room]
+
+    def _read_loop(self):
+        while True:
+            last_id, lookup, callback = self.read_queue.get()
+            # Make sure everything up to the requested id is on disk
+            with self.written:
+                self.written.wait_for(lambda: self.written_id >= last_id)
+            try:
+                callback(lookup())
+            except Exception as e:
+                print(f"History lookup failed: {e}")
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""Runtime metrics in Prometheus text format.
+
+Counters and histograms are updated on the hot path, so each update is a
+lock acquire and an addition. Gauges are callbacks evaluated only when
+someone scrapes the endpoint. start_http_server() serves everything at
+http://host:port/metrics from a background thread.
+"""
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency buckets in seconds, 10us to 1s
+TIME_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+# Queue depth buckets in messages
+BACKLOG_BUCKETS = (0, 1, 4, 16, 64, 256, 1024)
+# Batch size buckets in messages
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+registry = []
+http_server = None  # the running endpoint, if any
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        yield self.name, "", self.value
+
+
+class Gauge:
+    """A value computed by a callback at scrape time.
+
+    The callback may return a number or a dict of label string -> number.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help_text, callback):
+        self.name = name
+        self.help = help_text
+        self.callback = callback
+        registry.append(self)
+
+    def samples(self):
+        value = self.callback()
+        if isinstance(value, dict):
+            for labels, item in value.items():
+                yield self.name, labels, item
+        else:
+            yield self.name, "", value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        yield from histogram_samples(self.name, self.buckets, counts, total)
+
+
+class SnapshotHistogram:
+    """A histogram rebuilt from a callback's list of values at scrape time."""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets, callback):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.callback = callback
+        registry.append(self)
+
+    def samples(self):
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0
+        for value in self.callback():
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total += value
+        yield from histogram_samples(self.name, self.buckets, counts, total)
+
+
+def histogram_samples(name, buckets, counts, total):
+    cumulative = 0
+    for bound, count in zip(buckets, counts):
+        cumulative += count
+        yield f"{name}_bucket", f'le="{bound}"', cumulative
+    cumulative += counts[-1]
+    yield f"{name}_bucket", 'le="+Inf"', cumulative
+    yield f"{name}_sum", "", total
+    yield f"{name}_count", "", cumulative
+
+
+def render():
+    """All metrics in Prometheus text exposition format."""
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        try:
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+        except Exception as e:
+            lines.append(f"# error collecting {metric.name}: {e}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth a console line each
+        pass
+
+
+def start_http_server(host, port):
+    """Serve /metrics from a daemon thread."""
+    global http_server
+    server = http_server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print(f"Metrics available at http://{host}:{port}/metrics")
+    return server
+
+
+def stop_http_server():
+    """Close the endpoint so a new process can bind its port."""
+    global http_server
+    if http_server is not None:
+        http_server.shutdown()
+        http_server.server_close()
+        http_server = None
+
+
+# Server-wide metrics updated on the hot path
+messages_in = Counter("chat_messages_in_total", "Messages received from clients")
+messages_out = Counter("chat_messages_out_total", "Messages queued for delivery to clients")
+bytes_in = Counter("chat_bytes_in_total", "Bytes received from clients")
+bytes_out = Counter("chat_bytes_out_total", "Bytes written to clients")
+write_calls = Counter("chat_write_calls_total", "Socket write calls made by client writers")
+heartbeat_timeouts = Counter("chat_heartbeat_timeouts_total", "Clients disconnected for not answering a ping")
+broadcast_seconds = Histogram("chat_broadcast_duration_seconds",
+                              "Time spent queueing one broadcast for all its recipients")
+batch_messages = Histogram("chat_broadcast_batch_messages",
+                           "Messages queued together by one flush of the batching window",
+                           buckets=BATCH_BUCKETS)
+lock_hold_seconds = Histogram("chat_clients_lock_hold_seconds",
+                              "Time clients_lock was held to change the registry or rebuild a snapshot")
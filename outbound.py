@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""Bounded per-client outbound queues.
+
+broadcast() never touches a socket: it only appends pre-encoded bytes to
+each recipient's OutboundQueue, and a per-client writer (a thread in the
+thread engine, a task in the asyncio engine) drains the queue. When a
+reader falls behind and its queue fills up, the configured slow-consumer
+policy decides what happens.
+
+Messages are queued as shared immutable bytes objects: a broadcast is
+encoded once and the same object sits in every recipient's queue. Writers
+flush everything pending with one vectored write (sendmsg) instead of
+one send() per message.
+"""
+import threading
+
+# Slow-consumer policies
+DROP_OLDEST = 'drop-oldest'    # discard the oldest queued messages to make room
+DISCONNECT = 'disconnect'      # kick the client off the server
+COALESCE = 'coalesce'          # replace the whole backlog with a single notice
+POLICIES = (DROP_OLDEST, DISCONNECT, COALESCE)
+
+DEFAULT_MAX_MESSAGES = 256
+DEFAULT_MAX_BYTES = 256 * 1024
+
+# Most systems accept at most 1024 buffers per sendmsg() call
+IOV_MAX = 1024
+
+# How often each policy fired, across all queues in this process
+policy_counters_lock = threading.Lock()
+policy_counters = {policy: 0 for policy in POLICIES}
+
+
+def count_policy(policy, amount=1):
+    """Record that a slow-consumer policy fired."""
+    with policy_counters_lock:
+        policy_counters[policy] += amount
+
+
+def policy_stats():
+    """Return a copy of the slow-consumer policy counters."""
+    with policy_counters_lock:
+        return dict(policy_counters)
+
+
+def coalesce_notice(skipped):
+    """Default notice that replaces a coalesced backlog."""
+    return f"SERVER: {skipped} messages skipped because your connection is too slow.\n".encode('utf-8')
+
+
+class OutboundQueue:
+    """A bounded FIFO of pre-encoded messages waiting to be written to one client.
+
+    There is one per connection, so it is slotted and keeps its items in
+    a list rather than a deque (an empty deque allocates a whole block),
+    and the condition a writer thread waits on is only created by the
+    first wait(): asyncio writers never block on it.
+    """
+    __slots__ = ('max_messages', 'max_bytes', 'policy', 'wakeup', 'notice', 'closed',
+                 'dropped', 'overflows', '_items', '_bytes', '_lock', '_ready', '_waiters')
+
+    def __init__(self, max_messages=DEFAULT_MAX_MESSAGES, max_bytes=DEFAULT_MAX_BYTES,
+                 policy=DROP_OLDEST, wakeup=None, notice=coalesce_notice):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow-consumer policy: {policy}")
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.wakeup = wakeup  # called after every put, e.g. to wake an asyncio writer
+        self.notice = notice
+        self.closed = False
+        self.dropped = 0      # messages discarded by drop-oldest or coalesce
+        self.overflows = 0    # times this queue hit its limit
+        self._items = []
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._ready = None  # Condition on _lock, once a writer has waited
+        self._waiters = 0  # notify() is not free, so skip it when nobody waits
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def pending_bytes(self):
+        return self._bytes
+
+    def _full(self, incoming):
+        return self._items and (len(self._items) >= self.max_messages
+                                or self._bytes + incoming > self.max_bytes)
+
+    def _notify_all(self):
+        if self._ready is not None:
+            self._ready.notify_all()
+
+    def put(self, data):
+        """Queue data for the writer.
+
+        Returns False if the slow-consumer policy decided the client must be
+        disconnected; the caller is responsible for kicking it.
+        """
+        with self._lock:
+            if self.closed:
+                return True
+
+            if self._full(len(data)):
+                self.overflows += 1
+                count_policy(self.policy)
+                if self.policy == DISCONNECT:
+                    self.closed = True
+                    self._items = []
+                    self._bytes = 0
+                    self._notify_all()
+                    return False
+                elif self.policy == COALESCE:
+                    skipped = len(self._items)
+                    self.dropped += skipped
+                    notice = self.notice(skipped)
+                    self._items = [notice]
+                    self._bytes = len(notice)
+                else:
+                    # Drop just enough of the oldest messages for data to fit
+                    items = self._items
+                    drop = 0
+                    while drop < len(items) and (len(items) - drop >= self.max_messages
+                                                 or self._bytes + len(data) > self.max_bytes):
+                        self._bytes -= len(items[drop])
+                        drop += 1
+                    del items[:drop]
+                    self.dropped += drop
+
+            self._items.append(data)
+            self._bytes += len(data)
+            if self._waiters:
+                self._ready.notify()
+
+        if self.wakeup:
+            self.wakeup()
+        return True
+
+    def take(self):
+        """Remove and return everything queued, without blocking."""
+        with self._lock:
+            return self._take()
+
+    def _take(self):
+        items = self._items
+        self._items = []
+        self._bytes = 0
+        return items
+
+    def wait(self, timeout=None):
+        """Block until there is something to write.
+
+        Returns the queued messages, or None once the queue is closed and
+        fully drained.
+        """
+        with self._lock:
+            if self._ready is None:
+                self._ready = threading.Condition(self._lock)
+            while not self._items and not self.closed:
+                self._waiters += 1
+                try:
+                    if not self._ready.wait(timeout):
+                        return []
+                finally:
+                    self._waiters -= 1
+            if self._items:
+                return self._take()
+            return None
+
+    def close(self):
+        """Stop accepting messages; the writer drains what is left and exits."""
+        with self._lock:
+            self.closed = True
+            self._notify_all()
+        if self.wakeup:
+            self.wakeup()
+
+
+def send_vectored(sock, buffers):
+    """Write a list of buffers to a blocking socket with as few syscalls as possible.
+
+    Returns the number of write calls made.
+    """
+    if not hasattr(sock, 'sendmsg'):
+        # Windows has no sendmsg(); one copy and one sendall() instead
+        sock.sendall(b"".join(buffers))
+        return 1
+
+    buffers = list(buffers)
+    first = 0
+    calls = 0
+    while first < len(buffers):
+        sent = sock.sendmsg(buffers[first:first + IOV_MAX])
+        calls += 1
+        # Skip over what was written, splitting a partially written buffer
+        while sent:
+            length = len(buffers[first])
+            if sent >= length:
+                sent -= length
+                first += 1
+            else:
+                buffers[first] = memoryview(buffers[first])[sent:]
+                sent = 0
+    return calls
@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+"""Wire protocol shared by the server and both clients.
+
+Raw mode is the original protocol: every recv() is treated as one
+message, so messages can be merged or split under load.
+
+Framed mode prefixes every message with its length as a 4 byte
+big-endian integer, so any number of messages can share one recv() and a
+message can span several. It is negotiated during login:
+
+1. The server sends the username prompt (raw).
+2. A client that supports framing appends FRAMING_OFFER to its username.
+   The offer is whitespace, so servers that predate framing strip it off
+   and carry on in raw mode.
+3. A server that supports framing answers with FRAMING_ACK (raw) and
+   everything after that, in both directions, is framed. If the reply
+   does not start with FRAMING_ACK the client stays in raw mode.
+
+Framed clients may also offer, right after FRAMING_OFFER, the compact
+encoding (COMPACT_OFFER) and zlib compression (ZLIB_OFFER). Both are
+whitespace too. The server lists what it accepted after "FRAMED" in its
+acknowledgement, e.g. "FRAMED compact zlib", and both only change the
+server -> client direction; clients keep sending framed UTF-8 text.
+
+In compact mode every frame starts with a type byte. Chat lines are sent
+as CHAT frames carrying integer ids for the sender and room and the time
+as integer Unix seconds instead of repeating the formatted text; an id
+is defined by a NAME frame the first time a connection needs it. Every
+other message is a TEXT frame holding the usual UTF-8 text. Clients
+rebuild the same text lines the other modes get.
+
+With zlib, everything the server writes after the acknowledgement is
+one zlib stream, flushed (Z_SYNC_FLUSH) after every write so the client
+can decode it as it arrives.
+
+Framed clients may also offer sessions (SESSION_OFFER), which lets them
+resume after a dropped connection. The server then sends SESSION lines,
+which clients consume instead of showing:
+
+    SESSION: start 1234 <token>   logged in; everything up to message 1234 is accounted for
+    SESSION: token <token>        the token changed (the client joined or left a room)
+    SESSION: seen 1240            the chat lines written so far go up to message 1240
+
+In compact mode "seen" is a SEEN frame instead. To resume, a client logs
+in with its username followed by RESUME_SEPARATOR, the token and the
+last message id it saw (see offer_framing()); the server skips the
+welcome and scrollback and replays only the chat lines after that id.
+
+Framed clients that offer heartbeats (HEARTBEAT_OFFER) are sent
+HEARTBEAT_PING after a while of silence and must answer with PONG, or
+anything else, before the server's timeout or be disconnected.
+
+Clients that keep a user list send /roster after login. The server
+answers with the full list of online users and from then on tells them
+whenever someone comes online or goes offline, as PRESENCE lines:
+
+    PRESENCE: roster ["alice", "bob"]   everyone online, replacing the old list
+    PRESENCE: more ["carol"]            rest of a roster too long for one message
+    PRESENCE: join dave
+    PRESENCE: leave alice
+"""
+import json
+import struct
+import threading
+import time
+import zlib
+
+PROMPT = "Please enter your username: "
+FRAMING_OFFER = b"\x1e\x1f"
+COMPACT_OFFER = b"\x1d"
+ZLIB_OFFER = b"\x1c"
+SESSION_OFFER = b"\x0b"
+HEARTBEAT_OFFER = b"\x0c"
+OFFERS = {COMPACT_OFFER: "compact", ZLIB_OFFER: "zlib", SESSION_OFFER: "session",
+          HEARTBEAT_OFFER: "heartbeat"}
+RESUME_SEPARATOR = "\x1b"  # between the username and the session to resume
+ACK_PREFIX = b"\x1e\x1fFRAMED"
+FRAMING_ACK = ACK_PREFIX + b"\n"
+MAX_ACK_SIZE = 64
+
+# Compact mode frame types
+TEXT = 0  # UTF-8 text
+CHAT = 1  # varint sender id, varint room id (0 = default room), varint Unix time, UTF-8 body
+NAME = 2  # varint id, UTF-8 username or room name
+SEEN = 3  # varint id of the last chat line written so far
+
+HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 64 * 1024
+
+PRESENCE_PREFIX = "PRESENCE: "
+ROSTER_CHUNK = 1000  # usernames per roster message, to stay well under MAX_FRAME_SIZE
+
+SESSION_PREFIX = "SESSION: "
+HEARTBEAT_PING = "HEARTBEAT: ping\n"
+PONG = "/pong"
+
+
+class ProtocolError(Exception):
+    """The peer sent something that is not valid framed data."""
+
+
+def encode_frame(data):
+    """Prefix a payload with its length."""
+    if len(data) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {len(data)} bytes exceeds {MAX_FRAME_SIZE}")
+    return HEADER.pack(len(data)) + data
+
+
+def offer_framing(username, compact=False, compress=False, session=None, heartbeat=False):
+    """Encode a username together with the framing offer and any extras.
+
+    session is the client's Session: sessions are offered, and if the
+    server has given it a token, the login resumes that session.
+    heartbeat offers to answer pings.
+    """
+    if session is not None and session.token:
+        username += f"{RESUME_SEPARATOR}{session.token} {session.last_seen}"
+    data = username.encode('utf-8') + FRAMING_OFFER
+    if compact:
+        data += COMPACT_OFFER
+    if compress:
+        data += ZLIB_OFFER
+    if session is not None:
+        data += SESSION_OFFER
+    if heartbeat:
+        data += HEARTBEAT_OFFER
+    return data
+
+
+def parse_login(data):
+    """Split a login line into (username, wants_framing, set of extras offered)."""
+    extras = set()
+    while data[-1:] in OFFERS:
+        extras.add(OFFERS[data[-1:]])
+        data = data[:-1]
+    wants_framing = data.endswith(FRAMING_OFFER)
+    if wants_framing:
+        data = data[:-len(FRAMING_OFFER)]
+    else:
+        extras.clear()
+    return data.decode('utf-8').strip(), wants_framing, extras
+
+
+def split_resume(username):
+    """Split a login username into (username, token, last seen id); token is None for a new login."""
+    username, _, resume = username.partition(RESUME_SEPARATOR)
+    token, _, last_seen = resume.partition(" ")
+    try:
+        return username.strip(), token or None, int(last_seen or 0)
+    except ValueError:
+        return username.strip(), None, 0
+
+
+def framing_ack(extras=()):
+    """The acknowledgement naming the extras the server accepted."""
+    if not extras:
+        return FRAMING_ACK
+    return ACK_PREFIX + b"".join(b" " + extra.encode('ascii') for extra in sorted(extras)) + b"\n"
+
+
+def format_chat(timestamp, username, body, room=None):
+    """Format a chat line; room is None for the default room."""
+    if room is None:
+        return f"[{timestamp}] {username}: {body}\n"
+    return f"[{timestamp}] #{room} {username}: {body}\n"
+
+
+def encode_varint(value):
+    """Encode a non-negative integer 7 bits per byte, low bits first."""
+    out = bytearray()
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def decode_varint(data, offset):
+    """Decode a varint at offset; returns (value, offset after it)."""
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(data):
+            raise ProtocolError("Truncated varint")
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+class ChatFrame(bytes):
+    """An encoded chat line plus its message id, for the SEEN marks of session clients."""
+    message_id = None
+
+
+class CompactFrame(ChatFrame):
+    """A framed compact message plus the NAME frames it refers to.
+
+    names is a tuple of (id, framed NAME frame); the writer of each
+    connection sends the ones that connection has not seen yet.
+    """
+    names = ()
+
+
+def encode_text(data):
+    """Frame UTF-8 text as a compact TEXT frame."""
+    return encode_frame(bytes((TEXT,)) + data)
+
+
+def seen_frame(message_id, compact):
+    """Tell a session client which chat lines it has been sent, framed for its mode."""
+    if compact:
+        return encode_frame(bytes((SEEN,)) + encode_varint(message_id))
+    return encode_frame(f"{SESSION_PREFIX}seen {message_id}\n".encode('utf-8'))
+
+
+def session_start(token, last_id):
+    return f"{SESSION_PREFIX}start {last_id} {token}\n"
+
+
+def session_token(token):
+    return f"{SESSION_PREFIX}token {token}\n"
+
+
+class NameTable:
+    """Ids for the usernames and room names used in compact CHAT frames.
+
+    Ids are shared by every connection of the process and never reused.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}  # name -> (id, framed NAME frame)
+
+    def intern(self, name):
+        entry = self.entries.get(name)
+        if entry is None:
+            with self.lock:
+                entry = self.entries.get(name)
+                if entry is None:
+                    name_id = len(self.entries) + 1
+                    payload = bytes((NAME,)) + encode_varint(name_id) + name.encode('utf-8')
+                    entry = self.entries[name] = (name_id, encode_frame(payload))
+        return entry
+
+    def export(self):
+        """[name, id] pairs, for handing the table to a new process."""
+        return [[name, entry[0]] for name, entry in list(self.entries.items())]
+
+    def restore(self, pairs):
+        """Take over the ids of an exported table; call before any intern()."""
+        for name, name_id in sorted(pairs, key=lambda pair: pair[1]):
+            payload = bytes((NAME,)) + encode_varint(name_id) + name.encode('utf-8')
+            self.entries[name] = (name_id, encode_frame(payload))
+
+    def encode_chat(self, username, room, timestamp, body):
+        """Encode a chat line once for every compact recipient; room is None for the default room."""
+        sender = self.intern(username)
+        names = (sender,)
+        room_id = 0
+        if room is not None:
+            entry = self.intern(room)
+            room_id = entry[0]
+            names += (entry,)
+        payload = b"".join((bytes((CHAT,)), encode_varint(sender[0]), encode_varint(room_id),
+                            encode_varint(int(timestamp)), body.encode('utf-8')))
+        frame = CompactFrame(encode_frame(payload))
+        frame.names = names
+        return frame
+
+
+class CompactDecoder:
+    """Client side of the compact encoding: turns frames back into text lines."""
+
+    def __init__(self):
+        self.names = {}  # id -> name
+        self.seen = None  # id from the last SEEN frame
+
+    def decode(self, payload):
+        """Return the text of a compact frame, or None for a NAME or SEEN frame."""
+        if not payload:
+            raise ProtocolError("Empty compact frame")
+        kind = payload[0]
+        if kind == TEXT:
+            return payload[1:].decode('utf-8')
+        if kind == NAME:
+            name_id, offset = decode_varint(payload, 1)
+            self.names[name_id] = payload[offset:].decode('utf-8')
+            return None
+        if kind == SEEN:
+            self.seen, _ = decode_varint(payload, 1)
+            return None
+        if kind == CHAT:
+            sender, offset = decode_varint(payload, 1)
+            room_id, offset = decode_varint(payload, offset)
+            timestamp, offset = decode_varint(payload, offset)
+            try:
+                username = self.names[sender]
+                room = self.names[room_id] if room_id else None
+            except KeyError:
+                raise ProtocolError("Chat frame refers to an undefined name")
+            return format_chat(time.strftime("%H:%M", time.localtime(timestamp)),
+                               username, payload[offset:].decode('utf-8'), room)
+        raise ProtocolError(f"Unknown compact frame type {kind}")
+
+
+def roster_messages(usernames):
+    """Encode a full roster as one or more PRESENCE messages."""
+    usernames = sorted(usernames)
+    messages = [f"{PRESENCE_PREFIX}roster {json.dumps(usernames[:ROSTER_CHUNK])}\n"]
+    for start in range(ROSTER_CHUNK, len(usernames), ROSTER_CHUNK):
+        chunk = usernames[start:start + ROSTER_CHUNK]
+        messages.append(f"{PRESENCE_PREFIX}more {json.dumps(chunk)}\n")
+    return messages
+
+
+def presence_message(username, joined):
+    """Encode a single user coming online or going offline."""
+    return f"{PRESENCE_PREFIX}{'join' if joined else 'leave'} {username}\n"
+
+
+def parse_presence(line):
+    """Decode a PRESENCE line into (kind, usernames), or None for other lines."""
+    if not line.startswith(PRESENCE_PREFIX):
+        return None
+    kind, _, rest = line[len(PRESENCE_PREFIX):].rstrip('\n').partition(" ")
+    if kind in ("roster", "more"):
+        try:
+            return kind, json.loads(rest)
+        except ValueError:
+            return None
+    if kind in ("join", "leave"):
+        return kind, [rest]
+    return None
+
+
+class FrameDecoder:
+    """Reassemble length-prefixed frames from an arbitrary stream of chunks."""
+    __slots__ = ('max_frame_size', 'buffer')
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Add received bytes and return every payload completed by them."""
+        self.buffer += data
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= HEADER.size:
+            (length,) = HEADER.unpack_from(self.buffer, offset)
+            if length > self.max_frame_size:
+                raise ProtocolError(f"Frame of {length} bytes exceeds {self.max_frame_size}")
+            end = offset + HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            frames.append(bytes(self.buffer[offset + HEADER.size:end]))
+            offset = end
+        if offset:
+            del self.buffer[:offset]
+        return frames
+
+
+class Session:
+    """What a client needs to resume: the server's token and the last chat line it saw.
+
+    Outlives connections; every reconnect gets a new MessageReader with
+    the same Session.
+    """
+
+    def __init__(self):
+        self.token = None
+        self.last_seen = 0
+
+    def update(self, line):
+        """Apply a SESSION line from the server."""
+        kind, _, rest = line[len(SESSION_PREFIX):].rstrip('\n').partition(" ")
+        if kind == "start":
+            last_seen, _, self.token = rest.partition(" ")
+            self.last_seen = int(last_seen)
+        elif kind == "token":
+            self.token = rest
+        elif kind == "seen":
+            self.last_seen = max(self.last_seen, int(rest))
+
+
+class MessageReader:
+    """Client-side receive path: raw chunks until framing is acknowledged.
+
+    SESSION lines update session and heartbeat pings set ping_due instead
+    of being returned.
+    """
+
+    def __init__(self, session=None):
+        self.session = session
+        self.ping_due = False  # the server pinged us; the owner answers with PONG
+        self.framed = False
+        self.compact = None  # a CompactDecoder once compact mode is acknowledged
+        self.inflater = None  # a zlib decompressor once compression is acknowledged
+        self.negotiating = False
+        self.prompt_seen = False
+        self.pending = b""
+        self.decoder = FrameDecoder()
+
+    def expect_ack(self):
+        """Call just before sending a login that carries FRAMING_OFFER."""
+        self.negotiating = True
+
+    def feed(self, data):
+        """Return the messages contained in a received chunk, as text."""
+        data = self.pending + data
+        self.pending = b""
+        messages = []
+
+        # The prompt may share a chunk with the server's answer to our login
+        # if we logged in before reading it
+        if not self.prompt_seen:
+            prompt = PROMPT.encode('utf-8')
+            if data.startswith(prompt):
+                messages.append(PROMPT)
+                data = data[len(prompt):]
+            elif prompt.startswith(data):
+                # Not enough bytes yet to tell
+                self.pending = data
+                return messages
+            self.prompt_seen = True
+
+        if self.negotiating and data:
+            end = data.find(b"\n", 0, MAX_ACK_SIZE)
+            if data.startswith(ACK_PREFIX) and end >= 0:
+                self.accept(data[len(ACK_PREFIX):end].split())
+                data = data[end + 1:]
+            elif ACK_PREFIX.startswith(data) or (data.startswith(ACK_PREFIX)
+                                                 and len(data) < MAX_ACK_SIZE):
+                self.pending = data
+                return messages
+            else:
+                # Server does not speak framing; stay in raw mode
+                self.negotiating = False
+
+        if self.inflater:
+            data = self.inflater.decompress(data)
+        if self.compact:
+            for frame in self.decoder.feed(data):
+                text = self.compact.decode(frame)
+                if text is not None:
+                    messages.append(text)
+            if self.compact.seen is not None and self.session:
+                self.session.last_seen = max(self.session.last_seen, self.compact.seen)
+        elif self.framed:
+            messages.extend(frame.decode('utf-8') for frame in self.decoder.feed(data))
+        elif data:
+            messages.append(data.decode('utf-8'))
+        if self.framed:
+            # Session lines and pings are always frames of their own
+            kept = []
+            for message in messages:
+                if message == HEARTBEAT_PING:
+                    self.ping_due = True
+                elif message.startswith(SESSION_PREFIX) and self.session:
+                    self.session.update(message)
+                else:
+                    kept.append(message)
+            messages = kept
+        return messages
+
+    def accept(self, extras):
+        """Switch to the modes named in the server's acknowledgement."""
+        self.negotiating = False
+        self.framed = True
+        if b"compact" in extras:
+            self.compact = CompactDecoder()
+        if b"zlib" in extras:
+            self.inflater = zlib.decompressobj()
+
+    def encode(self, message):
+        """Encode an outgoing message for the negotiated mode."""
+        data = message.encode('utf-8')
+        return encode_frame(data) if self.framed else data
@@ -2,25 +2,46 @@
 import socket
 import threading
 import sys
+import time
 import argparse
 
+import backoff
+import heartbeat
+import protocol
+import tls
+
 # Client configuration
 DEFAULT_HOST = '127.0.0.1'
 DEFAULT_PORT = 8888
 BUFFER_SIZE = 2048
+NEGOTIATION_TIMEOUT = 5.0  # seconds to wait for the server to answer the login
 
 class ChatClient:
-    def __init__(self, host, port):
+    def __init__(self, host, port, use_framing=True, compact=True, compress=False, reconnect=True,
+                 tls_context=None):
         self.host = host
         self.port = port
+        self.use_framing = use_framing
+        self.compact = compact
+        self.compress = compress
+        self.reconnect_enabled = reconnect
+        self.tls_context = tls_context
+        self.tls_session = None  # resumed on reconnect, skipping most of the handshake
         self.socket = None
+        self.send_lock = threading.Lock()  # the receiving thread answers pings
         self.running = False
+        # Survives reconnects, so a new connection can resume where the old one stopped
+        self.session = protocol.Session() if use_framing else None
+        self.reader = protocol.MessageReader(self.session)
+        self.backoff = backoff.Backoff()
+        self.username = None
+        self.login_sent = False
+        self.negotiated = threading.Event()
     
     def connect(self):
         """Connect to the chat server."""
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((self.host, self.port))
+            self.open_connection()
             self.running = True
             
             print(f"Connected to server at {self.host}:{self.port}")
@@ -37,42 +58,153 @@ class ChatClient:
             print(f"Connection error: {e}")
             self.cleanup()
     
+    def open_connection(self):
+        """Open a new connection with a fresh receive state."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect((self.host, self.port))
+        except OSError:
+            sock.close()
+            raise
+        heartbeat.set_keepalive(sock)
+        if self.tls_context is not None:
+            try:
+                sock = self.tls_context.wrap_socket(sock, server_hostname=self.host,
+                                                    session=self.tls_session)
+            except OSError:
+                sock.close()
+                raise
+            # Our receiving thread and the input loop share it
+            sock = tls.SerializedSocket(sock)
+        self.reader = protocol.MessageReader(self.session)
+        self.login_sent = False
+        self.socket = sock
+    
     def receive_messages(self):
         """Receive and display messages from the server."""
         while self.running:
             try:
                 data = self.socket.recv(BUFFER_SIZE)
-                if not data:
-                    print("Disconnected from server")
+                messages = self.reader.feed(data)
+            except Exception as e:
+                if not self.running:
+                    break
+                # A bad frame or undecodable text leaves the stream unusable, so reconnect
+                print(f"Error receiving message: {e}")
+                data = b""
+            
+            if not data:
+                print("Disconnected from server")
+                self.negotiated.clear()
+                if not (self.running and self.reconnect_enabled and self.reconnect()):
                     self.running = False
+                    self.negotiated.set()
                     break
-                
-                message = data.decode('utf-8')
+                continue
+            
+            for message in messages:
+                # After a reconnect we log in without asking
+                if message == protocol.PROMPT and self.username is not None:
+                    continue
                 print(message, end='')
-                
-            except Exception as e:
-                print(f"Error receiving message: {e}")
-                self.running = False
+            
+            if self.reader.ping_due:
+                self.reader.ping_due = False
+                try:
+                    self.send(self.reader.encode(protocol.PONG))
+                except OSError:
+                    pass  # the next recv() notices
+            
+            # The server has answered our login, framed or not
+            if self.login_sent and not self.reader.negotiating and not self.negotiated.is_set():
+                self.backoff.reset()
+                self.negotiated.set()
+    
+    def reconnect(self):
+        """Reconnect after a growing, randomized delay and log back in as the same user.
+        
+        Returns False if the client exited meanwhile.
+        """
+        self.tls_session = tls.client_session(self.socket) or self.tls_session
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+        while self.running:
+            delay = self.backoff.next_delay()
+            print(f"Reconnecting in {delay:.1f}s...")
+            time.sleep(delay)
+            if not self.running:
                 break
+            try:
+                self.open_connection()
+            except OSError as e:
+                print(f"Reconnect failed: {e}")
+                continue
+            
+            resumed = " (TLS session resumed)" if getattr(self.socket, 'session_reused', False) else ""
+            print(f"Reconnected to server at {self.host}:{self.port}{resumed}")
+            if self.username is not None:
+                # No need to ask again; resumes the session if the server gave us one
+                self.send_login(self.username)
+            return True
+        return False
     
     def send_messages(self):
         """Send messages to the server."""
         try:
+            # The first line is our username
+            self.login(input())
+            
             while self.running:
                 message = input()
                 
                 if message == "/exit":
                     self.running = False
-                    self.socket.send(message.encode('utf-8'))
+                    self.send(self.reader.encode(message))
                     break
                 
-                self.socket.send(message.encode('utf-8'))
+                if not self.negotiated.is_set():
+                    print("Not connected to the server; message not sent")
+                    continue
+                
+                try:
+                    self.send(self.reader.encode(message))
+                except protocol.ProtocolError:
+                    print("Message too long; not sent")
+                except OSError as e:
+                    # The receiving thread reconnects
+                    print(f"Message not sent: {e}")
                 
         except Exception as e:
             print(f"Error sending message: {e}")
         finally:
             self.cleanup()
     
+    def login(self, username):
+        """Send our username and wait until the server has answered."""
+        self.send_login(username)
+        
+        # Don't send anything else until we know which mode the server chose
+        self.negotiated.wait(NEGOTIATION_TIMEOUT)
+    
+    def send_login(self, username):
+        """Send our username, offering the framed protocol if enabled."""
+        self.username = username
+        if self.use_framing:
+            self.reader.expect_ack()
+            data = protocol.offer_framing(username, self.compact, self.compress, self.session,
+                                          heartbeat=True)
+        else:
+            data = username.encode('utf-8')
+        self.login_sent = True
+        self.send(data)
+    
+    def send(self, data):
+        """Send data without interleaving it with a pong from the receiving thread."""
+        with self.send_lock:
+            self.socket.sendall(data)
+    
     def cleanup(self):
         """Close the connection and cleanup."""
         self.running = False
@@ -88,10 +220,28 @@ def main():
     parser = argparse.ArgumentParser(description='Chat Client')
     parser.add_argument('--host', default=DEFAULT_HOST, help='Server IP address')
     parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='Server port')
+    parser.add_argument('--protocol', choices=['compact', 'framed', 'raw'], default='compact',
+                        help='compact: offer binary chat frames (falls back to framed, then raw); '
+                             'framed: offer length-prefixed text; raw: never offer')
+    parser.add_argument('--compress', action='store_true',
+                        help='Offer zlib compression of everything the server sends')
+    parser.add_argument('--no-reconnect', action='store_true',
+                        help='Exit when the connection drops instead of reconnecting')
+    parser.add_argument('--tls', action='store_true', help='Connect with TLS')
+    parser.add_argument('--tls-ca', default=None,
+                        help="PEM file of the CA (or self-signed certificate) to trust for the server's certificate")
+    parser.add_argument('--tls-insecure', action='store_true',
+                        help="Don't verify the server's certificate (testing only)")
     args = parser.parse_args()
     
+    tls_context = None
+    if args.tls or args.tls_ca or args.tls_insecure:
+        tls_context = tls.client_context(args.tls_ca, verify=not args.tls_insecure)
+    
     # Create and run the client
-    client = ChatClient(args.host, args.port)
+    client = ChatClient(args.host, args.port, use_framing=args.protocol != 'raw',
+                        compact=args.protocol == 'compact', compress=args.compress,
+                        reconnect=not args.no_reconnect, tls_context=tls_context)
     client.connect()
 
 if __name__ == "__main__":
@@ -1,134 +1,447 @@
 #!/usr/bin/env python3
+import argparse
+import os
+import selectors
+import signal
 import socket
 import threading
 import time
 
+import admission
+import batching
+import chat_core
+import console
+import handoff
+import heartbeat
+import history
+import metrics
+import outbound
+import protocol
+import ratelimit
+import relay
+import search
+import sessions
+import tls
+
 # Server configuration
 HOST = '127.0.0.1'  # localhost
 PORT = 8888
 MAX_CLIENTS = 100
+LISTEN_BACKLOG = 1024
+ACCEPT_BATCH = 64  # connections accepted per wakeup of the accept loop
+ACCEPT_ERROR_DELAY = 0.1  # seconds to back off when accept() fails, e.g. out of descriptors
 BUFFER_SIZE = 2048
+FRAMED_RECV_SIZE = 64 * 1024
+WRITER_JOIN_TIMEOUT = 1.0  # seconds a closing client gets to flush its queue
+GOODBYE = "SERVER: Server is shutting down. Goodbye!\n"
+RESTART_GOODBYE = "SERVER: Server is restarting. Please reconnect.\n"
+SERVER_FULL = "Server is full. Try again later."
 
-# Connected clients and their usernames
-clients_lock = threading.Lock()
-clients = {}  # socket -> username
-
-def broadcast(message, sender_socket=None):
-    """Send a message to all connected clients except the sender."""
-    with clients_lock:
-        for client_socket, username in clients.items():
-            # Don't send the message back to the sender
-            if client_socket != sender_socket:
-                try:
-                    client_socket.send(message.encode('utf-8'))
-                except:
-                    # Client probably disconnected
-                    continue
+class Shutdown(Exception):
+    """Raised in the accept loop by SIGTERM."""
+
+class Restart(Shutdown):
+    """Raised in the accept loop by SIGUSR2."""
+
+class ThreadClient(chat_core.Client):
+    """A connected client served by a reader thread and a writer thread."""
+    __slots__ = ('socket', 'writer_thread')
+    
+    def __init__(self, client_socket, addr):
+        super().__init__(addr)
+        self.socket = client_socket
+        self.writer_thread = threading.Thread(target=self.write_loop)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+    
+    def read_messages(self):
+        """Yield incoming messages until the client disconnects."""
+        while True:
+            # Framed clients can pipeline, so read as much as is available
+            data = self.socket.recv(FRAMED_RECV_SIZE if self.framed else BUFFER_SIZE)
+            if not data:  # Client disconnected
+                return
+            yield from self.parse(data)
+    
+    def write_loop(self):
+        """Drain the outbound queue; only this thread ever blocks on send."""
+        while True:
+            batch = self.outbound.wait()
+            if batch is None:
+                break
+            try:
+                buffers = self.outgoing(batch)
+                metrics.write_calls.inc(outbound.send_vectored(self.socket, buffers))
+                metrics.bytes_out.inc(sum(map(len, buffers)))
+            except OSError:
+                # Client probably disconnected
+                self.kick()
+                break
+    
+    def kick(self):
+        """Disconnect the client; its reader thread then runs the normal cleanup."""
+        self.outbound.close()
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    
+    def close(self, timeout=WRITER_JOIN_TIMEOUT):
+        """Flush what is still queued, then close the socket."""
+        self.outbound.close()
+        if threading.current_thread() is not self.writer_thread:
+            self.writer_thread.join(timeout)
+        self.socket.close()
 
-def handle_client(client_socket, addr):
+def tls_handshake(client_socket, addr, context):
+    """Run the TLS handshake on the client's own thread; returns the wrapped socket or None."""
+    try:
+        # The handshake and the session tickets after it are several small
+        # writes in a row, which Nagle's algorithm would hold back
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client_socket.settimeout(chat_core.login_timeout)
+        tls_socket = context.wrap_socket(client_socket, server_side=True)
+    except OSError as e:
+        console.log(f"TLS handshake with {addr} failed: {e}")
+        client_socket.close()
+        return None
+    return tls.SerializedSocket(tls_socket)
+
+def handle_client(client_socket, addr, tls_context=None):
     """Handle a client connection."""
-    print(f"New connection from {addr}")
+    if tls_context is not None:
+        client_socket = tls_handshake(client_socket, addr, tls_context)
+        if client_socket is None:
+            chat_core.admission_control.handshake_done()
+            return
+    console.log(f"New connection from {addr}")
+    client = ThreadClient(client_socket, addr)
     
     # Ask for username
+    handshaking = True
     try:
-        client_socket.send("Please enter your username: ".encode('utf-8'))
-        username_bytes = client_socket.recv(BUFFER_SIZE)
+        chat_core.send(client, protocol.PROMPT)
+        try:
+            # A connection that never logs in must not hold its slot forever
+            client_socket.settimeout(chat_core.login_timeout)
+            username_bytes = client_socket.recv(BUFFER_SIZE)
+            client_socket.settimeout(None)
+        except socket.timeout:
+            console.log(f"{addr} did not log in within {chat_core.login_timeout} seconds")
+            username_bytes = b""
         if not username_bytes:
+            client.close()
             return
         
-        username = username_bytes.decode('utf-8').strip()
-        if not username:
-            username = f"User-{addr[0]}"
-        
-        # Register the client
-        with clients_lock:
-            clients[client_socket] = username
-        
-        # Welcome message
-        welcome_msg = f"Welcome {username}! You are now connected to the chat server.\n"
-        client_socket.send(welcome_msg.encode('utf-8'))
-        
-        # Notify others
-        broadcast(f"SERVER: {username} has joined the chat.\n", client_socket)
-        print(f"{username} has joined the chat")
+        chat_core.login(client, username_bytes)
+        # Only now is it counted as a client, so a burst can't slip past admission meanwhile
+        handshaking = False
+        chat_core.admission_control.handshake_done()
         
         # Main loop
-        while True:
-            try:
-                data = client_socket.recv(BUFFER_SIZE)
-                if not data:  # Client disconnected
-                    break
-                
-                message = data.decode('utf-8').strip()
-                if message == "/exit":
+        try:
+            for message in client.read_messages():
+                wait = chat_core.admit(client, message)
+                if wait is None:
+                    continue
+                if wait:
+                    # Not reading meanwhile pushes back on the sender
+                    time.sleep(wait)
+                if not chat_core.handle_message(client, message):
                     break
-                
-                # Format message with timestamp and username
-                timestamp = time.strftime("%H:%M", time.localtime())
-                formatted_message = f"[{timestamp}] {username}: {message}\n"
-                
-                # Broadcast to everyone
-                broadcast(formatted_message, client_socket)
-                print(formatted_message.strip())
-                
-            except Exception as e:
-                print(f"Error handling client {username}: {e}")
-                break
+        except Exception as e:
+            console.log(f"Error handling client {client.username}: {e}")
         
         # Client is disconnecting
-        with clients_lock:
-            if client_socket in clients:
-                del clients[client_socket]
-        
-        broadcast(f"SERVER: {username} has left the chat.\n")
-        print(f"{username} has left the chat")
-        client_socket.close()
+        chat_core.logout(client)
+        client.close()
         
     except Exception as e:
         print(f"Error: {e}")
-        client_socket.close()
+        chat_core.logout(client)
+        client.close()
+    finally:
+        if handshaking:
+            chat_core.admission_control.handshake_done()
+
+def refuse(client_socket, addr, reason, explain=True):
+    """Turn a connection away without starting any threads for it.
+
+    Without explain it is just closed, as a TLS client could not read why.
+    """
+    console.log(f"Refused connection from {addr}: {reason}")
+    if explain:
+        try:
+            client_socket.send(SERVER_FULL.encode('utf-8'))
+        except OSError:
+            pass
+    client_socket.close()
+
+def accept_batch(server, tls_context=None):
+    """Accept everything waiting on the listening socket, up to ACCEPT_BATCH connections."""
+    for _ in range(ACCEPT_BATCH):
+        try:
+            client_socket, addr = server.accept()
+        except BlockingIOError:
+            return
+        except OSError as e:
+            # Out of descriptors or buffers: leave the rest in the backlog for now
+            console.log(f"Accepting connections failed: {e}")
+            time.sleep(ACCEPT_ERROR_DELAY)
+            return
+        # Accepted sockets inherit non-blocking mode on some platforms
+        client_socket.setblocking(True)
+        if chat_core.keepalive_idle:
+            heartbeat.set_keepalive(client_socket, chat_core.keepalive_idle)
+        
+        reason = chat_core.admission_control.check()
+        if reason:
+            refuse(client_socket, addr, reason, explain=tls_context is None)
+            continue
+        
+        # Create a new thread to handle the client; it also runs any TLS handshake
+        client_thread = threading.Thread(target=handle_client, args=(client_socket, addr, tls_context))
+        client_thread.daemon = True
+        client_thread.start()
+
+def run_heartbeat(monitor):
+    """Check on silent clients every heartbeat tick."""
+    while True:
+        time.sleep(heartbeat.TICK)
+        monitor.tick()
+
+def drain(goodbye):
+    """Say goodbye and give every client's writer until the drain deadline to flush."""
+    if chat_core.bus:
+        # Peers leaving now are no news
+        chat_core.bus.stop()
+    chat_core.flush_broadcasts()
+    connected = chat_core.recipients()
+    for client in connected:
+        chat_core.send(client, goodbye)
+        client.outbound.close()
+    deadline = time.monotonic() + chat_core.drain_timeout
+    for client in connected:
+        try:
+            client.close(max(0, deadline - time.monotonic()))
+        except OSError:
+            pass
 
-def start_server():
-    """Start the chat server."""
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+def raise_on_signal(signum, exception):
+    """Make a signal interrupt the accept loop with an exception."""
+    def handler(received, frame):
+        raise exception()
+    if signum is not None:
+        signal.signal(signum, handler)
+
+def start_server(host=HOST, port=PORT, max_clients=MAX_CLIENTS, reuse_port=False,
+                 backlog=LISTEN_BACKLOG, tls_context=None):
+    """Start the chat server; clients must use TLS if a tls_context is given."""
+    if chat_core.admission_control is None:
+        chat_core.admission_control = admission.AdmissionControl(max_clients)
+    listeners = handoff.inherited_listeners()
+    if listeners:
+        # Hot restart: the old process kept the port open for us
+        server = listeners[0]
+    else:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Pre-fork mode: every worker listens on the same port
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    
+    raise_on_signal(getattr(signal, 'SIGTERM', None), Shutdown)
+    if not chat_core.bus:
+        # Pre-fork workers share the port with their siblings; restart the whole cluster instead
+        raise_on_signal(getattr(signal, 'SIGUSR2', None), Restart)
+    goodbye = GOODBYE
+    restart = False
     
     try:
-        server.bind((HOST, PORT))
-        server.listen(5)
-        print(f"Server started on {HOST}:{PORT}")
+        if not listeners:
+            server.bind((host, port))
+            server.listen(backlog)
+        print(f"Server started on {host}:{port}" + (" (TLS)" if tls_context else ""))
         print("Waiting for connections...")
         
+        if chat_core.batcher:
+            chat_core.batcher.schedule = batching.TimerThread().call_later
+        if chat_core.bus:
+            chat_core.bus.start()
+        if chat_core.heartbeat_monitor:
+            ticker = threading.Thread(target=run_heartbeat, args=(chat_core.heartbeat_monitor,))
+            ticker.daemon = True
+            ticker.start()
+        
+        # Wait for connections, then take every one that is waiting at once
+        server.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(server, selectors.EVENT_READ)
         while True:
-            client_socket, addr = server.accept()
-            
-            # Check if server is full
-            with clients_lock:
-                if len(clients) >= MAX_CLIENTS:
-                    client_socket.send("Server is full. Try again later.".encode('utf-8'))
-                    client_socket.close()
-                    continue
-            
-            # Create a new thread to handle the client
-            client_thread = threading.Thread(target=handle_client, args=(client_socket, addr))
-            client_thread.daemon = True
-            client_thread.start()
+            selector.select()
+            accept_batch(server, tls_context)
             
-    except KeyboardInterrupt:
+    except Restart:
+        print("Restarting server...")
+        goodbye = RESTART_GOODBYE
+        restart = True
+    except (KeyboardInterrupt, Shutdown):
         print("\nShutting down server...")
-        broadcast("SERVER: Server is shutting down. Goodbye!")
     except Exception as e:
         print(f"Server error: {e}")
     finally:
-        # Close all connections
-        with clients_lock:
-            for client in clients:
-                try:
-                    client.close()
-                except:
-                    pass
+        # Close all connections, giving writers until the drain deadline to flush the goodbye
+        drain(goodbye)
+        if restart:
+            # This engine cannot hand over live clients, only the listening
+            # socket, so connection attempts queue up instead of being refused
+            chat_core.history_store.flush(chat_core.drain_timeout)
+            metrics.stop_http_server()
+            try:
+                process, _ = handoff.spawn_successor([server])
+                print(f"Handed the listening socket to process {process.pid}")
+            except handoff.HandoffError as e:
+                print(f"Hot restart failed: {e}")
         server.close()
+        console.flush()
+        chat_core.print_policy_stats()
         print("Server closed")
 
+def main():
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='Chat Server')
+    parser.add_argument('--host', default=HOST, help='Address to listen on')
+    parser.add_argument('--port', type=int, default=PORT, help='Port to listen on')
+    parser.add_argument('--engine', choices=['thread', 'asyncio'], default='thread',
+                        help='thread: one thread per client; asyncio: single-threaded event loop')
+    parser.add_argument('--max-clients', type=int, default=MAX_CLIENTS,
+                        help='Maximum number of connected clients')
+    parser.add_argument('--max-memory', type=float, default=None,
+                        help='Refuse new connections while resident memory is above this many MB')
+    parser.add_argument('--max-backlog', type=float, default=None,
+                        help='Refuse new connections while more than this many MB are queued for clients')
+    parser.add_argument('--max-loop-lag', type=float, default=None,
+                        help='Refuse new connections while the asyncio event loop runs this many seconds late')
+    parser.add_argument('--backlog', type=int, default=LISTEN_BACKLOG,
+                        help='Connections the kernel queues until they are accepted')
+    parser.add_argument('--login-timeout', type=float, default=chat_core.login_timeout,
+                        help='Seconds a new connection gets to send its username; 0 waits forever')
+    parser.add_argument('--relay-port', type=int, default=None,
+                        help='Accept relay links from other servers on this port (relay mode)')
+    parser.add_argument('--peer', action='append', default=[], metavar='HOST:PORT',
+                        help="Link to another server's relay port; may be given more than once")
+    parser.add_argument('--relay-name', default=None,
+                        help='Name of this server in relay mode (default: HOST:PORT)')
+    parser.add_argument('--tls-cert', default=None,
+                        help='PEM certificate chain; clients must then connect with TLS')
+    parser.add_argument('--tls-key', default=None,
+                        help='PEM private key, if not in the --tls-cert file')
+    parser.add_argument('--heartbeat', type=float, default=heartbeat.DEFAULT_INTERVAL,
+                        help='Seconds of silence before a client is pinged; 0 disables heartbeats')
+    parser.add_argument('--heartbeat-timeout', type=float, default=heartbeat.DEFAULT_TIMEOUT,
+                        help='Seconds a pinged client has to answer before it is disconnected')
+    parser.add_argument('--keepalive', type=int, default=chat_core.keepalive_idle,
+                        help='Seconds of silence before TCP keepalive probes a connection; 0 disables them')
+    parser.add_argument('--batch-ms', type=float, default=0,
+                        help='Hold room messages this many milliseconds and send each member the batch '
+                             'in one write (trades latency for throughput in busy rooms; 0 disables)')
+    parser.add_argument('--batch-bytes', type=int, default=batching.DEFAULT_MAX_BYTES,
+                        help='Send a held batch at once when it reaches this many bytes')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes sharing the port (pre-fork mode, needs SO_REUSEPORT)')
+    parser.add_argument('--queue-size', type=int, default=outbound.DEFAULT_MAX_MESSAGES,
+                        help='Maximum messages queued for one client before the slow-consumer policy applies')
+    parser.add_argument('--queue-bytes', type=int, default=outbound.DEFAULT_MAX_BYTES,
+                        help='Maximum bytes queued for one client before the slow-consumer policy applies')
+    parser.add_argument('--slow-policy', choices=outbound.POLICIES, default=outbound.DROP_OLDEST,
+                        help='What to do when a client cannot keep up with its messages')
+    parser.add_argument('--rate-limit', type=float, default=None,
+                        help='Messages per second each connection may send (default: unlimited)')
+    parser.add_argument('--rate-burst', type=int, default=None,
+                        help='Messages a connection may send at once before --rate-limit applies')
+    parser.add_argument('--room-rate-limit', type=float, default=None,
+                        help='Chat messages per second each room accepts from all its members')
+    parser.add_argument('--room-rate-burst', type=int, default=None,
+                        help='Chat messages a room accepts at once before --room-rate-limit applies')
+    parser.add_argument('--throttle', choices=ratelimit.POLICIES, default=ratelimit.DELAY,
+                        help='What to do with a message over a rate limit')
+    parser.add_argument('--history-dir', default=None,
+                        help='Directory for the persistent message log (default: keep history in memory only)')
+    parser.add_argument('--history-size', type=int, default=history.RING_SIZE,
+                        help='Recent messages per room kept in memory')
+    parser.add_argument('--no-search', action='store_true',
+                        help="Don't index the history log for /search (saves memory)")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve Prometheus metrics over HTTP on this port (one port per worker, counting up)')
+    parser.add_argument('--no-compression', action='store_true',
+                        help='Refuse zlib compression even when clients offer it (saves server CPU)')
+    parser.add_argument('--drain-timeout', type=float, default=chat_core.drain_timeout,
+                        help='Seconds clients get to receive what is queued for them when the server stops')
+    parser.add_argument('--session-ttl', type=float, default=sessions.DEFAULT_TTL,
+                        help='Seconds a disconnected client can resume its session; 0 disables sessions')
+    parser.add_argument('--no-announce', action='store_true',
+                        help="Don't tell everyone when someone joins or leaves (for very large "
+                             "servers; /roster still reports it)")
+    parser.add_argument('--quiet', action='store_true',
+                        help="Don't print every chat message to the console")
+    args = parser.parse_args()
+    
+    chat_core.configure(args.queue_size, args.queue_bytes, args.slow_policy,
+                        compression=not args.no_compression, drain=args.drain_timeout,
+                        login=args.login_timeout, keepalive=args.keepalive,
+                        announce=not args.no_announce)
+    chat_core.admission_control = admission.AdmissionControl(
+        args.max_clients,
+        max_memory=args.max_memory and int(args.max_memory * 1024 * 1024),
+        max_backlog=args.max_backlog and int(args.max_backlog * 1024 * 1024),
+        max_loop_lag=args.max_loop_lag)
+    console.log_messages = not args.quiet
+    if args.rate_limit or args.room_rate_limit:
+        chat_core.rate_limiter = ratelimit.RateLimiter(args.rate_limit, args.rate_burst,
+                                                       args.room_rate_limit, args.room_rate_burst,
+                                                       args.throttle)
+    if args.session_ttl > 0:
+        # Set before forking workers or a hot restart, so they all accept each other's tokens
+        chat_core.session_tokens = sessions.SessionTokens(sessions.shared_key(), args.session_ttl)
+    # Created before forking, so pre-fork workers share session ticket keys
+    tls_context = tls.server_context(args.tls_cert, args.tls_key) if args.tls_cert else None
+    if args.relay_port is not None or args.peer:
+        if args.workers > 1:
+            parser.error("relay mode links single-process servers; it can't be combined with --workers")
+        chat_core.bus = relay.RelayBus(
+            args.relay_name or f"{args.host}:{args.port}",
+            listen=(args.host, args.relay_port) if args.relay_port is not None else None,
+            peers=[relay.parse_address(peer) for peer in args.peer])
+    if args.heartbeat > 0:
+        chat_core.heartbeat_monitor = heartbeat.Heartbeat(args.heartbeat, args.heartbeat_timeout,
+                                                          chat_core.ping, chat_core.time_out)
+    if args.batch_ms > 0:
+        chat_core.batcher = batching.RoomBatcher(args.batch_ms / 1000, args.batch_bytes,
+                                                 chat_core.flush_room)
+    
+    if args.engine == 'asyncio':
+        from async_server import start_async_server as start_engine
+    else:
+        start_engine = start_server
+    
+    def run(worker_id=None, reuse_port=False):
+        # Runs after fork() in pre-fork mode, so each worker starts its own
+        # history threads and keeps its own log
+        history_dir = args.history_dir
+        if history_dir and worker_id is not None:
+            history_dir = os.path.join(history_dir, f"worker-{worker_id}")
+        # Only a log keeps the messages a search finds; without one the index would just grow
+        index = search.SearchIndex() if history_dir and not args.no_search else None
+        chat_core.history_store = history.HistoryStore(history_dir, args.history_size, index=index)
+        if args.metrics_port is not None:
+            metrics.start_http_server(args.host, args.metrics_port + (worker_id or 0))
+        start_engine(args.host, args.port, args.max_clients, reuse_port, args.backlog, tls_context)
+    
+    if args.workers > 1:
+        from cluster import start_cluster
+        start_cluster(run, args.workers)
+    else:
+        run()
+
 if __name__ == "__main__":
-    start_server() 
\ No newline at end of file
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""Token-bucket rate limits on what clients send.
+
+Every connection can get its own bucket and every room shares one. A
+bucket refills at `rate` messages per second up to `burst`, and each
+received message takes a token from its connection's bucket and, if it
+is a chat line, from its room's. When a bucket is empty the configured
+policy decides what happens:
+
+- delay: the engine waits until the tokens are there before handling the
+  message, and does not read the socket meanwhile, so a flooding client
+  is slowed down by TCP backpressure instead of by the server's CPU
+- drop: the message is discarded
+- disconnect: the client is kicked
+"""
+import threading
+import time
+
+DELAY = 'delay'
+DROP = 'drop'
+DISCONNECT = 'disconnect'
+POLICIES = (DELAY, DROP, DISCONNECT)
+
+# Which limit throttled a message
+CONNECTION = 'connection'
+ROOM = 'room'
+
+MAX_IDLE_ROOMS = 1000  # full room buckets kept before they are forgotten
+
+# How many messages each limit throttled, across all clients in this process
+counters_lock = threading.Lock()
+counters = {(limit, policy): 0 for limit in (CONNECTION, ROOM) for policy in POLICIES}
+
+
+def count_throttled(limit, policy):
+    with counters_lock:
+        counters[(limit, policy)] += 1
+
+
+def throttle_stats():
+    """Return a copy of the throttled message counters."""
+    with counters_lock:
+        return dict(counters)
+
+
+class TokenBucket:
+    """Not thread-safe on its own; a connection's bucket is only used by its reader."""
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def wait_time(self, now):
+        """Seconds until a token is available; 0 if one is available now."""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def full(self, now):
+        return self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+
+class RateLimiter:
+    def __init__(self, rate=None, burst=None, room_rate=None, room_burst=None, policy=DELAY):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown throttle policy: {policy}")
+        self.rate = rate
+        self.burst = burst or max(1, rate or 0)
+        self.room_rate = room_rate
+        self.room_burst = room_burst or max(1, room_rate or 0)
+        self.policy = policy
+        self.lock = threading.Lock()  # guards the shared room buckets
+        self.rooms = {}  # room -> TokenBucket
+
+    def bucket(self):
+        """A new connection's bucket, or None without a per-connection limit."""
+        return TokenBucket(self.rate, self.burst) if self.rate else None
+
+    def _room_bucket(self, room, now):
+        bucket = self.rooms.get(room)
+        if bucket is None:
+            if len(self.rooms) >= MAX_IDLE_ROOMS:
+                # Forget rooms nobody has talked in for a while
+                for name in [name for name, b in self.rooms.items() if b.full(now)]:
+                    del self.rooms[name]
+            bucket = self.rooms[room] = TokenBucket(self.room_rate, self.room_burst)
+        return bucket
+
+    def check(self, bucket, room=None):
+        """Take the tokens for one message from a connection's bucket and a room's.
+
+        Returns (limit, wait): wait is 0 if the message may be handled now,
+        otherwise the seconds until it may, and limit says which bucket
+        was empty. Under the delay policy the tokens are taken anyway, so
+        later messages wait behind this one; otherwise a throttled message
+        takes nothing.
+        """
+        now = time.monotonic()
+        wait = bucket.wait_time(now) if bucket else 0
+        if room is None or not self.room_rate:
+            if bucket and (not wait or self.policy == DELAY):
+                bucket.tokens -= 1
+            return (CONNECTION if wait else None), wait
+
+        with self.lock:
+            room_bucket = self._room_bucket(room, now)
+            room_wait = room_bucket.wait_time(now)
+            if (not wait and not room_wait) or self.policy == DELAY:
+                if bucket:
+                    bucket.tokens -= 1
+                room_bucket.tokens -= 1
+        if not wait and not room_wait:
+            return None, 0
+        if wait >= room_wait:
+            return CONNECTION, wait
+        return ROOM, room_wait
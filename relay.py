@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+"""Relay mode: separate servers linked into one chat.
+
+Servers listen for relay links on --relay-port and dial the servers
+given with --peer, redialing with backoff when a link drops. A link is
+one TCP connection carrying length-prefixed JSON events both ways. As on
+the cluster bus, events are queued for each link and flushed by its
+writer with one vectored write, without waiting for the peer between
+them, and each event crosses each link once: the receiving server fans
+it out to its own clients.
+
+Servers need not all be linked to each other. Every event carries the
+server it started on (its origin, a name plus a random incarnation) and
+a sequence number from that server; a server applies and relays onward
+only events newer than the last it saw from their origin, and never its
+own, so events stop at servers that already have them instead of going
+around in circles.
+
+Who is online is tracked per origin. A new link starts with both sides
+sending a snapshot of every origin they know. A snapshot replaces an
+origin's presence but does not count as having seen its events, so chat
+lines still in flight over other links are delivered when they arrive,
+while the joins and leaves it already covers are not counted again.
+When a link drops, the users of the origins last heard through it
+leave, the server tells its other peers those origins are gone, and
+asks them for fresh snapshots in case the origins are still reachable
+some other way. Snapshots of a dropped origin are only believed once
+they are newer than what we knew, since a peer may answer before it
+has noticed the origin is gone itself; an event from the origin
+arriving later prompts a fresh snapshot from the peer that relayed it.
+"""
+import collections
+import json
+import os
+import socket
+import threading
+import time
+
+import backoff
+import chat_core
+import heartbeat
+import outbound
+import protocol
+from cluster import BUS_QUEUE_BYTES, BUS_QUEUE_MESSAGES, BUS_RECV_SIZE, decrement
+
+MAX_EVENT_SIZE = 16 * 1024 * 1024  # snapshots of busy servers are large
+
+
+def parse_address(text):
+    """Split HOST:PORT, with the host defaulting to localhost."""
+    host, _, port = text.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def frame(event):
+    payload = json.dumps(event).encode('utf-8')
+    return protocol.HEADER.pack(len(payload)) + payload
+
+
+class Link:
+    """A relay connection to another server, dialed or accepted."""
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.name = None  # the peer's origin, once it said hello
+        self.queue = outbound.OutboundQueue(BUS_QUEUE_MESSAGES, BUS_QUEUE_BYTES)
+
+
+class RelayBus:
+    """Links this server to its relay peers; stands in for the cluster bus."""
+
+    def __init__(self, name, listen=None, peers=()):
+        self.name = name
+        self.origin = f"{name}/{os.urandom(4).hex()}"
+        self.listen_address = listen  # (host, port) to accept links on, or None
+        self.peer_addresses = list(peers)
+        # Reentrant: the thread engine applies events, which query the bus, under it
+        self.lock = threading.RLock()
+        self.links = set()
+        self.seq = 0
+        self.local_users = collections.Counter()  # what we have told peers about our clients
+        self.local_rooms = collections.Counter()
+        self.seen = {}  # origin -> highest sequence number of the events received
+        self.synced = {}  # origin -> sequence number its presence was last snapshotted at
+        self.dropped = {}  # origin we stopped hearing from -> sequence number we knew it up to
+        self.routes = {}  # origin -> link its latest event came through
+        self.remote_users = {}  # origin -> Counter of usernames
+        self.remote_rooms = {}  # origin -> Counter of room members
+        self.dispatch = None
+
+    def start(self, dispatch=None):
+        """Start accepting and dialing links; dispatch works as for ClusterBus.start()."""
+        self.dispatch = dispatch or (lambda func, *args: func(*args))
+        if self.listen_address:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind(self.listen_address)
+            server.listen()
+            print(f"Relay links accepted on {self.listen_address[0]}:{self.listen_address[1]}")
+            self._spawn(self.accept_loop, server)
+        for address in self.peer_addresses:
+            self._spawn(self.dial_loop, address)
+
+    def stop(self):
+        """Stop handing relay events to the engine, which is shutting down."""
+        self.dispatch = lambda func, *args: None
+
+    def _spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    # Events from our own clients
+
+    def _publish(self, event):
+        """Send an event that starts here to every peer; call with the lock held."""
+        self.seq += 1
+        event["origin"] = self.origin
+        event["seq"] = self.seq
+        data = frame(event)
+        for link in self.links:
+            link.queue.put(data)
+
+    def publish_message(self, message, room=None, chat=None):
+        with self.lock:
+            self._publish({"type": "message", "text": message, "room": room, "chat": chat})
+
+    def publish_direct(self, username, message):
+        with self.lock:
+            self._publish({"type": "direct", "user": username, "text": message})
+
+    def publish_join(self, username):
+        """A client logged in here; it starts out in the default room."""
+        with self.lock:
+            self.local_users[username] += 1
+            self.local_rooms[chat_core.DEFAULT_ROOM] += 1
+            self._publish({"type": "join", "user": username})
+
+    def publish_leave(self, username, rooms):
+        with self.lock:
+            decrement(self.local_users, username)
+            for room in rooms:
+                decrement(self.local_rooms, room)
+            self._publish({"type": "leave", "user": username, "rooms": sorted(rooms)})
+
+    def publish_room_join(self, room):
+        with self.lock:
+            self.local_rooms[room] += 1
+            self._publish({"type": "room_join", "room": room})
+
+    def publish_room_leave(self, room):
+        with self.lock:
+            decrement(self.local_rooms, room)
+            self._publish({"type": "room_leave", "room": room})
+
+    # What chat_core asks about other servers
+
+    def remote_count(self):
+        """Clients that count against this server's limit; other servers admit their own."""
+        return 0
+
+    def remote_usernames(self):
+        with self.lock:
+            return [user for users in self.remote_users.values() for user in users.elements()]
+
+    def has_user(self, username):
+        """Whether a user is connected to another server."""
+        with self.lock:
+            return any(users[username] > 0 for users in self.remote_users.values())
+
+    def remote_room_counts(self):
+        """Members of each room on other servers."""
+        total = collections.Counter()
+        with self.lock:
+            for counts in self.remote_rooms.values():
+                total.update(counts)
+        return dict(total)
+
+    # Links
+
+    def accept_loop(self, server):
+        while True:
+            try:
+                sock, address = server.accept()
+            except OSError as e:
+                print(f"Accepting relay link failed: {e}")
+                time.sleep(1)
+                continue
+            self._spawn(self.run_link, sock, address)
+
+    def dial_loop(self, address):
+        """Keep a link to a peer up, redialing after a growing, randomized delay."""
+        delay = backoff.Backoff()
+        while True:
+            try:
+                sock = socket.create_connection(address)
+            except OSError:
+                time.sleep(delay.next_delay())
+                continue
+            delay.reset()
+            self.run_link(sock, address)
+            time.sleep(delay.next_delay())
+
+    def snapshot(self):
+        """Frames describing every origin we know; call with the lock held."""
+        frames = [frame({"type": "state", "origin": self.origin, "seq": self.seq,
+                         "users": dict(self.local_users), "rooms": dict(self.local_rooms)})]
+        for origin, users in self.remote_users.items():
+            frames.append(frame({"type": "state", "origin": origin, "seq": self.covered(origin),
+                                 "users": dict(users), "rooms": dict(self.remote_rooms[origin])}))
+        return frames
+
+    def covered(self, origin):
+        """The sequence number up to which we know an origin's presence."""
+        return max(self.seen.get(origin, 0), self.synced.get(origin, 0))
+
+    def run_link(self, sock, address):
+        """Carry events over a connected link until it drops."""
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        heartbeat.set_keepalive(sock)
+        link = Link(sock, address)
+        with self.lock:
+            # Events published from now on are queued behind the snapshot
+            link.queue.put(frame({"type": "hello", "origin": self.origin}))
+            for data in self.snapshot():
+                link.queue.put(data)
+            self.links.add(link)
+        self._spawn(self.write_loop, link)
+
+        decoder = protocol.FrameDecoder(max_frame_size=MAX_EVENT_SIZE)
+        try:
+            while True:
+                data = sock.recv(BUS_RECV_SIZE)
+                if not data:
+                    break
+                if not self.receive(link, decoder.feed(data)):
+                    break
+        except (OSError, ValueError, protocol.ProtocolError) as e:
+            print(f"Relay link to {link.name or address} failed: {e}")
+        link.queue.close()
+        sock.close()
+        self.link_lost(link)
+
+    def write_loop(self, link):
+        while True:
+            batch = link.queue.wait()
+            if batch is None:
+                break
+            try:
+                outbound.send_vectored(link.sock, batch)
+            except OSError:
+                # Wake the reader, which cleans up
+                try:
+                    link.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                break
+
+    def receive(self, link, frames):
+        """Apply and relay onward the events we haven't seen; returns False to drop the link."""
+        with self.lock:
+            fresh = []
+            for payload in frames:
+                event = json.loads(payload)
+                kind = event["type"]
+                if kind == "hello":
+                    if event["origin"] == self.origin:
+                        print(f"Relay peer {link.address} is this server; dropping the link")
+                        return False
+                    link.name = event["origin"]
+                    print(f"Relay link to {link.name} up")
+                    continue
+                if kind == "resync":
+                    for data in self.snapshot():
+                        link.queue.put(data)
+                    continue
+
+                origin = event["origin"]
+                if origin == self.origin:
+                    continue
+                if kind == "state":
+                    if origin in self.dropped:
+                        # A peer may answer our resync before it learns the origin is gone too
+                        if event["seq"] <= self.dropped[origin]:
+                            continue
+                        del self.dropped[origin]
+                    elif origin in self.remote_users and event["seq"] <= self.covered(origin):
+                        # A snapshot may repeat the last event we saw from an origin we lost
+                        continue
+                    # Events it covers may still be on their way over other links, with
+                    # chat lines we don't have, so it leaves seen alone
+                    self.synced[origin] = event["seq"]
+                elif event["seq"] <= self.seen.get(origin, 0):
+                    continue
+                else:
+                    self.seen[origin] = event["seq"]
+                    if origin in self.dropped and origin not in self.remote_users:
+                        # Still up after all; ask the peer that relayed this who is on it
+                        link.queue.put(frame({"type": "resync"}))
+                self.routes[origin] = link
+                data = protocol.HEADER.pack(len(payload)) + payload
+                for other in self.links:
+                    if other is not link:
+                        other.queue.put(data)
+                fresh.append(self.apply_presence(link, event))
+            if fresh:
+                self.dispatch(self.apply, fresh)
+        return True
+
+    def apply_presence(self, link, event):
+        """Update who is online where; returns the event and who it may bring on- or offline."""
+        kind = event["type"]
+        origin = event["origin"]
+        users = self.remote_users.setdefault(origin, collections.Counter())
+        room_counts = self.remote_rooms.setdefault(origin, collections.Counter())
+        if kind == "state":
+            names = set(users) | set(event["users"])
+            was_online = {name: chat_core.is_online(name) for name in names}
+            users.clear()
+            users.update(event["users"])
+            room_counts.clear()
+            room_counts.update(event["rooms"])
+            return event, was_online
+        if kind == "gone":
+            # Only believe it if that is where our news from those servers came from
+            lost = [server for server in event["servers"] if self.routes.get(server) is link]
+            return event, self.drop_origins(lost)
+        username = event.get("user")
+        was_online = {}
+        if event["seq"] <= self.synced.get(origin, 0):
+            # A snapshot already counted this join or leave
+            return event, was_online
+        if kind in ("join", "leave"):
+            was_online[username] = chat_core.is_online(username)
+        if kind == "join":
+            users[username] += 1
+            room_counts[chat_core.DEFAULT_ROOM] += 1
+        elif kind == "leave":
+            decrement(users, username)
+            for room in event["rooms"]:
+                decrement(room_counts, room)
+        elif kind == "room_join":
+            room_counts[event["room"]] += 1
+        elif kind == "room_leave":
+            decrement(room_counts, event["room"])
+        return event, was_online
+
+    def drop_origins(self, origins):
+        """Forget servers we can no longer hear from; returns their users as online before."""
+        users = {}
+        for origin in origins:
+            self.dropped[origin] = self.covered(origin)
+            for username in self.remote_users.pop(origin, ()):
+                users[username] = True
+            self.remote_rooms.pop(origin, None)
+            self.routes.pop(origin, None)
+            print(f"Relay server {origin} is gone")
+        return users
+
+    def link_lost(self, link):
+        with self.lock:
+            self.links.discard(link)
+            lost = [origin for origin, route in self.routes.items() if route is link]
+            users = self.drop_origins(lost)
+            if lost:
+                self._publish({"type": "gone", "servers": lost})
+                # They may still be reachable through another peer
+                resync = frame({"type": "resync"})
+                for other in self.links:
+                    other.queue.put(resync)
+        print(f"Relay link to {link.name or link.address} down")
+        if users:
+            self.dispatch(self.apply, [({"type": "gone"}, users)])
+
+    def apply(self, events):
+        """Deliver relayed events to this server's clients."""
+        for event, was_online in events:
+            kind = event["type"]
+            if kind == "message":
+                message_id = None
+                if event["room"] is not None and event.get("chat") is not None:
+                    message_id = chat_core.history_store.append(event["room"], event["text"])
+                chat_core.broadcast(event["text"], room=event["room"], chat=event.get("chat"),
+                                    message_id=message_id)
+            elif kind == "direct":
+                chat_core.send_to_user(event["user"], event["text"])
+            elif kind == "gone":
+                for username in was_online:
+                    if not chat_core.is_online(username):
+                        chat_core.announce_left(username)
+            for username, online in was_online.items():
+                chat_core.presence_changed(username, online)
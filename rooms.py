@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""Room membership index.
+
+Keeps both directions (room -> members and client -> rooms) so that
+delivering to a room costs O(members of that room) and removing a client
+costs O(rooms it is in), never O(all clients). Not thread-safe on its
+own; chat_core guards it with clients_lock.
+
+Broadcasts don't take that lock: they iterate an immutable snapshot of
+the room's members. A snapshot is built on first use after the room
+changes and then shared by every broadcast until the next join or leave.
+"""
+import re
+
+DEFAULT_ROOM = "general"
+ROOM_NAME = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
+
+
+def valid_room_name(name):
+    return bool(ROOM_NAME.match(name))
+
+
+class RoomIndex:
+    def __init__(self):
+        self.members = {}      # room -> set of clients
+        self.memberships = {}  # client -> set of rooms
+        self.snapshots = {}    # room -> tuple of members, dropped when the room changes
+
+    def join(self, client, room):
+        """Add a client to a room; returns False if it was already a member."""
+        members = self.members.setdefault(room, set())
+        if client in members:
+            return False
+        members.add(client)
+        self.snapshots.pop(room, None)
+        self.memberships.setdefault(client, set()).add(room)
+        return True
+
+    def leave(self, client, room):
+        """Remove a client from a room; returns False if it was not a member."""
+        members = self.members.get(room)
+        if not members or client not in members:
+            return False
+        members.discard(client)
+        self.snapshots.pop(room, None)
+        if not members:
+            del self.members[room]
+        rooms = self.memberships.get(client)
+        if rooms is not None:
+            rooms.discard(room)
+            if not rooms:
+                del self.memberships[client]
+        return True
+
+    def leave_all(self, client):
+        """Remove a client from every room; returns the rooms it was in."""
+        rooms = self.memberships.pop(client, set())
+        for room in rooms:
+            members = self.members[room]
+            members.discard(client)
+            self.snapshots.pop(room, None)
+            if not members:
+                del self.members[room]
+        return rooms
+
+    def members_of(self, room):
+        return self.members.get(room, ())
+
+    def snapshot(self, room):
+        """The cached member tuple of a room, or None if it must be rebuilt.
+
+        Safe to call without the lock; the tuple is never modified.
+        """
+        return self.snapshots.get(room)
+
+    def rebuild_snapshot(self, room):
+        """Snapshot a room's current members; call with the lock held."""
+        members = self.members.get(room)
+        if not members:
+            return ()
+        snapshot = self.snapshots[room] = tuple(members)
+        return snapshot
+
+    def rooms_of(self, client):
+        return self.memberships.get(client, ())
+
+    def counts(self):
+        """Number of members in each room."""
+        return {room: len(members) for room, members in self.members.items()}
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Full-text search over the message history.
+
+An inverted index maps every word of every chat line to the ids of the
+messages containing it, separately for each room. Message ids only grow,
+so each posting list is kept sorted just by appending, in an array of
+4-byte integers rather than a list of int objects. A query intersects
+the posting lists of its words, starting from the shortest, and walks
+back from the newest match, so it costs about the length of the rarest
+word's list no matter how much history there is.
+
+Indexing is kept off the broadcast path: add() only queues the message
+and an indexer thread tokenizes it and appends to the posting lists. At
+startup the same thread first indexes what is already in the history
+log, so older messages become searchable a little later than new ones.
+"""
+import array
+import bisect
+import queue
+import re
+import threading
+import time
+
+RESULTS = 20  # matches shown per search
+BACKFILL_BATCH = 1000  # records from the log indexed per lock hold
+INDEX_DELAY = 0.05  # seconds new messages are left to pile up, so busy rooms are indexed in batches
+
+WORD = re.compile(r"\w+")
+CLOCK = re.compile(r"\[\d\d:\d\d\] (#\S+ )?")
+
+
+def words(text):
+    """The distinct lowercase words of a chat line, without its time and room."""
+    prefix = CLOCK.match(text)
+    if prefix:
+        text = text[prefix.end():]
+    return set(WORD.findall(text.lower()))
+
+
+class SearchIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rooms = {}  # room -> {word: array of message ids, ascending}
+        self.queue = queue.Queue()
+        self.backfilled = False  # the log written before startup is indexed
+        self.messages = 0
+        self.postings = 0
+
+    def start(self, backlog=()):
+        """Index backlog, (id, room, text) records from before startup, then everything added."""
+        thread = threading.Thread(target=self._index_loop, args=(backlog,))
+        thread.daemon = True
+        thread.start()
+
+    def add(self, message_id, room, text):
+        """Queue a new message for indexing; ids must be added in increasing order."""
+        self.queue.put((message_id, room, text))
+
+    def _index_loop(self, backlog):
+        batch = []
+        try:
+            for record in backlog:
+                batch.append(record)
+                if len(batch) >= BACKFILL_BATCH:
+                    self._index(batch)
+                    batch = []
+        except OSError as e:
+            print(f"Indexing the history log failed: {e}")
+        self._index(batch)
+        self.backfilled = True
+
+        while True:
+            batch = [self.queue.get()]
+            time.sleep(INDEX_DELAY)
+            # Index everything that piled up in one go
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._index(batch)
+
+    def _index(self, batch):
+        # Tokenize before taking the lock, so searches wait only for the appends
+        tokenized = [(message_id, room, words(text)) for message_id, room, text in batch]
+        with self.lock:
+            for message_id, room, found in tokenized:
+                postings = self.rooms.get(room)
+                if postings is None:
+                    postings = self.rooms[room] = {}
+                for word in found:
+                    ids = postings.get(word)
+                    if ids is None:
+                        ids = postings[word] = array.array('I')
+                    ids.append(message_id)
+                self.postings += len(found)
+            self.messages += len(tokenized)
+
+    def search(self, room, query, limit=RESULTS):
+        """Ids of the newest messages in room containing every word of query, oldest first."""
+        wanted = words(query)
+        if not wanted:
+            return []
+        matches = []
+        with self.lock:
+            postings = self.rooms.get(room, {})
+            lists = [postings.get(word) for word in wanted]
+            if not all(lists):
+                return []
+            lists.sort(key=len)
+            rarest, others = lists[0], lists[1:]
+            for message_id in reversed(rarest):
+                for ids in others:
+                    position = bisect.bisect_left(ids, message_id)
+                    if position == len(ids) or ids[position] != message_id:
+                        break
+                else:
+                    matches.append(message_id)
+                    if len(matches) >= limit:
+                        break
+        matches.reverse()
+        return matches
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Session-resume tokens.
+
+A client that offers sessions at login is given a token naming its user,
+rooms and the history the server keeps. When its connection drops it
+logs back in with the token and the id of the last chat message it saw,
+and the server puts it back in its rooms and replays only what it missed
+instead of the usual welcome and scrollback.
+
+Tokens are signed rather than stored, so the server keeps no state for
+disconnected clients. The key is shared through the environment: workers
+forked in pre-fork mode and the process started by a hot restart inherit
+it and accept each other's tokens.
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import os
+import time
+
+KEY_ENV = "CHAT_SESSION_KEY"
+DEFAULT_TTL = 15 * 60  # seconds a token can be used to resume
+SIGNATURE_SIZE = 16
+
+
+def shared_key():
+    """The signing key from the environment, or a new one put there for our children."""
+    key = os.environ.get(KEY_ENV)
+    if key:
+        try:
+            return binascii.unhexlify(key)
+        except ValueError:
+            print(f"Ignoring {KEY_ENV}: not a hex string")
+    key = os.urandom(32)
+    os.environ[KEY_ENV] = key.hex()
+    return key
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+
+
+class SessionTokens:
+    def __init__(self, key, ttl=DEFAULT_TTL):
+        self.key = key
+        self.ttl = ttl
+
+    def _sign(self, payload):
+        return hmac.new(self.key, payload, hashlib.sha256).digest()[:SIGNATURE_SIZE]
+
+    def issue(self, username, room, rooms, origin):
+        """A token for a user's current rooms; origin names the history its message ids refer to."""
+        payload = _b64encode(json.dumps({
+            "user": username,
+            "room": room,
+            "rooms": sorted(rooms),
+            "origin": origin,
+            "expires": int(time.time() + self.ttl),
+        }).encode('utf-8'))
+        return (payload + b"." + _b64encode(self._sign(payload))).decode('ascii')
+
+    def verify(self, token, username):
+        """The session a token stands for, or None if it is forged, expired or someone else's."""
+        try:
+            payload, _, signature = token.encode('ascii').partition(b".")
+            if not hmac.compare_digest(_b64decode(signature), self._sign(payload)):
+                return None
+            session = json.loads(_b64decode(payload))
+        except (ValueError, UnicodeError):
+            return None
+        if session.get("user") != username or session.get("expires", 0) < time.time():
+            return None
+        return session
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""Optional TLS for client connections.
+
+The server only handshakes off the accept path. The thread engine wraps
+an accepted socket and runs the handshake on that client's own thread,
+under the login timeout. The asyncio engine lets the event loop run it
+without blocking. In both cases a slow or malicious handshake only costs
+its own connection.
+
+Reconnects are cheap because of session resumption. The server issues
+TLS 1.3 session tickets, and a client that reconnects presents the
+ticket from its last connection (client_session()), which skips the
+certificate exchange and key agreement. Ticket keys live in the server's
+SSLContext: pre-fork workers share them, because the context is created
+before forking, but a restarted server process can't resume sessions
+from the old one.
+
+OpenSSL does not allow a connection to be used from two threads at once,
+but the thread engine and both clients read and write on separate
+threads, so they wrap TLS connections in SerializedSocket.
+"""
+import select
+import socket
+import ssl
+import threading
+import time
+
+
+def server_context(certfile, keyfile=None):
+    """A context for accepting TLS connections with the given certificate chain."""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    # Our clients keep only the newest ticket, so don't spend time issuing more
+    context.num_tickets = 1
+    return context
+
+
+def client_context(cafile=None, verify=True):
+    """A context for connecting to a TLS server.
+
+    cafile trusts a private CA or self-signed certificate on top of the
+    system ones; verify=False accepts any certificate (testing only).
+    """
+    context = ssl.create_default_context(cafile=cafile)
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def client_session(sock):
+    """The session to resume on the next connection, or None if the server gave none."""
+    try:
+        session = sock.session
+    except (AttributeError, ValueError):
+        return None
+    return session if session is not None and session.has_ticket else None
+
+
+def _wait(sock, writable, timeout):
+    """Wait until sock is readable (or writable); raises socket.timeout."""
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        poller.register(sock, select.POLLOUT if writable else select.POLLIN)
+        ready = poller.poll(None if timeout is None else timeout * 1000)
+    else:
+        waiting = ([], [sock], []) if writable else ([sock], [], [])
+        ready = any(select.select(*waiting, timeout))
+    if not ready:
+        raise socket.timeout("timed out")
+
+
+class SerializedSocket:
+    """An SSLSocket that a reader and a writer thread can share.
+
+    The socket is non-blocking and every SSL call takes a lock, so the
+    two threads never use the connection at the same time and neither
+    holds the lock while waiting for the network. Offers the subset of
+    the socket interface the thread engine uses.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.timeout = None
+        sock.setblocking(False)
+
+    def _call(self, operation, *args):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            with self.lock:
+                try:
+                    return operation(*args)
+                except ssl.SSLWantReadError:
+                    writable = False
+                except ssl.SSLWantWriteError:
+                    writable = True
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            _wait(self.sock, writable, remaining)
+
+    def recv(self, size):
+        return self._call(self.sock.recv, size)
+
+    def sendall(self, data):
+        view = memoryview(data)
+        while view:
+            sent = self._call(self.sock.send, view)
+            view = view[sent:]
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def shutdown(self, how):
+        # Shut down the TCP connection underneath only: SSLSocket.shutdown()
+        # would tear down the SSL state while the other thread is using it
+        socket.socket.shutdown(self.sock, how)
+
+    def close(self):
+        self.sock.close()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    @property
+    def session(self):
+        return self.sock.session
+
+    @property
+    def session_reused(self):
+        return self.sock.session_reused
+
+    def setsockopt(self, *args):
+        self.sock.setsockopt(*args)